@@ -2,4 +2,5 @@ from . compute_fracture_modes import compute_fracture_modes
 from . fracture_modes import FractureModes
 from . fracture_modes_parameters import FractureModesParameters
 from . explode_mesh import explode_mesh
-from . generate_fractures import generate_fractures
\ No newline at end of file
+from . generate_fractures import generate_fractures
+from . fracture_dataset import FractureDataset
\ No newline at end of file
@@ -0,0 +1,148 @@
+# Include existing libraries
+import numpy as np
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
+
+
+class ADMMConicSolver:
+    # License-free alternative to MosekConicSolver. It solves the same problem
+    #           argmin     ||Du||_{2,1}
+    #           s.t.       u' M Us = 0
+    #           and        u' M c = 1
+    # with the (proximal) alternating direction method of multipliers, by
+    # splitting it as
+    #           argmin     sum ||Y_e||
+    #           s.t.       Y = Du
+    #           and        A u = b       <--- all the rows above, stacked
+    # Every iteration is one block soft-thresholding of Y and one linear solve
+    # with K = rho D'D + sigma M, which we factorize once per mesh. The affine
+    # constraints are only a handful of rows, so we deal with them through a
+    # small dense Schur complement instead of refactorizing when they change.
+
+    def __init__(self, D, M, d, tol=1e-6, max_iter=5000, rho=1.0, sigma=1e-3, verbose=False):
+        D = csc_matrix(D)
+        self.d = d
+        self.p = D.shape[0] // d
+        self.n = D.shape[1]
+        self.tol = tol
+        self.max_iter = max_iter
+        self.verbose = verbose
+        self.M = csc_matrix(M)
+        # D is typically tiny (omega times face areas), so rescale it so that
+        # D'D and M have comparable diagonals. This doesn't change the
+        # minimizer, but makes the default rho and sigma sensible for any mesh.
+        m_diag = self.M.diagonal()
+        dtd_diag = np.asarray(D.multiply(D).sum(axis=0)).ravel()
+        self.scale = np.sqrt(np.mean(dtd_diag) / np.mean(m_diag))
+        self.D = D / self.scale
+        self.Dt = csc_matrix(self.D.T)
+        self.rho = rho
+        self.sigma = sigma
+        self.DtD = csc_matrix(self.Dt @ self.D)
+        self.factorize()
+
+        # Rows of A (as M-weighted vectors) and their precomputed K^{-1} A'
+        self.orthogonality_rows = []
+        self.orthogonality_solves = []
+        # ADMM state, reused as a warm start between consecutive solves
+        self.u = np.zeros(self.n)
+        self.Y = np.zeros(self.p * d)
+        self.Z = np.zeros(self.p * d)
+        self.num_iterations = 0
+
+    def factorize(self):
+        K = csc_matrix(self.rho * self.DtD + self.sigma * self.M)
+        self.K_solve = splu(K).solve
+        # The cached K^{-1} A' depend on rho, so they need updating too
+        if hasattr(self, "orthogonality_rows"):
+            self.orthogonality_solves = [self.K_solve(a) for a in self.orthogonality_rows]
+
+    def add_orthogonality(self, U):
+        # Set up orthogonality constraint wrt U (called once per finished mode)
+        a = self.M @ U
+        self.orthogonality_rows.append(a)
+        self.orthogonality_solves.append(self.K_solve(a))
+        # The previous state belongs to a different mode, so don't warm start from it
+        self.u = np.zeros(self.n)
+        self.Y = np.zeros(self.p * self.d)
+        self.Z = np.zeros(self.p * self.d)
+
+    def shrink(self, X, kappa):
+        # Block soft-thresholding: the proximal operator of kappa * sum ||X_e||
+        X = np.reshape(X, (-1, self.p))
+        norms = np.linalg.norm(X, axis=0)
+        factor = np.maximum(1.0 - kappa / np.maximum(norms, 1e-300), 0.0)
+        return np.reshape(X * factor[None, :], (-1,))
+
+    def solve(self, c, tol=None, max_iter=None):
+        # tol and max_iter override the ones we were built with for this solve only (e.g., a loose early solve, see solve_fracture_modes)
+        tol = self.tol if tol is None else tol
+        max_iter = self.max_iter if max_iter is None else max_iter
+        a_c = self.M @ c
+        A = np.vstack(self.orthogonality_rows + [a_c])
+        b = np.zeros(A.shape[0])
+        b[-1] = 1.0
+        W = np.column_stack(self.orthogonality_solves + [self.K_solve(a_c)])
+        S = A @ W
+
+        u, Y, Z = self.u, self.Y, self.Z
+        eps_abs = tol * np.sqrt(self.p * self.d)
+        num_refactorizations = 0
+        for it in range(max_iter):
+            # u-update: argmin rho/2||Du - Y + Z||^2 + sigma/2||u - u_prev||_M^2 s.t. A u = b
+            r = self.rho * (self.Dt @ (Y - Z)) + self.sigma * (self.M @ u)
+            Kr = self.K_solve(r)
+            lam = np.linalg.solve(S, A @ Kr - b)
+            u = Kr - W @ lam
+            # Y-update
+            Du = self.D @ u
+            Y_prev = Y
+            Y = self.shrink(Du + Z, 1.0 / self.rho)
+            # Dual update
+            Z = Z + Du - Y
+
+            # Stopping criterion (see Boyd et al. 2011, section 3.3)
+            primal_residual = np.linalg.norm(Du - Y)
+            dual_residual = self.rho * np.linalg.norm(self.Dt @ (Y - Y_prev))
+            eps_primal = eps_abs + tol * max(np.linalg.norm(Du), np.linalg.norm(Y))
+            eps_dual = eps_abs + tol * self.rho * np.linalg.norm(self.Dt @ Z)
+            if primal_residual <= eps_primal and dual_residual <= eps_dual:
+                break
+
+            # Residual balancing, but refactorizing K only rarely
+            if it % 100 == 99 and num_refactorizations < 10:
+                if primal_residual > 10 * dual_residual * eps_primal / eps_dual:
+                    rho_factor = 2.0
+                elif dual_residual > 10 * primal_residual * eps_dual / eps_primal:
+                    rho_factor = 0.5
+                else:
+                    continue
+                self.rho = self.rho * rho_factor
+                Z = Z / rho_factor  # Z is the scaled dual variable
+                self.factorize()
+                W = np.column_stack(self.orthogonality_solves + [self.K_solve(a_c)])
+                S = A @ W
+                num_refactorizations += 1
+        if self.verbose:
+            print(f"ADMM: {it + 1} iterations, primal residual {primal_residual}, dual residual {dual_residual}.")
+        self.num_iterations = it + 1
+        self.u, self.Y, self.Z = u, Y, Z
+        return u
+
+    def checkpoint_state(self):
+        # What a mode checkpoint needs to carry on with the same solver (see ModeCheckpoint): the step size, which residual balancing changes over time
+        return {'rho': self.rho}
+
+    def restore_state(self, state):
+        if 'rho' in state and state['rho'] != self.rho:
+            self.rho = state['rho']
+            self.factorize()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,94 @@
+# Include existing libraries
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+
+
+def write_arrays(directory, arrays):
+    """Write a dictionary of arrays to a directory of .npy files.
+
+    Every dense array is written to its own uncompressed .npy file, so that it can later be memory-mapped. Sparse matrices are stored through their compressed (CSR or CSC) index arrays, and plain Python scalars and strings go into an `index.json` file next to them. The directory is written under a temporary name and renamed at the end, so readers never see a half-written directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to write (overwritten if it exists)
+    arrays : dict
+        Maps names to numpy arrays, scipy sparse matrices, or int / float / bool / str / None values
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_directory = os.path.join(parent, f".tmp_{uuid.uuid4().hex}")
+    os.makedirs(tmp_directory)
+    index = {}
+    for name, value in arrays.items():
+        if issparse(value):
+            fmt = 'csc' if value.format == 'csc' else 'csr'
+            value = csc_matrix(value) if fmt == 'csc' else csr_matrix(value)
+            for part in ['data', 'indices', 'indptr']:
+                np.save(os.path.join(tmp_directory, f"{name}.{part}.npy"), getattr(value, part))
+            index[name] = {'type': fmt, 'shape': list(value.shape)}
+        elif isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_directory, f"{name}.npy"), value)
+            index[name] = {'type': 'array'}
+        else:
+            if isinstance(value, np.generic):
+                value = value.item()
+            index[name] = {'type': 'value', 'value': value}
+    with open(os.path.join(tmp_directory, "index.json"), "w") as f:
+        json.dump(index, f)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    try:
+        os.replace(tmp_directory, directory)
+    except OSError:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+
+
+def read_arrays(directory, mmap=False):
+    """Read a directory written by `write_arrays`.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory
+    mmap : bool (optional, default False)
+        Whether to memory-map the arrays (read-only) instead of loading them into memory
+
+    Returns
+    -------
+    arrays : dict
+        Maps names to numpy arrays, scipy sparse matrices or plain values
+    """
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(directory, "index.json")) as f:
+        index = json.load(f)
+    arrays = {}
+    for name, entry in index.items():
+        if entry['type'] in ('csr', 'csc'):
+            parts = [np.load(os.path.join(directory, f"{name}.{part}.npy"), mmap_mode=mmap_mode)
+                     for part in ['data', 'indices', 'indptr']]
+            matrix_type = csc_matrix if entry['type'] == 'csc' else csr_matrix
+            arrays[name] = matrix_type(tuple(parts), shape=tuple(entry['shape']), copy=False)
+        elif entry['type'] == 'array':
+            arrays[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+        else:
+            arrays[name] = entry['value']
+    return arrays
+
+
+def directory_size(directory):
+    # Total size in bytes of all files in a directory tree
+    total = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
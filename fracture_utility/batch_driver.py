@@ -0,0 +1,253 @@
+# Include existing libraries
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from multiprocessing.connection import wait
+
+from .conic_solve import mosek, mosek_env
+
+# Thread pools of the numerical libraries, which we size to the CPUs of each worker
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS']
+
+
+@contextmanager
+def redirect_output(log_file):
+    # Sends everything written to stdout and stderr to log_file, at the file descriptor level, so that it also captures what C and C++ libraries (MOSEK, libigl, tetgen) print
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    with open(log_file, "w") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+
+
+def worker_main(connection, function, cpus):
+    # Main loop of a worker process: run tasks until told to stop (with None). It says 'ready' once it has started up, and 'started' when it gets a task, so that the time it takes to start (importing libraries, checking out a license) doesn't count towards the task's timeout
+    # A session (and process group) of our own, so that BatchWorker.kill also gets the processes our tasks start
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    # Check out a MOSEK license once for every task this worker will run
+    if mosek is not None:
+        mosek_env()
+    connection.send('ready')
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        connection.send('started')
+        kwargs, log_file = task
+        t0 = time.time()
+        with redirect_output(log_file):
+            try:
+                function(**kwargs)
+                status = 'ok'
+            except Exception:
+                traceback.print_exc()
+                status = 'error'
+        connection.send((status, time.time() - t0))
+
+
+def default_worker_cpus(num_workers=None, cpus_per_worker=1):
+    # Splits the CPUs this process can run on into groups of cpus_per_worker, one per worker
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    if num_workers is None:
+        num_workers = max(len(cpus) // cpus_per_worker, 1)
+    return [cpus[(i * cpus_per_worker) % len(cpus):(i * cpus_per_worker) % len(cpus) + cpus_per_worker]
+            for i in range(num_workers)]
+
+
+class BatchWorker:
+    # A worker process, and the task it is running (if any)
+
+    def __init__(self, context, function, cpus):
+        self.context = context
+        self.function = function
+        self.cpus = cpus
+        self.task = None
+        # When the task was sent, and when the worker started running it (see worker_main)
+        self.sent = None
+        self.started = None
+        self.deadline = None
+        self.start()
+
+    def start(self):
+        self.connection, child_connection = self.context.Pipe()
+        # (not a daemon, so that tasks can start processes of their own, e.g., generate_fractures with num_workers > 1. run stops every worker when it's done)
+        self.process = self.context.Process(target=worker_main, args=(child_connection, self.function, self.cpus),
+                                            daemon=False)
+        # A new process reads these when it starts, before it imports numpy
+        num_threads = str(len(self.cpus)) if self.cpus is not None else None
+        saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+        try:
+            if num_threads is not None:
+                for name in THREAD_VARIABLES:
+                    os.environ[name] = num_threads
+            self.process.start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        child_connection.close()
+
+    def kill(self):
+        # Kills the worker and whatever its task started (e.g., the Pool of generate_fractures with num_workers > 1), which would otherwise keep running on our CPUs. This is safe after the worker is gone: its process group lives on while any of those does
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                # (the worker didn't get to start its own group, or nothing is left of it)
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+    def restart(self):
+        self.kill()
+        self.connection.close()
+        self.start()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=10)
+        self.kill()
+        self.connection.close()
+
+
+class BatchDriver:
+    """Runs a function on many inputs in a pool of persistent worker processes.
+
+    This is meant for `generate_fractures` on a whole dataset: instead of a new Python process per mesh, which has to import every library and check out a MOSEK license again, every worker does that once and then runs task after task. Each worker is pinned to its own CPUs (`worker_cpus`), and the numerical libraries in it use that many threads. Every task writes everything it prints to its own log file. A task that raises is logged and reported as an error, without affecting other tasks. A task that runs longer than `timeout` seconds, or whose worker dies, is reported as such and its worker is replaced by a fresh one.
+
+    Parameters
+    ----------
+    function : callable
+        Function to run (it must be importable, e.g. `generate_fractures`), called with the keyword arguments of each task
+    worker_cpus : list of lists of ints (optional, default None)
+        CPUs of each worker. By default, one worker per CPU (see `default_worker_cpus`)
+    timeout : float (optional, default None)
+        Maximum number of seconds a task can run for
+    """
+
+    def __init__(self, function, worker_cpus=None, timeout=None):
+        self.function = function
+        if worker_cpus is None:
+            worker_cpus = default_worker_cpus()
+        self.worker_cpus = worker_cpus
+        self.timeout = timeout
+        # Workers must not inherit a (multithreaded) copy of our state
+        self.context = multiprocessing.get_context('spawn')
+
+    def run(self, tasks, callback=None, poll_interval=10):
+        # Runs every task, a (kwargs, log_file) pair, and returns a list with the (status, seconds) of each, where status is 'ok', 'error', 'timeout' or 'crashed'. If given, callback(i, status, seconds) is called as soon as task i is done. tasks can also be an iterator, which is only advanced when a worker is free (e.g., to claim tasks from a SharedTaskQueue one at a time), and which can yield None when it has no task to give yet, to be asked again poll_interval seconds later. Tasks are numbered in the order they were started
+        if isinstance(tasks, (list, tuple)):
+            worker_cpus = self.worker_cpus[:max(len(tasks), 1)]
+        else:
+            worker_cpus = self.worker_cpus
+        source = iter(tasks)
+        tasks = []
+        results = []
+        exhausted = False
+        next_poll = None
+        workers = [BatchWorker(self.context, self.function, cpus) for cpus in worker_cpus]
+
+        def finish(worker, status, seconds):
+            i = worker.task
+            worker.task = None
+            results[i] = (status, seconds)
+            if status in ('timeout', 'crashed'):
+                # Whatever the task logged is still there, we just say what happened at the end
+                with open(tasks[i][1], "a") as log:
+                    log.write(f"\nTask {status} after {seconds:.1f} seconds "
+                              f"(worker exit code {worker.process.exitcode})\n")
+            if callback is not None:
+                callback(i, status, seconds)
+
+        try:
+            while True:
+                for worker in workers:
+                    if worker.task is not None or exhausted or (next_poll is not None and time.time() < next_poll):
+                        continue
+                    try:
+                        task = next(source)
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                    if task is None:
+                        next_poll = time.time() + poll_interval
+                        continue
+                    next_poll = None
+                    tasks.append(task)
+                    results.append(None)
+                    if not worker.process.is_alive():
+                        worker.restart()
+                    worker.task = len(tasks) - 1
+                    worker.sent = time.time()
+                    # (the deadline is set once the worker starts the task)
+                    worker.started = None
+                    worker.deadline = None
+                    worker.connection.send(task)
+                busy = [worker for worker in workers if worker.task is not None]
+                if not busy:
+                    if exhausted:
+                        break
+                    if next_poll is not None:
+                        time.sleep(max(next_poll - time.time(), 0))
+                    continue
+                deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+                if next_poll is not None and len(busy) < len(workers):
+                    deadlines.append(next_poll)
+                wait_time = max(min(deadlines) - time.time(), 0) if deadlines else None
+                ready = wait([worker.connection for worker in busy] + [worker.process.sentinel for worker in busy],
+                             timeout=wait_time)
+                for worker in busy:
+                    if worker.connection in ready or worker.process.sentinel in ready:
+                        try:
+                            while worker.task is not None and worker.connection.poll():
+                                message = worker.connection.recv()
+                                if message == 'started':
+                                    worker.started = time.time()
+                                    if self.timeout is not None:
+                                        worker.deadline = worker.started + self.timeout
+                                elif message != 'ready':
+                                    status, seconds = message
+                                    finish(worker, status, seconds)
+                            if worker.task is not None and worker.process.sentinel in ready:
+                                raise EOFError
+                        except (EOFError, OSError):
+                            # The worker died (e.g., a segfault in a C++ library or running out of memory)
+                            worker.kill()
+                            finish(worker, 'crashed', time.time() - (worker.started or worker.sent))
+                            worker.restart()
+                            continue
+                    if worker.task is not None and worker.deadline is not None and time.time() >= worker.deadline:
+                        worker.kill()
+                        finish(worker, 'timeout', time.time() - worker.started)
+                        worker.restart()
+        finally:
+            for worker in workers:
+                worker.stop()
+        return results
@@ -1,109 +1,302 @@
 # Include existing libraries
+import time
+import warnings
+
 import numpy as np
-from scipy.sparse import coo_matrix, csr_matrix, kron, eye
-from scipy.sparse.linalg import eigsh
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, kron, eye
+from scipy.sparse.linalg import LinearOperator, eigsh, lobpcg, spilu, splu
 from scipy.sparse.csgraph import connected_components
 # Libigl
 import igl
 from tqdm import tqdm
 
+# pyamg for the multigrid preconditioner of the 'lobpcg' eigen backend (optional, an incomplete LU factorization is used otherwise)
+try:
+    import pyamg
+except ImportError:
+    pyamg = None
+
 # Local includes
 from .explode_mesh import explode_mesh
-from .conic_solve import conic_solve
+from .conic_solve import make_conic_solver
 from .massmatrix_tets import massmatrix_tets
-from .sparse_sqrt import sparse_sqrt
+from .mode_checkpoint import ModeCheckpoint
+from .stage_cache import hash_arrays, stage_key
 from .tictoc import tic, toc
 
 
-# @profile
-def compute_fracture_modes(vertices, elements, parameters):
-    # Takes as input an (unexploded) tetrahedral mesh and a number of modes, returns a matrix UU dim x #T by #parameters.num_modes with computed fracture modes.
-    if parameters.verbose:
-        print("Starting fracture mode computation")
-        print(f"We will find {parameters.num_modes} unique fracture modes")
-        print(f"Our input (unexploded) mesh has {vertices.shape[0]} vertices and {elements.shape[0]} tetrahedra.")
-        tic()
+# With eigen_backend='auto', Laplacians with more rows than this use LOBPCG instead of a direct factorization, whose fill-in grows too fast in 3D (on regular grids, 36k rows already take 650MB to factorize, and 91k rows take 2.5GB, see scripts/benchmark_eigen.py)
+lobpcg_min_size = 20000
+
+
+def laplacian_preconditioner(A, kind=None):
+    # Approximate inverse of the (nonsingular) matrix A for LOBPCG: smoothed aggregation multigrid with kind='amg', an incomplete LU factorization with kind='ilu', and by default multigrid if pyamg is installed
+    if kind is None:
+        kind = 'ilu' if pyamg is None else 'amg'
+    if kind == 'amg':
+        if pyamg is None:
+            raise ImportError("The 'amg' eigen preconditioner needs pyamg to be installed. Use eigen_preconditioner='ilu' otherwise.")
+        return pyamg.smoothed_aggregation_solver(csr_matrix(A)).aspreconditioner()
+    elif kind == 'ilu':
+        # (a loose drop tolerance: a better preconditioner saves fewer LOBPCG iterations than it costs to build)
+        ilu = spilu(csc_matrix(A), drop_tol=1e-2, fill_factor=5)
+        return LinearOperator(A.shape, matvec=ilu.solve, dtype=float)
+    else:
+        raise ValueError(f"Unknown eigen preconditioner '{kind}'. Choose 'amg' or 'ilu'.")
+
+
+class LaplacianEigensolver:
+    # Smallest eigenmodes of the generalized eigenproblem -Q u = lambda M u, for a (negative semidefinite) Laplacian Q and a mass matrix M
+    # -Q is singular (constant functions are in its kernel), so instead of factorizing it we factorize -Q + shift M, with a shift far below its first nonzero eigenvalue. With backend='shift_invert', this is a sparse LU factorization, and eigsh runs in shift-invert mode around -shift. With backend='lobpcg', it is only an approximate inverse (see laplacian_preconditioner) and we use block LOBPCG, which needs a fraction of the memory on large meshes. backend='auto' chooses by size (see lobpcg_min_size)
+    # The factorization or preconditioner is built once and kept, and so are the eigenmodes, so that asking for more modes only solves the eigenproblem again (and LOBPCG only solves for the new ones)
+
+    def __init__(self, Q, M, backend='auto', preconditioner=None, tol=1e-5):
+        self.A = csc_matrix(-Q)
+        self.M = csc_matrix(M)
+        if backend == 'auto':
+            backend = 'lobpcg' if self.A.shape[0] > lobpcg_min_size else 'shift_invert'
+        if backend not in ('shift_invert', 'lobpcg'):
+            raise ValueError(f"Unknown eigen backend '{backend}'. Choose 'shift_invert', 'lobpcg' or 'auto'.")
+        self.backend = backend
+        self.preconditioner = preconditioner
+        self.tol = tol
+        # The diagonals' ratio is the scale of the largest eigenvalues
+        self.shift = 1e-6 * np.mean(self.A.diagonal()) / np.mean(self.M.diagonal())
+        self.inverse = None
+        self.eigenmodes = None
+
+    def shifted_inverse(self):
+        if self.inverse is None:
+            shifted = self.A + self.shift * self.M
+            if self.backend == 'shift_invert':
+                self.inverse = LinearOperator(self.A.shape, matvec=splu(csc_matrix(shifted)).solve, dtype=float)
+            else:
+                self.inverse = laplacian_preconditioner(shifted, self.preconditioner)
+        return self.inverse
+
+    def solve(self, num_modes):
+        # The first num_modes eigenmodes, one per column, by increasing eigenvalue
+        if self.eigenmodes is not None and self.eigenmodes.shape[1] >= num_modes:
+            return self.eigenmodes[:, :num_modes]
+        if self.backend == 'shift_invert':
+            # eigsh(A,num_modes,M,which='SM') # <- our bottleneck outside of conic solves
+            _, eigenmodes = eigsh(self.A, num_modes, self.M, which='LM', sigma=-self.shift,
+                                  OPinv=self.shifted_inverse())
+            self.eigenmodes = np.real(eigenmodes)
+        else:
+            # Only the modes we don't have yet, constrained to be M-orthogonal to those (extra vectors in the block, which the wanted ones would converge faster with, slow LOBPCG down here: they have to converge too, and take much longer)
+            num_known = 0 if self.eigenmodes is None else self.eigenmodes.shape[1]
+            X = np.random.default_rng(num_known).standard_normal((self.A.shape[0], num_modes - num_known))
+            with warnings.catch_warnings():
+                # (LOBPCG warns with every residual when it doesn't converge, we print one line instead)
+                warnings.simplefilter('ignore', UserWarning)
+                eigenvalues, eigenmodes, residual_norms = lobpcg(self.A, X, B=self.M, M=self.shifted_inverse(),
+                                                                 Y=self.eigenmodes, tol=self.tol, maxiter=200,
+                                                                 largest=False, retResidualNormsHistory=True)
+            # (only when it is clearly off, a residual just above tol makes no difference)
+            residual = np.max(residual_norms[-1])
+            if residual > 10 * self.tol:
+                print(f"LOBPCG stopped at a residual of {residual:.3e} instead of {self.tol:.3e}, "
+                      f"so the initial guesses are less accurate (but still usable).")
+            eigenmodes = eigenmodes[:, np.argsort(eigenvalues)]
+            self.eigenmodes = eigenmodes if self.eigenmodes is None else np.hstack((self.eigenmodes, eigenmodes))
+        return self.eigenmodes
+
+
+class FractureOperators:
+    # Everything compute_fracture_modes builds before solving for the modes: the Laplacian eigenproblem that gives us initial guesses, the exploded mesh and the per-tet matrices of the conic problem. FractureModes keeps it, so that extend_modes only pays for the new modes
+
+    def __init__(self, vertices, elements, parameters):
+        self.d = parameters.d
+        self.omega = parameters.omega
+        self.num_quad = parameters.num_quad
+        # (to tell checkpoints of different meshes apart)
+        self.mesh_hash = hash_arrays(vertices, elements)
+        blockdiag_kron = eye(parameters.d)
+        # Step 1: Laplacian eigenmodes (see initial_guesses)
+        laplacian_unexploded = igl.cotmatrix(vertices, elements)
+        self.massmatrix_unexploded = kron(blockdiag_kron, massmatrix_tets(vertices, elements), format='csc')
+        self.Q_unexploded = kron(blockdiag_kron, laplacian_unexploded, format='csc')
+        self.eigensolver = LaplacianEigensolver(self.Q_unexploded, self.massmatrix_unexploded,
+                                                backend=parameters.eigen_backend,
+                                                preconditioner=parameters.eigen_preconditioner,
+                                                tol=parameters.eigen_tol)
+
+        # Step 2: Explode mesh, get unexploded-to-exploded matrix, get discontinuity and exploded Laplacian matrices
+        self.exploded_vertices, self.exploded_elements, discontinuity_matrix, self.unexploded_to_exploded_matrix, self.tet_to_vertex_matrix, self.tet_neighbors = explode_mesh(
+            vertices, elements, num_quad=parameters.num_quad)
+        discontinuity_matrix_full = kron(parameters.omega * blockdiag_kron, discontinuity_matrix, format='coo')
+        self.unexploded_to_exploded_matrix_full = kron(blockdiag_kron, self.unexploded_to_exploded_matrix, format='csc')
+        self.tet_to_vertex_matrix_full = kron(blockdiag_kron, self.tet_to_vertex_matrix, format='csc')
+        massmatrix_exploded = massmatrix_tets(self.exploded_vertices, self.exploded_elements)
+        M = kron(blockdiag_kron, massmatrix_exploded, format='csc')
+
+        # We convert everything into per-tet quantities
+        self.M = coo_matrix(self.tet_to_vertex_matrix_full.T @ M @ self.tet_to_vertex_matrix_full)
+        self.discontinuity_matrix_full = coo_matrix(discontinuity_matrix_full @ self.tet_to_vertex_matrix_full)
+
+    def matches(self, parameters):
+        # Whether these operators are the ones parameters would build
+        return (self.d, self.omega, self.num_quad) == (parameters.d, parameters.omega, parameters.num_quad)
+
+    def initial_guesses(self, num_modes):
+        # The first num_modes Laplacian eigenmodes, as per-tet exploded displacements. The eigensolver keeps its factorization and the eigenmodes, so that asking for more modes later doesn't factorize again
+        UU = self.unexploded_to_exploded_matrix_full @ self.eigensolver.solve(num_modes)
+        return self.tet_to_vertex_matrix_full.T @ UU
+
 
-    # Step 1: Compute traditional Laplacian eigenmodes.
-    blockdiag_kron = eye(parameters.d)
-    laplacian_unexploded = igl.cotmatrix(vertices, elements)
-    massmatrix_unexploded = kron(blockdiag_kron, massmatrix_tets(vertices, elements), format='csc')
-    Q_unexploded = kron(blockdiag_kron, laplacian_unexploded, format='csc')
-    # print(-Q_unexploded)
-    # print(massmatrix_unexploded)
-    # unexploded_Q_eigenvalues, unexploded_Q_eigenmodes = eigsh(-Q_unexploded,parameters.num_modes,massmatrix_unexploded,which='SM') # <- our bottleneck outside of conic solves
-    unexploded_Q_eigenvalues, unexploded_Q_eigenmodes = eigsh(-Q_unexploded, parameters.num_modes,
-                                                              massmatrix_unexploded, which='LM', sigma=0)
-    unexploded_Q_eigenmodes = np.real(unexploded_Q_eigenmodes)
-
-    # Step 2: Explode mesh, get unexploded-to-exploded matrix, get discontinuity and exploded Laplacian matrices
-    exploded_vertices, exploded_elements, discontinuity_matrix, unexploded_to_exploded_matrix, tet_to_vertex_matrix, tet_neighbors = explode_mesh(
-        vertices, elements, num_quad=1)
-    discontinuity_matrix_full = kron(parameters.omega * blockdiag_kron, discontinuity_matrix, format='coo')
-    unexploded_to_exploded_matrix_full = kron(blockdiag_kron, unexploded_to_exploded_matrix, format='csc')
-    tet_to_vertex_matrix_full = kron(blockdiag_kron, tet_to_vertex_matrix, format='csc')
-    laplacian_exploded = igl.cotmatrix(exploded_vertices, exploded_elements)
-    massmatrix_exploded = massmatrix_tets(exploded_vertices, exploded_elements)
-    Q = kron(blockdiag_kron, laplacian_exploded, format='csc')
-    R = coo_matrix(sparse_sqrt(-Q))
-    M = kron(blockdiag_kron, massmatrix_exploded, format='csc')
-
-    # Step 3: Solve iteratively to find all modes
+def checkpoint_key(operators, parameters, previous_modes=None):
+    # What a mode checkpoint depends on: the mesh, the parameters (but not how many modes we want, so that a run can resume asking for more) and the modes the new ones must be orthogonal to
+    parameter_values = {name: value for name, value in vars(parameters).items()
+                        if name not in ('verbose', 'num_modes', 'checkpoint_dir', 'time_budget', 'max_solves')}
+    previous_hash = None if previous_modes is None else hash_arrays(previous_modes)
+    return stage_key('mode_checkpoint', operators.mesh_hash, parameter_values, previous_hash)
 
+
+def within_budget(parameters, start_time, num_solves):
+    # Whether the mode computation that started at start_time may do one more conic solve
+    if parameters.time_budget is not None and time.time() - start_time >= parameters.time_budget:
+        return False
+    return parameters.max_solves is None or num_solves < parameters.max_solves
+
+
+def solve_fracture_modes(operators, parameters, num_modes, previous_modes=None, start_time=None, telemetry=None):
+    # Step 3: Solve iteratively to find num_modes modes with the operators of a mesh, returning them (one per column) and the per-tet piece labels of each. If previous_modes (one per column) is given, these are the modes that come after them: each is orthogonal to them and starts from the next Laplacian eigenmode, just like when computing all of them at once
+    # With parameters.checkpoint_dir, every mode is saved there as soon as it converges, and a run that finds a checkpoint of the same computation resumes after its last mode. The checkpoint is deleted once all modes are computed
+    # With parameters.time_budget or parameters.max_solves, we stop when the budget runs out (counting from start_time, by default now) and return only the modes we finished, so there can be fewer than num_modes. The budget is checked before every conic solve, so it can be overshot by the length of one. The checkpoint is kept, so a run with more budget carries on from there
+    # With parameters.loose_solver_tol, the first conic solves of each mode, when c is still far from the mode, are only solved approximately: each one is parameters.solver_tol_factor times as accurate as the one before, or as the last change in c if that's smaller, until that is below parameters.solver_tol or c stops changing, and from then on they are solved to full accuracy. A mode only counts as converged after a full-accuracy solve that changed it by less than parameters.tol, so the modes match the ones we'd get without the schedule up to that. If telemetry is a list, a dictionary is appended to it for every solve, with the mode, its iteration, the solver's tolerance (None for full accuracy) and number of iterations, the time it took and the change in c
+    if start_time is None:
+        start_time = time.time()
+    num_previous = 0 if previous_modes is None else previous_modes.shape[1]
     # Initialization
-    UU = unexploded_to_exploded_matrix_full @ unexploded_Q_eigenmodes
+    UU = operators.initial_guesses(num_previous + num_modes)[:, num_previous:]
+    M = operators.M
 
-    # We convert everything into per-tet quantities
-    UU = tet_to_vertex_matrix_full.T @ UU
-    Q = coo_matrix(tet_to_vertex_matrix_full.T @ Q @ tet_to_vertex_matrix_full)
-    R = coo_matrix(sparse_sqrt(-Q))
-    M = coo_matrix(tet_to_vertex_matrix_full.T @ M @ tet_to_vertex_matrix_full)
-    discontinuity_matrix_full = coo_matrix(discontinuity_matrix_full @ tet_to_vertex_matrix_full)
+    # The conic problem only changes by one row per inner iteration and one row per mode, so we build it once
+    solver = make_conic_solver(operators.discontinuity_matrix_full, M, parameters.d, parameters)
+    for k in range(num_previous):
+        solver.add_orthogonality(previous_modes[:, k])
 
-    if parameters.verbose:
-        t_before_modes = toc(silence=True)
-        print(f"Building matrices before starting mode computation: {t_before_modes} seconds.")
+    labels_full = np.zeros((operators.exploded_elements.shape[0], num_modes))
+    checkpoint = None
+    num_done = 0
+    if parameters.checkpoint_dir is not None:
+        checkpoint = ModeCheckpoint(parameters.checkpoint_dir, checkpoint_key(operators, parameters, previous_modes))
+        done_modes, done_labels, solver_state = checkpoint.load()
+        if done_modes is not None:
+            num_done = min(done_modes.shape[1], num_modes)
+            UU[:, :num_done] = done_modes[:, :num_done]
+            labels_full[:, :num_done] = done_labels[:, :num_done]
+            for k in range(num_done):
+                solver.add_orthogonality(UU[:, k])
+            # (e.g., the ADMM step size, so that we carry on exactly as if we hadn't stopped)
+            solver.restore_state(solver_state)
+            if parameters.verbose:
+                print(f"Resuming from a checkpoint with {num_done} modes.")
 
     # "Outer" loop to find all modes
-    Us = []
     ts = []
-    labels_full = np.zeros((elements.shape[0], parameters.num_modes))
-    for k in tqdm(range(parameters.num_modes), desc="Computing fracture modes"):
-        if parameters.verbose:
-            tic()
+    num_solves = 0
+    num_computed = num_done
+    for k in tqdm(range(num_done, num_modes), desc="Computing fracture modes", initial=num_done, total=num_modes):
+        tic()
         iter_num = 0
         diff = 1.0
+        converged = False
+        solver_tol = parameters.loose_solver_tol
         c = UU[:, k]  # initialize to exploded laplacian mode
         # "Inner" loop to find each mode
-        while diff > parameters.tol and iter_num < parameters.max_iter:
+        while not converged and iter_num < parameters.max_iter:
+            if not within_budget(parameters, start_time, num_solves):
+                break
+            # (the last iteration we're allowed is always solved to full accuracy)
+            if solver_tol is not None and (solver_tol <= parameters.solver_tol or iter_num == parameters.max_iter - 1):
+                solver_tol = None
             cprev = c
+            t_solve = time.time()
             # Solve conic problem
-            Ui = conic_solve(discontinuity_matrix_full, M, Us, c, parameters.d)
+            if solver_tol is None:
+                Ui = solver.solve(c)
+            else:
+                Ui = solver.solve(c, tol=solver_tol, max_iter=parameters.loose_solver_max_iter)
             c = Ui / np.sqrt(np.dot(Ui, M @ Ui))
             diff = np.max(np.abs(c - cprev))
             iter_num = iter_num + 1
+            num_solves = num_solves + 1
+            if telemetry is not None:
+                telemetry.append({'mode': num_previous + k, 'iteration': iter_num, 'solver_tol': solver_tol,
+                                  'solver_iterations': solver.num_iterations, 'seconds': time.time() - t_solve,
+                                  'diff': float(diff)})
+            if parameters.verbose:
+                print(f"Iteration {iter_num}: change {diff} after {time.time() - t_solve} seconds with "
+                      f"{'full accuracy' if solver_tol is None else f'solver tolerance {solver_tol}'}.")
+            converged = diff <= parameters.tol and solver_tol is None
+            if solver_tol is not None:
+                solver_tol = None if diff <= parameters.tol else parameters.solver_tol_factor * min(solver_tol, diff)
+        if not converged and iter_num < parameters.max_iter:
+            # Out of budget in the middle of this mode, which we drop
+            break
         # Now, identify pieces:
         tet_tet_distances = np.linalg.norm(
-            np.reshape(c, (-1, parameters.d), order='F')[tet_neighbors[:, 0], :] -
-            np.reshape(c, (-1, parameters.d), order='F')[tet_neighbors[:, 1], :], axis=1)
-        actual_neighbors = tet_neighbors[(tet_tet_distances < 0.1), :]
+            np.reshape(c, (-1, parameters.d), order='F')[operators.tet_neighbors[:, 0], :] -
+            np.reshape(c, (-1, parameters.d), order='F')[operators.tet_neighbors[:, 1], :], axis=1)
+        actual_neighbors = operators.tet_neighbors[(tet_tet_distances < 0.1), :]
 
         tet_adjacency_matrix = csr_matrix(
             (np.ones(actual_neighbors.shape[0]), (actual_neighbors[:, 0], actual_neighbors[:, 1])),
-            shape=(exploded_elements.shape[0], exploded_elements.shape[0]), dtype=int)
+            shape=(operators.exploded_elements.shape[0], operators.exploded_elements.shape[0]), dtype=int)
         n_components, labels = connected_components(tet_adjacency_matrix)
         labels_full[:, k] = labels
-        Us.append(c)
+        solver.add_orthogonality(c)
         UU[:, k] = c
+        num_computed = k + 1
+        t_mode = toc(silence=True)
+        ts.append(t_mode)
+        if checkpoint is not None:
+            checkpoint.save(c, labels, {'iterations': iter_num, 'diff': float(diff), 'seconds': t_mode,
+                                        'num_pieces': int(n_components)}, solver.checkpoint_state())
         if parameters.verbose:
-            t_mode = toc(silence=True)
-            ts.append(t_mode)
-            print(f"Computed unique mode number {k + 1} using {iter_num} iterations and {t_mode} seconds.")
+            print(f"Computed unique mode number {num_previous + k + 1} using {iter_num} iterations and {t_mode} seconds.")
             print(f"This mode breaks the shape into {n_components} pieces.")
-    if parameters.verbose:
+    solver.close()
+    if checkpoint is not None and num_computed == num_modes:
+        checkpoint.remove()
+    if parameters.verbose and ts:
         print(f"Average time per mode: {sum(ts) / len(ts)} seconds")
+    # (callers can tell from the number of modes, e.g., FractureModes.partial_modes)
+    if parameters.verbose and num_computed < num_modes:
+        print(f"Ran out of budget after {num_computed} of {num_modes} fracture modes ({num_solves} conic solves in "
+              f"{time.time() - start_time} seconds), returning those.")
+    return UU[:, :num_computed], labels_full[:, :num_computed]
+
+
+# @profile
+def compute_fracture_modes(vertices, elements, parameters, return_operators=False, telemetry=None):
+    # Takes as input an (unexploded) tetrahedral mesh and a number of modes, returns a matrix UU dim x #T by #parameters.num_modes with computed fracture modes. With return_operators, the FractureOperators used are returned too (see FractureModes.extend_modes)
+    # If parameters has a budget, it includes building the matrices, and UU may have fewer columns. telemetry is passed to solve_fracture_modes
+    start_time = time.time()
+    if parameters.verbose:
+        print("Starting fracture mode computation")
+        print(f"We will find {parameters.num_modes} unique fracture modes")
+        print(f"Our input (unexploded) mesh has {vertices.shape[0]} vertices and {elements.shape[0]} tetrahedra.")
+        tic()
+
+    # Steps 1 and 2: Laplacian eigenmodes and the exploded mesh's matrices
+    operators = FractureOperators(vertices, elements, parameters)
+    operators.initial_guesses(parameters.num_modes)
+
+    if parameters.verbose:
+        t_before_modes = toc(silence=True)
+        print(f"Building matrices before starting mode computation: {t_before_modes} seconds.")
 
-    modes = UU
+    # Step 3
+    modes, labels_full = solve_fracture_modes(operators, parameters, parameters.num_modes, start_time=start_time,
+                                             telemetry=telemetry)
 
     # Placeholder return
-    return exploded_vertices, exploded_elements, modes, labels_full, tet_to_vertex_matrix, tet_neighbors, M, unexploded_to_exploded_matrix
+    outputs = (operators.exploded_vertices, operators.exploded_elements, modes, labels_full,
+               operators.tet_to_vertex_matrix, operators.tet_neighbors, operators.M,
+               operators.unexploded_to_exploded_matrix)
+    if return_operators:
+        return outputs + (operators,)
+    return outputs
@@ -2,89 +2,179 @@
 import numpy as np
 import sys
 
-# Mosek for the conic solve
-import mosek
+# Mosek for the conic solve (optional, see admm_solve.py for a license-free alternative)
+try:
+    import mosek
+except ImportError:
+    mosek = None
 
+from .admm_solve import ADMMConicSolver
 
-def conic_solve(D, M, Us, c, d, verbose=False):
+
+# From Mosek template, apparently we have to add this
+def streamprinter(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+# Every solver in a process shares one MOSEK environment. Creating one checks out a license, which takes long enough to matter when a process computes the modes of many small meshes (see batch_driver.py)
+shared_env = None
+
+
+def mosek_env():
+    global shared_env
+    if mosek is None:
+        raise ImportError("The 'mosek' solver needs MOSEK to be installed. Use solver='admm' otherwise.")
+    if shared_env is None:
+        shared_env = mosek.Env()
+    return shared_env
+
+
+class MosekConicSolver:
     # This uses Mosek to solve the conic problem
     #           argmin     ||Du||_{2,1}
     #           s.t.       u' M Us = 0
     #           and        u' M c = 1
-    # 
-    # Unfortunately MOSEK's conic API is quite complicated so we actually have 
+    #
+    # Unfortunately MOSEK's conic API is quite complicated so we actually have
     # to write it as
     #          argmin    sum (z_e)                <--- linear
     #           s.t.     ze >= sqrt(sum(Yd^2))    <--- cone (linear if d=1)
     #           and      Y = Du                   <--- linear
     #           and      u' M Us = 0              <--- linear
     #           and      u' M c = 1               <--- linear
+    #
+    # Only the last two rows ever change while computing the modes of a mesh:
+    # the c row changes on every inner iteration and one Us row is added per
+    # finished mode. So, instead of building a new task for every solve, we
+    # build the Y = Du rows and the cones once and keep the task alive.
+    # (MOSEK's conic interior point optimizer cannot be warm-started, so the
+    # savings come from not rebuilding the model.)
+
+    def __init__(self, D, M, d, verbose=False):
+        self.env = mosek_env()
+        D = D.tocoo()
+        self.M = M
+        self.d = d
+        self.verbose = verbose
+        # Dimensions and degrees of freedom
+        self.p = D.shape[0] // d
+        self.n = D.shape[1]
+        p, n = self.p, self.n
+        self.ndofs = n + p * d + p
+
+        self.task = self.env.Task(0, 0)
+        if verbose:
+            self.task.set_Stream(mosek.streamtype.log, streamprinter)
+        task = self.task
+
+        # Variables are ordered as [u, (z_0, Y_0), ..., (z_p, Y_p)], where Y_e
+        # are the d entries of Du belonging to element e. This way, each cone
+        # is a contiguous block of variables and we can add them all at once.
+        task.appendvars(self.ndofs)
+        task.putvarboundsliceconst(0, self.ndofs, mosek.boundkey.fr, 0., 0.)
+        z_indeces = n + (d + 1) * np.arange(p)
+        # Row dim*p+e of D corresponds to the entry dim of element e
+        y_indeces = (z_indeces[None, :] + 1 + np.arange(d)[:, None]).flatten()
+
+        # Objective function
+        task.putclist(z_indeces.tolist(), [1.] * p)
+
+        # Set up equality constraint Y = Du
+        task.appendcons(p * d)
+        # D
+        task.putaijlist(D.row.tolist(), D.col.tolist(), D.data.tolist())
+        # -Y
+        task.putaijlist(list(range(p * d)), y_indeces.tolist(), [-1.] * (p * d))
+        task.putconboundsliceconst(0, p * d, mosek.boundkey.fx, 0., 0.)
+
+        # Set up norm-1 constraint wrt c (its coefficients are filled in by solve)
+        task.appendcons(1)
+        self.c_row = p * d
+        task.putconbound(self.c_row, mosek.boundkey.fx, 1., 1.)
+        self.num_orthogonality_rows = 0
+
+        # Set up cone ze >= sqrt(Yes^2)
+        task.appendconesseq([mosek.conetype.quad] * p, [0.] * p, [d + 1] * p, n)
+
+        task.putobjsense(mosek.objsense.minimize)
+
+        # Interior point accuracy and iteration cap (see solve), starting from MOSEK's defaults
+        self.default_accuracy = self.accuracy()
+        self.num_iterations = 0
+
+    def accuracy(self):
+        task = self.task
+        return (task.getdouparam(mosek.dparam.intpnt_co_tol_rel_gap),
+                task.getdouparam(mosek.dparam.intpnt_co_tol_pfeas),
+                task.getdouparam(mosek.dparam.intpnt_co_tol_dfeas),
+                task.getintparam(mosek.iparam.intpnt_max_iterations))
+
+    def set_accuracy(self, tol=None, max_iter=None):
+        # Sets the relative gap and feasibility tolerances of the interior point optimizer to tol and its iteration cap to max_iter, or back to the defaults if None
+        rel_gap, pfeas, dfeas, default_max_iter = self.default_accuracy
+        accuracy = (rel_gap, pfeas, dfeas) if tol is None else (tol, tol, tol)
+        accuracy = accuracy + (default_max_iter if max_iter is None else max_iter,)
+        if accuracy != self.accuracy():
+            self.task.putdouparam(mosek.dparam.intpnt_co_tol_rel_gap, accuracy[0])
+            self.task.putdouparam(mosek.dparam.intpnt_co_tol_pfeas, accuracy[1])
+            self.task.putdouparam(mosek.dparam.intpnt_co_tol_dfeas, accuracy[2])
+            self.task.putintparam(mosek.iparam.intpnt_max_iterations, accuracy[3])
+
+    def add_orthogonality(self, U):
+        # Set up orthogonality constraint wrt U (called once per finished mode)
+        UtM = self.M @ U
+        row = self.task.getnumcon()
+        self.task.appendcons(1)
+        self.task.putarow(row, list(range(self.n)), UtM)
+        self.task.putconbound(row, mosek.boundkey.fx, 0., 0.)
+        self.num_orthogonality_rows += 1
+
+    def solve(self, c, tol=None, max_iter=None):
+        # Update the norm-1 constraint wrt c and re-optimize. With tol or max_iter, this solve is only that accurate (see set_accuracy)
+        ctM = self.M @ c
+        self.task.putarow(self.c_row, list(range(self.n)), ctM)
+        self.set_accuracy(tol, max_iter)
+        self.task.optimize()
+        self.num_iterations = self.task.getintinf(mosek.iinfitem.intpnt_iter)
+        xx = [0.] * self.ndofs
+        self.task.getxx(mosek.soltype.itr, xx)
+        return np.asarray(xx)[0:self.n]  # Extract just the u part from the solution
+
+    def checkpoint_state(self):
+        # (MOSEK keeps nothing between solves besides the constraints, see ModeCheckpoint)
+        return {}
+
+    def restore_state(self, state):
+        pass
+
+    def close(self):
+        if self.task is not None:
+            # (the environment is shared, so it stays)
+            self.task.__exit__(None, None, None)
+            self.task = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def make_conic_solver(D, M, d, parameters):
+    # Builds the conic solver chosen in a FractureModesParameters object
+    if parameters.solver == 'mosek':
+        return MosekConicSolver(D, M, d)
+    elif parameters.solver == 'admm':
+        return ADMMConicSolver(D, M, d, tol=parameters.solver_tol, max_iter=parameters.solver_max_iter)
+    else:
+        raise ValueError(f"Unknown conic solver '{parameters.solver}'. Choose 'mosek' or 'admm'.")
 
 
-    # From Mosek template, apparently we have to add this
-    def streamprinter(text):
-        sys.stdout.write(text)
-        sys.stdout.flush()
-
-    # Mosek boilerplate
-    with mosek.Env() as env:
-        if verbose:
-            env.set_Stream(mosek.streamtype.log, streamprinter)
-        with env.Task(0,0) as task:
-            if verbose:
-                task.set_Stream(mosek.streamtype.log, streamprinter)
-
-            # Dimensions and degrees of freedom
-            p = D.shape[0] // d
-            n = D.shape[1]
-            ndofs = n+ p*d+p
-            task.appendvars(ndofs)
-            task.putvarboundlistconst([*range(ndofs)], mosek.boundkey.fr, 0., 0.)
-            task.appendcons(p*d+n+1+len(Us))
-
-            # Objective function
-            task.putclist([*range(   n+ p*d,    n+ p*d+p)],
-                    [1.] * (p))
-
-            
-
-            #Set up equality constraint Y = Du
-            nrows = 0
-            #D
-            task.putaijlist(nrows+D.row, D.col, D.data)
-            #-Y
-            task.putaijlist([*range(nrows, nrows+ p*d)],
-                [*range(   n,    n+ p*d)], [-1.]*( p*d))
-            task.putconboundlistconst([*range(nrows,nrows+ p*d)],
-                mosek.boundkey.fx, 0., 0.)
-            nrows +=  p*d
-
-
-
-            # Set up orthogonality constraint wrt Us
-            for U in Us:
-                UtM = M*U
-                task.putaijlist([nrows]*len(UtM), [*range(  0,    n)], UtM)
-                task.putconbound(nrows, mosek.boundkey.fx, 0., 0.)
-                nrows += 1
-            # Set up norm-1 constraint wrt c
-            ctM = M*c
-            task.putaijlist([nrows]*len(ctM), [*range(  0,    n)], ctM)
-            task.putconbound(nrows, mosek.boundkey.fx, 1., 1.)
-            nrows += 1
-
-
-            # Set up cone ze >= sqrt(Yes^2)
-            for e in range(p):
-                coneinds = [   n+ p*d+e]
-                for dim in range(d):
-                    coneinds.extend([   n+ p*dim+e])
-                task.appendcone(mosek.conetype.quad, 0., coneinds)
-
-            # Solve
-            task.putobjsense(mosek.objsense.minimize)
-            task.optimize()
-            xx = [0.] * ndofs
-            task.getxx(mosek.soltype.itr, xx)
-
-            return np.asarray(xx)[0:n] # Extract just the u part from the solution
\ No newline at end of file
+def conic_solve(D, M, Us, c, d, verbose=False):
+    # One-off version of MosekConicSolver.solve. When solving repeatedly on
+    # the same mesh, build a solver with make_conic_solver once instead.
+    with MosekConicSolver(D, M, d, verbose=verbose) as solver:
+        for U in Us:
+            solver.add_orthogonality(U)
+        return solver.solve(c)
@@ -6,12 +6,16 @@ $DATA_ROOT/
 ├──── $CATEGORY/
 │     |──── $MESH/
 |     |     |──── compressed_data.npz
-|     |     |──── compressed_mesh.obj
-|     │     |──── $FRACTURE/
-|     |     |     |──── compressed_fracture.npy
+|     |     |──── compressed_mesh.obj (or .ply)
+|     |     |──── fractures.bin
+|     |     |──── fractures.json
 •     •     •
 •     •     •
 ```
+where `fractures.bin` and `fractures.json` are the fracture archive written by
+    `generate_fractures` (see `fracture_archive.py`). Older data, with one
+    `$FRACTURE/compressed_fracture.npy` directory per fracture instead of an
+    archive, can also be decompressed.
 
 You can use `decompress_mesh()` to decompress all fractures of a single mesh,
     or use `decompress_category()` to decompress all fractures of all meshes in
@@ -19,23 +23,54 @@ You can use `decompress_mesh()` to decompress all fractures of a single mesh,
 
 The provided code under `__main__` can decompress the entire Breaking Bad
     dataset which consists of three subsets `everyday`, `artiface`, `other`.
+    Meshes are decompressed by `--num_workers` processes, and every category
+    keeps a manifest of the meshes it already decompressed, so that an
+    interrupted run picks up where it stopped (use `--restart` to start over).
 """
 
 import os
+import json
 import time
 import argparse
+from multiprocessing import Pool
 
 import numpy as np
 from tqdm import tqdm
 from scipy.sparse import load_npz
 import igl
 
+try:
+    from .fracture_archive import FractureArchive
+    from .segment_mesh import split_by_label, weld_mesh
+except ImportError:
+    # Run as a script
+    from fracture_archive import FractureArchive
+    from segment_mesh import split_by_label, weld_mesh
+
 ALL_CATEGORY = [
     'BeerBottle', 'Bowl', 'Cup', 'DrinkingUtensil', 'Mug', 'Plate', 'Spoon',
     'Teacup', 'ToyFigure', 'WineBottle', 'Bottle', 'Cookie', 'DrinkBottle',
     'Mirror', 'PillBottle', 'Ring', 'Statue', 'Teapot', 'Vase', 'WineGlass'
 ]
 ALL_SUBSET = ['everyday', 'artifact', 'other']
+MANIFEST_NAME = 'decompressed.jsonl'
+
+
+def read_fractures(mesh_dir_full_path):
+    """Yield the name and piece labels of every fracture of a mesh."""
+    if os.path.exists(os.path.join(mesh_dir_full_path, "fractures.json")):
+        archive = FractureArchive(mesh_dir_full_path)
+        for i in range(len(archive)):
+            yield f"fracture_{i}", archive[i]
+        return
+    # Older layout, with one directory per fracture
+    for frac_dir in os.listdir(mesh_dir_full_path):
+        frac_dir_full_path = os.path.join(mesh_dir_full_path, frac_dir)
+        if not os.path.isdir(frac_dir_full_path):
+            continue
+        frac_data_path = os.path.join(frac_dir_full_path,
+                                      "compressed_fracture.npy")
+        yield frac_dir, np.load(frac_data_path)
 
 
 def decompress_mesh(mesh_dir_full_path, save_dir):
@@ -48,37 +83,34 @@ def decompress_mesh(mesh_dir_full_path, save_dir):
     num_fracs = 0
     compressed_mesh_path = os.path.join(mesh_dir_full_path,
                                         "compressed_mesh.obj")
+    if not os.path.exists(compressed_mesh_path):
+        compressed_mesh_path = os.path.join(mesh_dir_full_path,
+                                            "compressed_mesh.ply")
     compressed_data_path = os.path.join(mesh_dir_full_path,
                                         "compressed_data.npz")
     fine_vertices, fine_triangles = igl.read_triangle_mesh(
         compressed_mesh_path)
     piece_to_fine_vertices_matrix = load_npz(compressed_data_path)
+    # Welding only depends on the mesh, so do it once for all fractures
+    welded_vertices, welded_triangles = weld_mesh(fine_vertices,
+                                                  fine_triangles)
     # Now, go over all fractures
-    for frac_dir in os.listdir(mesh_dir_full_path):
-        frac_dir_full_path = os.path.join(mesh_dir_full_path, frac_dir)
-        if not os.path.isdir(frac_dir_full_path):
-            continue
+    for frac_name, piece_labels_after_impact in read_fractures(
+            mesh_dir_full_path):
         # Make new directory for decompressed fracture
-        frac_save_path = os.path.join(save_dir, frac_dir)
+        frac_save_path = os.path.join(save_dir, frac_name)
         os.makedirs(frac_save_path, exist_ok=True)
-        # Load fracture data
-        frac_data_path = os.path.join(frac_dir_full_path,
-                                      "compressed_fracture.npy")
-        piece_labels_after_impact = np.load(frac_data_path)
         # Now actually construct the meshes to write
         fine_vertex_labels_after_impact = \
             piece_to_fine_vertices_matrix @ piece_labels_after_impact
         n_pieces_after_impact = int(np.max(piece_labels_after_impact) + 1)
-        for i in range(n_pieces_after_impact):
-            tri_labels = \
-                fine_vertex_labels_after_impact[fine_triangles[:, 0]]
-            if np.any(tri_labels == i):
-                vi, fi = igl.remove_unreferenced(
-                    fine_vertices, fine_triangles[tri_labels == i, :])[:2]
-            else:
+        tri_labels = fine_vertex_labels_after_impact[fine_triangles[:, 0]]
+        pieces = split_by_label(welded_vertices, welded_triangles,
+                                np.round(tri_labels).astype(int),
+                                n_pieces_after_impact)
+        for i, (ui, gi) in enumerate(pieces):
+            if gi.shape[0] == 0:
                 continue
-            ui, I, J, _ = igl.remove_duplicate_vertices(vi, fi, 1e-10)
-            gi = J[fi]
             # Now we write the mesh ui, gi
             write_file_name = os.path.join(frac_save_path, f"piece_{i}.ply")
             igl.write_triangle_mesh(write_file_name, ui, gi, force_ascii=False)
@@ -87,23 +119,99 @@ def decompress_mesh(mesh_dir_full_path, save_dir):
     return num_fracs
 
 
-def decompress_category(category_dir, save_dir):
-    """Decompress all shapes belonging to a category."""
+def mesh_signature(mesh_dir_full_path):
+    """Size and modification time of every file of a compressed mesh."""
+    # If any of them changes (e.g., more fractures were generated), the mesh
+    # needs to be decompressed again
+    signature = {}
+    for name in sorted(os.listdir(mesh_dir_full_path)):
+        stat = os.stat(os.path.join(mesh_dir_full_path, name))
+        signature[name] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def read_manifest(manifest_path):
+    """Read the meshes a previous run already decompressed."""
+    done = {}
+    if not os.path.exists(manifest_path):
+        return done
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line of a run that was killed while writing it
+                continue
+            done[entry['mesh']] = entry
+    return done
+
+
+def decompress_mesh_task(task):
+    """Decompress one mesh, in a worker process."""
+    mesh_dir, mesh_dir_full_path, mesh_save_dir = task
+    # (taken before decompressing, so that changes made meanwhile are noticed)
+    signature = mesh_signature(mesh_dir_full_path)
+    num_fracs = decompress_mesh(mesh_dir_full_path, mesh_save_dir)
+    return mesh_dir, signature, num_fracs
+
+
+def decompress_category(category_dir, save_dir, num_workers=1, resume=True):
+    """Decompress all shapes belonging to a category.
+
+    Meshes are decompressed in parallel by `num_workers` processes. Every
+    decompressed mesh is recorded in a manifest in `save_dir`, and with
+    `resume` meshes that are in it (and didn't change since) are skipped.
+    """
     if not os.path.isdir(category_dir):
         return
     print("Processing", category_dir)
-    num_fracs = 0
-    t0 = time.time()
-    for mesh_dir in tqdm(os.listdir(category_dir)):
+    os.makedirs(save_dir, exist_ok=True)
+    manifest_path = os.path.join(save_dir, MANIFEST_NAME)
+    done = read_manifest(manifest_path) if resume else {}
+    tasks = []
+    num_skipped = 0
+    for mesh_dir in sorted(os.listdir(category_dir)):
         mesh_dir_full_path = os.path.join(category_dir, mesh_dir)
+        if not os.path.isdir(mesh_dir_full_path):
+            continue
+        if mesh_dir in done and done[mesh_dir]['signature'] == \
+                mesh_signature(mesh_dir_full_path):
+            num_skipped += 1
+            continue
         mesh_save_dir = os.path.join(save_dir, mesh_dir)
-        num_fracs += decompress_mesh(mesh_dir_full_path, mesh_save_dir)
+        tasks.append((mesh_dir, mesh_dir_full_path, mesh_save_dir))
+    if num_skipped > 0:
+        print(f"Skipping {num_skipped} meshes that were already decompressed.")
+    num_fracs = 0
+    t0 = time.time()
+    with open(manifest_path, 'a' if resume else 'w') as manifest:
+        if manifest.tell() > 0:
+            # End the line a killed run may have left unfinished
+            manifest.write('\n')
+        if num_workers > 1 and len(tasks) > 1:
+            pool = Pool(min(num_workers, len(tasks)))
+            results = pool.imap_unordered(decompress_mesh_task, tasks)
+        else:
+            pool = None
+            results = map(decompress_mesh_task, tasks)
+        try:
+            for mesh_dir, signature, mesh_fracs in tqdm(results,
+                                                        total=len(tasks)):
+                # A mesh only goes into the manifest once it is complete
+                manifest.write(json.dumps({'mesh': mesh_dir,
+                                           'signature': signature,
+                                           'num_pieces': mesh_fracs}) + '\n')
+                manifest.flush()
+                num_fracs += mesh_fracs
+        finally:
+            if pool is not None:
+                pool.terminate()
 
     total_time = time.time() - t0
     print(f"Decompressed a total of {num_fracs} fracture pieces in {total_time} seconds.")
 
 
-def process_everyday(data_root, category):
+def process_everyday(data_root, category, num_workers=1, resume=True):
     if not os.path.isdir(os.path.join(data_root, 'everyday_compressed')):
         print('compressed everyday subset does not exist, skipping...')
         return
@@ -114,25 +222,25 @@ def process_everyday(data_root, category):
     for cat in category:
         cat_dir = os.path.join(data_root, 'everyday_compressed', cat)
         save_dir = os.path.join(data_root, 'everyday', cat)
-        decompress_category(cat_dir, save_dir)
+        decompress_category(cat_dir, save_dir, num_workers, resume)
 
 
-def process_artifact(data_root):
+def process_artifact(data_root, num_workers=1, resume=True):
     cat_dir = os.path.join(data_root, 'artifact_compressed')
     if not os.path.isdir(os.path.join(data_root, 'artifact_compressed')):
         print('compressed artifact subset does not exist, skipping...')
         return
     save_dir = os.path.join(data_root, 'artifact')
-    decompress_category(cat_dir, save_dir)
+    decompress_category(cat_dir, save_dir, num_workers, resume)
 
 
-def process_other(data_root):
+def process_other(data_root, num_workers=1, resume=True):
     cat_dir = os.path.join(data_root, 'other_compressed')
     if not os.path.isdir(os.path.join(data_root, 'other_compressed')):
         print('compressed other subset does not exist, skipping...')
         return
     save_dir = os.path.join(data_root, 'other')
-    decompress_category(cat_dir, save_dir)
+    decompress_category(cat_dir, save_dir, num_workers, resume)
 
 
 if __name__ == "__main__":
@@ -154,6 +262,11 @@ if __name__ == "__main__":
             'all',
         ],
         help='category in everyday subset')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes decompressing meshes')
+    parser.add_argument('--restart', action='store_true',
+                        help='decompress everything again, instead of '
+                        'skipping meshes that were already decompressed')
     args = parser.parse_args()
 
     if args.subset == 'all':
@@ -162,10 +275,12 @@ if __name__ == "__main__":
         subsets = [args.subset]
     for subset in subsets:
         if subset == 'everyday':
-            process_everyday(args.data_root, args.category)
+            process_everyday(args.data_root, args.category, args.num_workers,
+                             not args.restart)
         elif subset == 'artifact':
-            process_artifact(args.data_root)
+            process_artifact(args.data_root, args.num_workers,
+                             not args.restart)
         elif subset == 'other':
-            process_other(args.data_root)
+            process_other(args.data_root, args.num_workers, not args.restart)
         else:
             raise NotImplementedError('Unknown subset:', subset)
\ No newline at end of file
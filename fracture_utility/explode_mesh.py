@@ -45,9 +45,6 @@ def explode_mesh(vertices,elements,num_quad=3):
     tet_neighbors = tet_neighbors[tet_neighbors_j[:,0]>-1,:]
     # that's it, keep going building D
 
-    I = np.zeros(6*num_quad*4*exploded_elements.shape[0])
-    J = np.zeros(6*num_quad*4*exploded_elements.shape[0])
-    vals = np.zeros(6*num_quad*4*exploded_elements.shape[0])
     num_tets = elements.shape[0]
     # the matrix row ordering will be 
     # I = 4*num_tets*qi + 4*i + nn
@@ -62,60 +59,37 @@ def explode_mesh(vertices,elements,num_quad=3):
     areas = igl.doublearea(vertices,all_faces)
 
     #areas[vertices[all_faces[:,0],2]>0] = 100*areas[vertices[all_faces[:,0],2]>0]
-    # This for loop is obviously suboptimal, should be vectorized. However,
-    # it is far from the bottleneck (dominated by eigsh call), so it is not
-    # very important to do it.
-    for i in range(elements.shape[0]):
-        tet_1 = i
-        for nn in range(4):
-            tet_2 = TT[i,nn]
-            if tet_2>-1 and tet_1>tet_2: # internal faces only, and only once
-                face_area = areas[nn*elements.shape[0] + i]
-                # tet_1 and tet_2 are neighbors. The face nn of tet_1 neighbors the face TTi[i,j] of tet_2
-                # So the six exploded vertices we are dealing with are 4*tet_1 + tet_face_ordering[nn,:] and 4*tet_2 + tet_face_ordering[TTi[i,nn],:]
-                # What we want to know is which of these six vertices are duplicates
-                # In the unexploded mesh, these vertices are (in the same order) elements[tet_1,tet_face_ordering[nn,:]] and elements[tet_2,tet_face_ordering[TTi[i,nn],:]]
-                unexploded_indeces_tet_1 = elements[tet_1,tet_face_ordering[nn,:]]
-                unexploded_indeces_tet_2 = elements[tet_2,tet_face_ordering[TTi[i,nn],:]]
-                exploded_indeces_tet_1 = 4*tet_1 + tet_face_ordering[nn,:]
-                exploded_indeces_tet_2 = 4*tet_2 + tet_face_ordering[TTi[i,nn],:]
+    # Internal faces only, and only once: face nn of tet_1 neighbors face TTi[tet_1,nn] of tet_2 = TT[tet_1,nn]
+    tet_1, nn = np.nonzero((TT>-1) & (np.arange(num_tets)[:,None]>TT))
+    tet_2 = TT[tet_1,nn]
+    face_area = areas[nn*num_tets + tet_1]
+    # So the six exploded vertices we are dealing with are 4*tet_1 + tet_face_ordering[nn,:] and 4*tet_2 + tet_face_ordering[TTi[tet_1,nn],:]
+    # What we want to know is which of these six vertices are duplicates
+    # In the unexploded mesh, these vertices are (in the same order) elements[tet_1,tet_face_ordering[nn,:]] and elements[tet_2,tet_face_ordering[TTi[tet_1,nn],:]]
+    local_indeces_tet_1 = tet_face_ordering[nn,:]
+    local_indeces_tet_2 = tet_face_ordering[TTi[tet_1,nn],:]
+    unexploded_indeces_tet_1 = np.take_along_axis(elements[tet_1,:],local_indeces_tet_1,axis=1)
+    unexploded_indeces_tet_2 = np.take_along_axis(elements[tet_2,:],local_indeces_tet_2,axis=1)
+    # Then all we need is a mapping giving the equality relationship between unexploded_indeces_tet_1 and 2. We can do this by sorting them
+    argsort_1 = np.argsort(unexploded_indeces_tet_1,axis=1)
+    argsort_2 = np.argsort(unexploded_indeces_tet_2,axis=1)
+    exploded_indeces_tet_1 = 4*tet_1[:,None] + np.take_along_axis(local_indeces_tet_1,argsort_1,axis=1)
+    exploded_indeces_tet_2 = 4*tet_2[:,None] + np.take_along_axis(local_indeces_tet_2,argsort_2,axis=1)
 
-                # Then all we need is a mapping giving the equality relationship between unexploded_indeces_tet_1 and 2. We can do this by sorting them
-                argsort_1 = np.argsort(unexploded_indeces_tet_1)
-                argsort_2 = np.argsort(unexploded_indeces_tet_2)
-
-                # There should be 3*6 new non-zero entries in the matrix from this internal face, in 3 different rows
-                for qi in range(num_quad):
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 0] = 4*num_tets*qi + 4*i + nn
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 1] = 4*num_tets*qi + 4*i + nn
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 2] = 4*num_tets*qi + 4*i + nn
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 3] = 4*num_tets*qi + 4*i + nn
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 4] = 4*num_tets*qi + 4*i + nn
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 5] = 4*num_tets*qi + 4*i + nn
-                    J[ 6*(qi + num_quad*nn + num_quad*4*i) + 0] = exploded_indeces_tet_1[argsort_1[0]]
-                    J[ 6*(qi + num_quad*nn + num_quad*4*i) + 1] = exploded_indeces_tet_2[argsort_2[0]]
-                    J[ 6*(qi + num_quad*nn + num_quad*4*i) + 2] = exploded_indeces_tet_1[argsort_1[1]]
-                    J[ 6*(qi + num_quad*nn + num_quad*4*i) + 3] = exploded_indeces_tet_2[argsort_2[1]]
-                    J[ 6*(qi + num_quad*nn + num_quad*4*i) + 4] = exploded_indeces_tet_1[argsort_1[2]]
-                    J[ 6*(qi + num_quad*nn + num_quad*4*i) + 5] = exploded_indeces_tet_2[argsort_2[2]]
-                    vals[ 6*(qi + num_quad*nn + num_quad*4*i) + 0] = quad_weights[qi,0]*face_area
-                    vals[ 6*(qi + num_quad*nn + num_quad*4*i) + 1] = -quad_weights[qi,0]*face_area
-                    vals[ 6*(qi + num_quad*nn + num_quad*4*i) + 2] = quad_weights[qi,1]*face_area
-                    vals[ 6*(qi + num_quad*nn + num_quad*4*i) + 3] = -quad_weights[qi,1]*face_area
-                    vals[ 6*(qi + num_quad*nn + num_quad*4*i) + 4] = quad_weights[qi,2]*face_area
-                    vals[ 6*(qi + num_quad*nn + num_quad*4*i) + 5] = -quad_weights[qi,2]*face_area
-            else:
-                for qi in range(num_quad):
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 0] = -1
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 1] = -1
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 2] = -1
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 3] = -1
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 4] = -1
-                    I[ 6*(qi + num_quad*nn + num_quad*4*i) + 5] = -1
-
-    J = J[I>-1]
-    vals = vals[I>-1]
-    I = I[I>-1]
+    # There are 6 new non-zero entries in the matrix per internal face and quadrature point, interleaved as
+    # [tet_1 vertex 0, tet_2 vertex 0, tet_1 vertex 1, tet_2 vertex 1, tet_1 vertex 2, tet_2 vertex 2]
+    J_face = np.reshape(np.stack((exploded_indeces_tet_1,exploded_indeces_tet_2),axis=2),(-1,6))
+    signs = np.array([1.0,-1.0,1.0,-1.0,1.0,-1.0])
+    Is = []
+    Js = []
+    vals = []
+    for qi in range(num_quad):
+        Is.append(np.repeat(4*num_tets*qi + 4*tet_1 + nn,6))
+        Js.append(J_face.flatten())
+        vals.append((face_area[:,None]*(np.repeat(quad_weights[qi,:],2)*signs)[None,:]).flatten())
+    I = np.concatenate(Is)
+    J = np.concatenate(Js)
+    vals = np.concatenate(vals)
 
     discontinuity_matrix = csr_matrix((vals,(I,J)),shape=(num_quad*4*exploded_elements.shape[0],exploded_vertices.shape[0]))
 
@@ -0,0 +1,349 @@
+# Include existing libraries
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import igl
+import numpy as np
+from gpytoolbox.copyleft import mesh_boolean
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
+
+from .stage_cache import StageCache, hash_arrays, stage_key
+
+
+def fine_mesh_components(v_fine, f_fine):
+    # Per-triangle connected component labels of the fine mesh, and the bounding box of each component
+    edges = np.concatenate((f_fine[:, [0, 1]], f_fine[:, [1, 2]], f_fine[:, [2, 0]]))
+    vertex_graph = csr_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])),
+                              shape=(v_fine.shape[0], v_fine.shape[0]))
+    num_components, vertex_labels = connected_components(vertex_graph, directed=False)
+    face_labels = vertex_labels[f_fine[:, 0]]
+    component_min = np.full((num_components, 3), np.inf)
+    component_max = np.full((num_components, 3), -np.inf)
+    for dd in range(3):
+        np.minimum.at(component_min[:, dd], face_labels, np.min(v_fine[f_fine, dd], axis=1))
+        np.maximum.at(component_max[:, dd], face_labels, np.max(v_fine[f_fine, dd], axis=1))
+    return face_labels, component_min, component_max
+
+
+def clip_fine_mesh(v_fine, f_fine, face_labels, component_min, component_max, vi):
+    # Keep only the connected components of the fine mesh whose bounding box overlaps the piece's. We can't cut components (intersecting with an open mesh isn't the same as intersecting with a closed one), but a component that is entirely outside the piece's bounding box can't intersect it.
+    overlap = np.all(component_min <= np.max(vi, axis=0), axis=1) & np.all(component_max >= np.min(vi, axis=0), axis=1)
+    if np.all(overlap):
+        return v_fine, f_fine
+    return igl.remove_unreferenced(v_fine, f_fine[overlap[face_labels], :])[:2]
+
+
+def fine_piece_key(fine_hash, vi, fi):
+    # Cache key of the intersection of the fine mesh (with content hash fine_hash) with one piece
+    return stage_key('fine_piece', fine_hash, hash_arrays(vi, fi))
+
+
+def intersect_piece(task):
+    # Intersects one (clipped) fine mesh with one coarse piece. This is what the worker processes run
+    v_fine, f_fine, vi, fi = task
+    if f_fine.shape[0] == 0 or fi.shape[0] == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=int)
+    # This should be replaced by a call to igl.mesh_booleans once the official binding is published
+    return mesh_boolean(v_fine, f_fine.astype(np.int32), vi, fi.astype(np.int32), boolean_type='intersection')
+
+
+def difference_piece(task):
+    # Subtracts the interior shell from one piece (only if their bounding boxes overlap, otherwise there is nothing to subtract)
+    vi, fi, v_interior, f_interior = task
+    if fi.shape[0] == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=int)
+    if np.any(np.max(vi, axis=0) < np.min(v_interior, axis=0)) or np.any(np.min(vi, axis=0) > np.max(v_interior, axis=0)):
+        return vi, fi
+    return mesh_boolean(vi, fi.astype(np.int32), v_interior, f_interior.astype(np.int32), boolean_type='difference')
+
+
+def run_piece_tasks(function, tasks, num_workers, desc):
+    # Maps function over tasks, on a pool of num_workers processes if there is more than one
+    if num_workers > 1 and len(tasks) > 1:
+        with Pool(min(num_workers, len(tasks))) as pool:
+            return list(tqdm(pool.imap(function, tasks), total=len(tasks), desc=desc))
+    return [function(task) for task in tqdm(tasks, desc=desc)]
+
+
+def compute_fine_pieces(v_fine, f_fine, pieces, num_workers=1, cache_dir=None, cache_size=20 * 2 ** 30):
+    """Intersect a fine triangle mesh with each of a list of coarse pieces.
+
+    The intersections are independent, so they run on a pool of `num_workers` processes. Each piece is only intersected with the connected components of the fine mesh that overlap its bounding box. If `cache_dir` is given, every intersection is stored there, keyed by the contents of the fine mesh and the piece, so that they are not recomputed for pieces that didn't change.
+
+    Parameters
+    ----------
+    v_fine : (n,3) numpy double array
+        Fine mesh vertex positions
+    f_fine : (m,3) numpy int array
+        Fine mesh triangle indeces
+    pieces : list of tuples
+        The (vertices, triangles) of each (closed) coarse piece
+    num_workers : int (optional, default 1)
+        Number of worker processes
+    cache_dir : str (optional, default None)
+        Directory to cache the intersections in (see `StageCache`)
+    cache_size : int (optional, default 20GB)
+        Maximum size of the cache in bytes
+
+    Returns
+    -------
+    fine_pieces : list of tuples
+        The (vertices, triangles) of the intersection of the fine mesh with each piece
+    """
+    fine_pieces = [None] * len(pieces)
+    keys = [None] * len(pieces)
+    cache = None
+    if cache_dir is not None:
+        cache = StageCache(cache_dir, max_size=cache_size)
+        fine_hash = hash_arrays(v_fine, f_fine)
+        for i, (vi, fi) in enumerate(pieces):
+            keys[i] = fine_piece_key(fine_hash, vi, fi)
+            cached = cache.get(keys[i])
+            if cached is not None:
+                fine_pieces[i] = (cached['vertices'], cached['triangles'])
+    missing = [i for i in range(len(pieces)) if fine_pieces[i] is None]
+
+    face_labels, component_min, component_max = fine_mesh_components(v_fine, f_fine)
+    tasks = []
+    for i in missing:
+        vi, fi = pieces[i]
+        if fi.shape[0] == 0:
+            tasks.append((v_fine[:0, :], f_fine[:0, :], vi, fi))
+            continue
+        tasks.append(clip_fine_mesh(v_fine, f_fine, face_labels, component_min, component_max, vi) + (vi, fi))
+    results = run_piece_tasks(intersect_piece, tasks, num_workers, "Precomputing fine mesh pieces")
+
+    for i, (vi_fine, fi_fine) in zip(missing, results):
+        fine_pieces[i] = (vi_fine, fi_fine)
+        if cache is not None:
+            cache.put(keys[i], {'vertices': vi_fine, 'triangles': fi_fine}, evict=False)
+    if cache is not None and missing:
+        cache.evict()
+    return fine_pieces
+
+
+def compute_hollow_pieces(pieces, v_interior, f_interior, num_workers=1, cache_dir=None, cache_size=20 * 2 ** 30):
+    """Subtract an interior shell from each of a list of pieces.
+
+    This is how hollow objects are fractured: every fragment is a union of pieces, so subtracting the interior once per piece here means fragments never need a boolean of their own. Like `compute_fine_pieces`, the differences run on a pool of `num_workers` processes and are cached in `cache_dir`, if given.
+
+    Parameters
+    ----------
+    pieces : list of tuples
+        The (vertices, triangles) of each (closed) piece
+    v_interior : (n,3) numpy double array
+        Interior shell vertex positions
+    f_interior : (m,3) numpy int array
+        Interior shell triangle indeces
+    num_workers : int (optional, default 1)
+        Number of worker processes
+    cache_dir : str (optional, default None)
+        Directory to cache the differences in (see `StageCache`)
+    cache_size : int (optional, default 20GB)
+        Maximum size of the cache in bytes
+
+    Returns
+    -------
+    hollow_pieces : list of tuples
+        The (vertices, triangles) of each piece minus the interior
+    """
+    hollow_pieces = [None] * len(pieces)
+    keys = [None] * len(pieces)
+    cache = None
+    if cache_dir is not None:
+        cache = StageCache(cache_dir, max_size=cache_size)
+        interior_hash = hash_arrays(v_interior, f_interior)
+        for i, (vi, fi) in enumerate(pieces):
+            keys[i] = stage_key('hollow_piece', interior_hash, hash_arrays(vi, fi))
+            cached = cache.get(keys[i])
+            if cached is not None:
+                hollow_pieces[i] = (cached['vertices'], cached['triangles'])
+    missing = [i for i in range(len(pieces)) if hollow_pieces[i] is None]
+
+    tasks = [tuple(pieces[i]) + (v_interior, f_interior) for i in missing]
+    results = run_piece_tasks(difference_piece, tasks, num_workers, "Subtracting interior from pieces")
+
+    for i, (vi_hollow, fi_hollow) in zip(missing, results):
+        hollow_pieces[i] = (vi_hollow, fi_hollow)
+        if cache is not None:
+            cache.put(keys[i], {'vertices': vi_hollow, 'triangles': fi_hollow}, evict=False)
+    if cache is not None and missing:
+        cache.evict()
+    return hollow_pieces
+
+
+def split_fine_pieces(parent_fine_pieces, pieces, parents, num_workers=1):
+    """Intersect pieces with the fine mesh of the larger pieces they were split from.
+
+    When new fracture modes split a piece into smaller ones (see `FractureModes.extend_modes`), intersecting the fine mesh with each of them is the same as intersecting the fine mesh of the piece they come from, which is much smaller. This works the same for pieces with the interior subtracted (see `compute_hollow_pieces`). Like `compute_fine_pieces`, the intersections run on a pool of `num_workers` processes.
+
+    Parameters
+    ----------
+    parent_fine_pieces : list of tuples
+        The (vertices, triangles) of the fine mesh of each piece before splitting
+    pieces : list of tuples
+        The (vertices, triangles) of each (closed) coarse piece after splitting
+    parents : (len(pieces),) numpy int array
+        Index of the piece each piece was split from
+    num_workers : int (optional, default 1)
+        Number of worker processes
+
+    Returns
+    -------
+    fine_pieces : list of tuples
+        The (vertices, triangles) of the intersection of the fine mesh with each piece
+    """
+    components = {}
+    tasks = []
+    for (vi, fi), j in zip(pieces, parents):
+        v_parent, f_parent = parent_fine_pieces[j]
+        if fi.shape[0] == 0 or f_parent.shape[0] == 0:
+            tasks.append((v_parent[:0, :], f_parent[:0, :], vi, fi))
+            continue
+        if j not in components:
+            components[j] = fine_mesh_components(v_parent, f_parent)
+        tasks.append(clip_fine_mesh(v_parent, f_parent, *components[j], vi) + (vi, fi))
+    return run_piece_tasks(intersect_piece, tasks, num_workers, "Splitting fine mesh pieces")
+
+
+class FinePieceCache:
+    """On-demand version of `compute_fine_pieces`.
+
+    Instead of intersecting the fine mesh with every piece up front, each intersection is computed the first time it is asked for (`cache[i]`) and kept in memory, up to `max_memory` bytes, dropping the least recently used pieces beyond that. If `cache_dir` is given, intersections are also stored on disk (sharing entries with `compute_fine_pieces`), so dropped pieces and later sessions don't need to recompute them. `prefetch` computes pieces in a background thread, so that they are usually ready by the time they are needed: it goes through them (most likely first) only until `max_memory` is full, and pieces it computed are the first to be dropped until they are asked for. It is safe to ask for pieces from several threads.
+
+    Parameters
+    ----------
+    v_fine : (n,3) numpy double array
+        Fine mesh vertex positions
+    f_fine : (m,3) numpy int array
+        Fine mesh triangle indeces
+    pieces : list of tuples
+        The (vertices, triangles) of each (closed) coarse piece
+    max_memory : int (optional, default 1GB)
+        Maximum size in bytes of the pieces kept in memory
+    cache_dir : str (optional, default None)
+        Directory to also cache the intersections in (see `StageCache`)
+    cache_size : int (optional, default 20GB)
+        Maximum size of the disk cache in bytes
+    """
+
+    def __init__(self, v_fine, f_fine, pieces, max_memory=2 ** 30, cache_dir=None, cache_size=20 * 2 ** 30):
+        self.v_fine = v_fine
+        self.f_fine = f_fine
+        self.pieces = pieces
+        self.max_memory = max_memory
+        self.face_labels, self.component_min, self.component_max = fine_mesh_components(v_fine, f_fine)
+        self.disk_cache = None
+        if cache_dir is not None:
+            self.disk_cache = StageCache(cache_dir, max_size=cache_size)
+            self.fine_hash = hash_arrays(v_fine, f_fine)
+        # Pieces in memory, from least to most recently used
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        # Pieces being computed right now, so that two threads never compute the same one
+        self.in_progress = {}
+        self.lock = threading.Lock()
+        self.prefetch_thread = None
+        self.stop_prefetch = threading.Event()
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+    def get(self, i, prefetching=False):
+        # With prefetching=True, getting the piece doesn't count as using it (see remember)
+        while True:
+            with self.lock:
+                if i in self.memory:
+                    if not prefetching:
+                        self.memory.move_to_end(i)
+                    return self.memory[i]
+                event = self.in_progress.get(i)
+                if event is None:
+                    event = threading.Event()
+                    self.in_progress[i] = event
+                    break
+            # Someone else is computing it, wait for them
+            event.wait()
+        try:
+            fine_piece = self.build(i)
+            with self.lock:
+                self.remember(i, fine_piece, used=not prefetching)
+        finally:
+            with self.lock:
+                del self.in_progress[i]
+            event.set()
+        return fine_piece
+
+    def build(self, i):
+        vi, fi = self.pieces[i]
+        key = None
+        if self.disk_cache is not None:
+            key = fine_piece_key(self.fine_hash, vi, fi)
+            cached = self.disk_cache.get(key)
+            if cached is not None:
+                return cached['vertices'], cached['triangles']
+        if fi.shape[0] == 0:
+            fine_piece = intersect_piece((self.v_fine[:0, :], self.f_fine[:0, :], vi, fi))
+        else:
+            fine_piece = intersect_piece(clip_fine_mesh(self.v_fine, self.f_fine, self.face_labels, self.component_min,
+                                                        self.component_max, vi) + (vi, fi))
+        if key is not None:
+            self.disk_cache.put(key, {'vertices': fine_piece[0], 'triangles': fine_piece[1]})
+        return fine_piece
+
+    def remember(self, i, fine_piece, used=True):
+        # Add to the in-memory LRU (always keeping at least the newest piece). A piece nobody used yet goes behind all the others, so that it never pushes out one that was asked for
+        self.memory[i] = fine_piece
+        if not used:
+            self.memory.move_to_end(i, last=False)
+        self.memory_size += fine_piece[0].nbytes + fine_piece[1].nbytes
+        while self.memory_size > self.max_memory and len(self.memory) > 1:
+            _, (vi_fine, fi_fine) = self.memory.popitem(last=False)
+            self.memory_size -= vi_fine.nbytes + fi_fine.nbytes
+
+    def with_pieces(self, pieces, previous):
+        # A cache of the same fine mesh for a new list of pieces, where previous[i] is the index of the piece of this cache that pieces[i] is the same as (or -1 if none is). Those are not computed again if we have them in memory (and everything else is shared with this cache's disk cache)
+        self.close()
+        cache = FinePieceCache(self.v_fine, self.f_fine, pieces, max_memory=self.max_memory)
+        cache.disk_cache = self.disk_cache
+        if self.disk_cache is not None:
+            cache.fine_hash = self.fine_hash
+        with self.lock:
+            for i, j in enumerate(previous):
+                if j >= 0 and j in self.memory:
+                    cache.remember(i, self.memory[j])
+        return cache
+
+    def get_all(self):
+        return [self[i] for i in range(len(self))]
+
+    def prefetch(self, order=None):
+        # Computes pieces in the given order (most likely to be needed first) in a background thread, until memory is full: beyond that, a piece would only be dropped again (or push out others, see remember)
+        if order is None:
+            order = range(len(self))
+        self.close()
+        self.stop_prefetch.clear()
+
+        def run():
+            for i in order:
+                with self.lock:
+                    full = self.memory_size >= self.max_memory
+                if self.stop_prefetch.is_set() or full:
+                    return
+                self.get(int(i), prefetching=True)
+
+        self.prefetch_thread = threading.Thread(target=run, daemon=True)
+        self.prefetch_thread.start()
+
+    def close(self):
+        # Stops prefetching (after the piece currently being computed)
+        if self.prefetch_thread is not None:
+            self.stop_prefetch.set()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
@@ -0,0 +1,163 @@
+# Include existing libraries
+import json
+import os
+import threading
+
+import numpy as np
+
+# File locks, so that an archive only has one writer at a time (not available on Windows, see FractureArchive)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def label_dtype(num_pieces):
+    # Smallest unsigned integer type that can hold every label of a fracture into at most num_pieces pieces
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if num_pieces <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+class FractureArchive:
+    """Appendable, memory-mappable archive of the fractures of one mesh.
+
+    Every fracture is given by the label of each precomputed piece (e.g., `piece_labels_after_impact`). An archive named `name` in `directory` is two files: `name.bin`, with the labels of every fracture one after the other (so it is a fractures by pieces matrix of the smallest integer type that fits them, see `label_dtype`), and `name.json`, a small index with its shape and type. This replaces one file per fracture. Fractures are appended with `append` and only become part of the archive when the index is written by `flush` or `close`, so an archive that was being written when a job died is still valid (it loses whatever wasn't flushed). Reading is random access, `archive[i]` are the labels of fracture i, memory-mapped from disk.
+
+    An archive has a single writer at a time: opening it for writing ('a' or 'w') takes an exclusive lock on `name.lock`, which is held until `close`, so a second writer (e.g., another `generate_fractures` run on the same output directory) waits until the first one is done. Without the lock, each writer would only keep its own fractures. Readers don't lock, and see the fractures up to the last `flush`. Locking needs `fcntl`, so on Windows it is up to the caller to never open two writers.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the archive lives
+    name : str (optional, default 'fractures')
+        Name of the archive
+    num_pieces : int (optional, default None)
+        Number of precomputed pieces. Needed to create an archive, otherwise it must match the archive's
+    partition : str (optional, default None)
+        Identifies the pieces the labels refer to (e.g., `FractureModes.partition_hash`). When appending, it must match the archive's (unless the archive has no fractures yet), since fractures of other pieces with the same number of pieces would be read wrong
+    mode : str (optional, default 'r')
+        'r' to read an existing archive, 'a' to append to an archive (creating it if needed) and 'w' to overwrite it
+    """
+
+    format_version = 1
+
+    def __init__(self, directory, name='fractures', num_pieces=None, mode='r', partition=None):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError(f"Unknown mode '{mode}', use 'r', 'a' or 'w'")
+        self.data_path = os.path.join(directory, f"{name}.bin")
+        self.index_path = os.path.join(directory, f"{name}.json")
+        self.mode = mode
+        self.lock_file = None
+        if mode != 'r':
+            os.makedirs(directory, exist_ok=True)
+            self.lock_file = open(os.path.join(directory, f"{name}.lock"), 'a')
+            if fcntl is not None:
+                # (before reading the index, which the previous writer may still change)
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            self.open_archive(num_pieces, partition)
+        except BaseException:
+            self.unlock()
+            raise
+
+    def open_archive(self, num_pieces, partition):
+        mode = self.mode
+        if mode != 'w' and os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index['format_version'] != self.format_version:
+                raise ValueError(f"{self.index_path} has format version {index['format_version']}, "
+                                 f"but this code reads version {self.format_version}")
+            if num_pieces is not None and num_pieces != index['num_pieces']:
+                raise ValueError(f"{self.index_path} has {index['num_pieces']} pieces, not {num_pieces}")
+            self.num_pieces = index['num_pieces']
+            self.dtype = np.dtype(index['dtype'])
+            self.num_fractures = index['num_fractures']
+            self.partition = index.get('partition')
+            if mode == 'a' and partition is not None and partition != self.partition:
+                if self.num_fractures > 0:
+                    raise ValueError(f"{self.index_path} has fractures of other pieces than these (from a run with "
+                                     f"other modes?), so they can't be in the same archive")
+                self.partition = partition
+        elif mode == 'r':
+            raise FileNotFoundError(f"No fracture archive at {self.index_path}")
+        else:
+            if num_pieces is None:
+                raise ValueError("num_pieces is needed to create a fracture archive")
+            self.num_pieces = num_pieces
+            self.dtype = label_dtype(num_pieces)
+            self.num_fractures = 0
+            self.partition = partition
+        # Fractures appended so far (num_fractures only counts those in the index)
+        self.num_appended = self.num_fractures
+        self.data_file = None
+        self.mapped = None
+        self.lock = threading.Lock()
+        if mode != 'r':
+            self.data_file = open(self.data_path, 'ab')
+            # Drop anything appended after the last flush (e.g., if we crashed)
+            self.data_file.truncate(self.num_fractures * self.num_pieces * self.dtype.itemsize)
+            self.write_index()
+
+    def write_index(self):
+        # Written to a temporary file and then renamed, so that readers never see half an index
+        index = {'format_version': self.format_version, 'num_pieces': self.num_pieces, 'dtype': self.dtype.str,
+                 'num_fractures': self.num_fractures, 'partition': self.partition}
+        temp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+    def append(self, piece_labels):
+        # Appends one fracture (num_pieces labels) or several (a num_pieces by num_fractures matrix, like the labels returned by impact_projection_batch). It is safe to append from several threads
+        piece_labels = np.reshape(piece_labels, (self.num_pieces, -1))
+        if piece_labels.size and (np.min(piece_labels) < 0 or np.max(piece_labels) >= self.num_pieces):
+            raise ValueError(f"Fracture labels must be between 0 and {self.num_pieces - 1}")
+        with self.lock:
+            self.data_file.write(np.ascontiguousarray(piece_labels.T, dtype=self.dtype).tobytes())
+            self.num_appended += piece_labels.shape[1]
+
+    def flush(self):
+        with self.lock:
+            self.data_file.flush()
+            os.fsync(self.data_file.fileno())
+            self.num_fractures = self.num_appended
+            self.write_index()
+
+    def close(self):
+        if self.data_file is not None:
+            self.flush()
+            self.data_file.close()
+            self.data_file = None
+        self.unlock()
+
+    def unlock(self):
+        # Lets the next writer in (closing the file releases the lock)
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def labels(self):
+        # All the (flushed) fractures, as a memory-mapped num_fractures by num_pieces matrix
+        if self.mapped is None or self.mapped.shape[0] != self.num_fractures:
+            if self.num_fractures == 0:
+                self.mapped = np.zeros((0, self.num_pieces), dtype=self.dtype)
+            else:
+                self.mapped = np.memmap(self.data_path, dtype=self.dtype, mode='r',
+                                        shape=(self.num_fractures, self.num_pieces))
+        return self.mapped
+
+    def __len__(self):
+        return self.num_fractures
+
+    def __getitem__(self, i):
+        return np.asarray(self.labels()[i], dtype=int)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
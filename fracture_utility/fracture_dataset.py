@@ -0,0 +1,123 @@
+# Include existing libraries
+import os
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+
+import igl
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz
+
+from .fracture_archive import FractureArchive
+from .segment_mesh import split_by_label, weld_mesh
+
+
+class FractureDataset:
+    """Fractures of compressed meshes, as vertex and triangle arrays, without decompressing them to disk.
+
+    `root` is either one compressed mesh directory (with `compressed_mesh.obj` or `.ply`, `compressed_data.npz` and a fracture archive or one `compressed_fracture.npy` directory per fracture, see `decompress.py`) or any directory containing them, e.g. a whole compressed subset. `dataset[i]` is the list of fragments of the i-th fracture, each a (vertices, triangles) pair, exactly as `decompress.py` would write them. The welded fine mesh of the last `cache_size` meshes used is kept in memory, so reading fractures of the same mesh one after the other only loads it once. `iterate` can read fractures ahead of time in worker processes.
+
+    Parameters
+    ----------
+    root : str
+        Compressed mesh directory, or directory containing them
+    cache_size : int (optional, default 8)
+        Number of meshes kept in memory
+    """
+
+    def __init__(self, root, cache_size=8):
+        self.root = root
+        self.cache_size = cache_size
+        self.mesh_dirs = []
+        for directory, _, files in os.walk(root):
+            if "compressed_data.npz" in files:
+                self.mesh_dirs.append(directory)
+        self.mesh_dirs.sort()
+        # Every fracture is a mesh index and either its index in the mesh's archive or the path to its labels
+        self.fractures = []
+        for mesh_index, mesh_dir in enumerate(self.mesh_dirs):
+            if os.path.exists(os.path.join(mesh_dir, "fractures.json")):
+                self.fractures.extend((mesh_index, i) for i in range(len(FractureArchive(mesh_dir))))
+                continue
+            for frac_dir in sorted(os.listdir(mesh_dir)):
+                frac_data_path = os.path.join(mesh_dir, frac_dir, "compressed_fracture.npy")
+                if os.path.exists(frac_data_path):
+                    self.fractures.append((mesh_index, frac_data_path))
+        self.cache = OrderedDict()
+
+    def __getstate__(self):
+        # Worker processes get an empty cache
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.fractures)
+
+    def load_mesh(self, mesh_index):
+        # Welded fine mesh, matrix from piece labels to triangle labels and fracture archive (if any) of a mesh
+        if mesh_index in self.cache:
+            self.cache.move_to_end(mesh_index)
+            return self.cache[mesh_index]
+        mesh_dir = self.mesh_dirs[mesh_index]
+        compressed_mesh_path = os.path.join(mesh_dir, "compressed_mesh.obj")
+        if not os.path.exists(compressed_mesh_path):
+            compressed_mesh_path = os.path.join(mesh_dir, "compressed_mesh.ply")
+        fine_vertices, fine_triangles = igl.read_triangle_mesh(compressed_mesh_path)
+        # A triangle has the label of its first vertex, just like in write_segmented_output
+        piece_to_fine_triangles_matrix = csr_matrix(load_npz(os.path.join(mesh_dir, "compressed_data.npz")))[
+                                         fine_triangles[:, 0], :]
+        archive = None
+        if os.path.exists(os.path.join(mesh_dir, "fractures.json")):
+            archive = FractureArchive(mesh_dir)
+        mesh = weld_mesh(fine_vertices, fine_triangles) + (piece_to_fine_triangles_matrix, archive)
+        self.cache[mesh_index] = mesh
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return mesh
+
+    def fracture_name(self, i):
+        # Mesh directory and name of the i-th fracture (the directory decompress.py would write it to)
+        mesh_index, key = self.fractures[i]
+        if isinstance(key, str):
+            return self.mesh_dirs[mesh_index], os.path.basename(os.path.dirname(key))
+        return self.mesh_dirs[mesh_index], f"fracture_{key}"
+
+    def __getitem__(self, i):
+        mesh_index, key = self.fractures[i]
+        vertices, triangles, piece_to_fine_triangles_matrix, archive = self.load_mesh(mesh_index)
+        piece_labels = np.load(key) if isinstance(key, str) else archive[key]
+        triangle_labels = np.round(piece_to_fine_triangles_matrix @ piece_labels).astype(int)
+        fragments = split_by_label(vertices, triangles, triangle_labels, int(np.max(piece_labels)) + 1)
+        return [(ui, gi) for ui, gi in fragments if gi.shape[0] > 0]
+
+    def iterate(self, indeces=None, num_workers=0, prefetch=4, chunk_size=16):
+        # Yields dataset[i] for every i in indeces (default, all of them, in order). With num_workers > 0, fractures are read by that many processes, in chunks of chunk_size consecutive indeces (so that each process mostly reads fractures of a mesh it has cached), keeping at most prefetch chunks ahead of the one being yielded
+        if indeces is None:
+            indeces = range(len(self))
+        indeces = list(indeces)
+        if num_workers == 0:
+            for i in indeces:
+                yield self[i]
+            return
+        chunks = [indeces[start:start + chunk_size] for start in range(0, len(indeces), chunk_size)]
+        with Pool(num_workers, initializer=set_worker_dataset, initargs=(self,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(read_worker_fractures, (chunk,)))
+                if len(pending) > prefetch:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+
+# The copy of the dataset each worker process of FractureDataset.iterate reads from
+worker_dataset = None
+
+
+def set_worker_dataset(dataset):
+    global worker_dataset
+    worker_dataset = dataset
+
+
+def read_worker_fractures(indeces):
+    return [worker_dataset[i] for i in indeces]
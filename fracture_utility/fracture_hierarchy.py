@@ -0,0 +1,48 @@
+# Include existing libraries
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+
+
+class FractureHierarchy:
+    # In impact_projection, two neighboring pieces stay together if the distance between their projected impacts is below a threshold, and the fracture is the connected components of that graph. As the threshold grows, pieces only ever merge, in the order of the edges of a minimum spanning tree of the piece graph (weighted by those distances). So, by storing the spanning tree once per impact (this is a single-linkage dendrogram), we can read off the fracture for any threshold or any number of pieces in O(pieces), without projecting the impact again.
+
+    def __init__(self, piece_neighbors, piece_distances, num_pieces):
+        self.num_pieces = num_pieces
+        # Every neighboring pair appears twice (and every piece is its own neighbor), we only need each edge once
+        keep = piece_neighbors[:, 0] < piece_neighbors[:, 1]
+        neighbors = piece_neighbors[keep, :]
+        distances = piece_distances[keep]
+        # Only the order of the distances matters for the spanning tree. We use their ranks as weights, which avoids zero-weight edges disappearing from the sparse graph
+        order = np.argsort(distances, kind='stable')
+        ranks = np.empty(distances.shape[0])
+        ranks[order] = np.arange(1, distances.shape[0] + 1)
+        graph = csr_matrix((ranks, (neighbors[:, 0], neighbors[:, 1])), shape=(num_pieces, num_pieces))
+        tree = minimum_spanning_tree(graph).tocoo()
+        # The merges, sorted by the threshold above which they happen
+        tree_order = np.argsort(tree.data)
+        self.merge_distances = distances[order][np.rint(tree.data[tree_order]).astype(int) - 1]
+        self.merge_pieces = np.vstack((tree.row, tree.col)).T[tree_order, :]
+
+    def n_pieces(self, threshold):
+        # Number of pieces that impact_projection would produce with this threshold
+        return self.num_pieces - int(np.searchsorted(self.merge_distances, threshold, side='left'))
+
+    def labels(self, threshold):
+        # Same output as the connected components call in impact_projection with this threshold: the number of pieces and per-piece labels
+        merges = self.merge_pieces[self.merge_distances < threshold, :]
+        graph = csr_matrix((np.ones(merges.shape[0]), (merges[:, 0], merges[:, 1])),
+                           shape=(self.num_pieces, self.num_pieces), dtype=int)
+        return connected_components(graph, directed=False)
+
+    def threshold_for_num_pieces(self, num_pieces):
+        # Smallest threshold that breaks the shape into at most num_pieces pieces. This can be fewer than num_pieces if several merges happen at the same distance, and it is never fewer than the number of pieces with an infinite threshold.
+        num_merges = self.num_pieces - num_pieces
+        if num_merges <= 0:
+            return 0.0
+        if num_merges > self.merge_distances.shape[0]:
+            return np.inf
+        return np.nextafter(self.merge_distances[num_merges - 1], np.inf)
+
+    def labels_for_num_pieces(self, num_pieces):
+        return self.labels(self.threshold_for_num_pieces(num_pieces))
@@ -1,4 +1,6 @@
 # Include existing libraries
+import copy
+import json
 import os
 import uuid
 
@@ -8,24 +10,91 @@ import igl
 import numpy as np
 import trimesh
 from gpytoolbox.copyleft import mesh_boolean
-from scipy.sparse import coo_matrix, csr_matrix, eye, kron, save_npz
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, diags, eye, issparse, kron, save_npz, vstack
 from scipy.sparse.csgraph import connected_components
-from scipy.sparse.linalg import lsqr, spsolve
+from scipy.sparse.linalg import factorized, lsqr, spsolve
+from scipy.spatial import cKDTree
 from scipy.stats import multivariate_normal
 from tqdm import tqdm
 
-from .compute_fracture_modes import compute_fracture_modes
+from .array_store import read_arrays, write_arrays
+from .compute_fracture_modes import FractureOperators, compute_fracture_modes, solve_fracture_modes
+from .fine_pieces import FinePieceCache, compute_fine_pieces, compute_hollow_pieces, split_fine_pieces
+from .fracture_archive import FractureArchive
+from .fracture_hierarchy import FractureHierarchy
 from .fracture_modes_parameters import FractureModesParameters
 from .massmatrix_tets import massmatrix_tets
+from .point_location import locate_fine_pieces
+from .segment_mesh import split_by_label, weld_mesh
+from .stage_cache import hash_arrays
 from .tictoc import tic, toc
 
 
+def fine_mesh_property(name):
+    # The fine mesh attributes set by impact_precomputation. With lazy_fine_pieces, they are only assembled from fine_piece_cache the first time one of them is read
+    def getter(self):
+        if getattr(self, '_' + name) is None and self.fine_piece_cache is not None:
+            self.assemble_fine_pieces(self.fine_piece_cache.get_all())
+        return getattr(self, '_' + name)
+
+    def setter(self, value):
+        setattr(self, '_' + name, value)
+        # (the welded fine mesh depends on these)
+        self._welded_fine_mesh = None
+
+    return property(getter, setter)
+
+
 # TODO: CHECK I DIDN'T BREAK 3D MODES
 # TODO: Write unit tests for all dimensions and boolean options
 
 class FractureModes:
     impact_precomputed = False
     impact_projected = False
+    # Factorization of A (see impact_precomputation), only used to visualize wave impacts
+    A_solver = None
+    # Caches of the impact_vis, tet_labels_after_impact and fine_vertex_labels_after_impact properties
+    _impact_vis = None
+    _tet_labels_after_impact = None
+    _fine_vertex_labels_after_impact = None
+    # Fine mesh pieces, built on demand (only with impact_precomputation(lazy_fine_pieces=True))
+    fine_piece_cache = None
+    _fine_vertices = None
+    _fine_triangles = None
+    _piece_to_fine_vertices_matrix = None
+    _fine_labels = None
+    _welded_fine_mesh = None
+    fine_vertices = fine_mesh_property('fine_vertices')
+    fine_triangles = fine_mesh_property('fine_triangles')
+    piece_to_fine_vertices_matrix = fine_mesh_property('piece_to_fine_vertices_matrix')
+    fine_labels = fine_mesh_property('fine_labels')
+    # Welded pieces minus the interior, only for hollow objects (see assemble_hollow_pieces)
+    hollow_vertices = None
+    hollow_triangles = None
+    hollow_triangle_pieces = None
+    # How impact_precomputation split the fine mesh into pieces (see its fine_backend)
+    fine_backend = 'boolean'
+    # The fine mesh and cache options impact_precomputation was called with, which extend_impact_precomputation cuts new pieces out of (not saved, see extend_impact_precomputation for what happens without them)
+    precomputation_inputs = None
+    # What compute_modes assembled and the parameters it used, kept for extend_modes (the parameters are saved and cached with the modes, without the options that only concern how that run went, see get_state)
+    mode_operators = None
+    mode_parameters = None
+    run_parameter_names = ('verbose', 'checkpoint_dir', 'time_budget', 'max_solves')
+    # Whether the last compute_modes or extend_modes ran out of budget and computed fewer modes than asked for (see FractureModesParameters.time_budget)
+    partial_modes = False
+    # One dictionary per conic solve of compute_modes and extend_modes since (see solve_fracture_modes, not saved)
+    mode_telemetry = None
+    # Everything compute_modes and impact_precomputation produce. This is what we need to store to skip them later (see get_state and save)
+    modes_state_names = ['exploded_vertices', 'exploded_elements', 'modes', 'labels', 'tet_to_vertex_matrix',
+                         'tet_neighbors', 'massmatrix', 'unexploded_to_exploded_matrix', 'verbose', 'mode_parameters']
+    precomputation_state_names = ['all_modes_labels', 'precomputed_num_pieces', 'piece_to_tet_matrix',
+                                  'piece_neighbors', 'piece_modes', 'piece_labels', 'piece_massmatrix',
+                                  'tet_to_piece_matrix', 'A', 'M', 'C', 'wave_piece_lsqr', 'fine_vertices',
+                                  'fine_triangles', 'piece_to_fine_vertices_matrix', 'fine_labels', 't_impact_pre',
+                                  'impact_radius', 'impact_sigma', 'impact_support', 'hollow_vertices',
+                                  'hollow_triangles', 'hollow_triangle_pieces', 'fine_backend']
+    # Bump this whenever the two lists above change, so that load refuses files written by older code
+    save_format_version = 5
 
     def __init__(self, vertices, elements, v_interior=None, f_interior=None):
         # Initialize this class with an n by 3 matrix of vertices and an n by 4 integer matrix of tet indeces
@@ -38,10 +107,106 @@ class FractureModes:
         if parameters is None:
             parameters = FractureModesParameters()
         # This is just a call to compute_fracture_modes, saving all the information we will need for impact projection
-        self.exploded_vertices, self.exploded_elements, self.modes, self.labels, self.tet_to_vertex_matrix, self.tet_neighbors, self.massmatrix, self.unexploded_to_exploded_matrix = compute_fracture_modes(
-            self.vertices, self.elements, parameters)
+        self.mode_telemetry = []
+        self.exploded_vertices, self.exploded_elements, self.modes, self.labels, self.tet_to_vertex_matrix, self.tet_neighbors, self.massmatrix, self.unexploded_to_exploded_matrix, self.mode_operators = compute_fracture_modes(
+            self.vertices, self.elements, parameters, return_operators=True, telemetry=self.mode_telemetry)
+        self.partial_modes = self.modes.shape[1] < parameters.num_modes
+        self.set_mode_parameters(parameters)
         self.verbose = parameters.verbose
 
+    def extend_modes(self, num_new_modes, parameters=None, num_workers=1):
+        # Computes num_new_modes more modes, orthogonal to the ones we have, without computing those again (see solve_fracture_modes). This reuses the matrices and eigenmodes compute_modes built (or builds them, if the modes were loaded from disk), so it only costs the conic solves of the new modes. By default, it uses the parameters of compute_modes
+        # If impact_precomputation was called, it is updated too (see extend_impact_precomputation, num_workers is passed to it)
+        if parameters is None:
+            parameters = self.mode_parameters
+        if parameters is None:
+            raise ValueError("We don't know the parameters these modes were computed with (they were cached by older "
+                             "code), so pass the same ones to extend_modes")
+        assert self.modes.shape[0] == parameters.d * self.elements.shape[0], \
+            "These modes don't have dimension parameters.d (transfer_modes_to_3d modes can't be extended)"
+        if self.mode_operators is None or not self.mode_operators.matches(parameters):
+            self.mode_operators = FractureOperators(self.vertices, self.elements, parameters)
+        if self.mode_telemetry is None:
+            self.mode_telemetry = []
+        new_modes, new_labels = solve_fracture_modes(self.mode_operators, parameters, num_new_modes,
+                                                     previous_modes=self.modes, telemetry=self.mode_telemetry)
+        self.partial_modes = new_modes.shape[1] < num_new_modes
+        if new_modes.shape[1] == 0:
+            return
+        self.modes = np.hstack((self.modes, new_modes))
+        self.labels = np.hstack((self.labels, new_labels))
+        self.set_mode_parameters(parameters)
+        if self.impact_precomputed:
+            self.extend_impact_precomputation(num_workers=num_workers)
+
+    def set_mode_parameters(self, parameters):
+        # Keeps a copy of the parameters the modes were computed with, saying how many modes we actually have (which is what save and the stage cache store)
+        self.mode_parameters = copy.copy(parameters)
+        self.mode_parameters.num_modes = self.modes.shape[1]
+
+    def get_state(self, names):
+        # Dictionary with the attributes in names (e.g., modes_state_names), for caching or saving. mode_parameters becomes a JSON string
+        state = {name: getattr(self, name, None) for name in names}
+        if state.get('mode_parameters') is not None:
+            state['mode_parameters'] = json.dumps({name: value for name, value in vars(self.mode_parameters).items()
+                                                   if name not in self.run_parameter_names})
+        return state
+
+    def set_modes_state(self, state):
+        # Restores what compute_modes computed, from the output of get_state(modes_state_names). Modes cached by older code have no mode_parameters (then extend_modes needs them)
+        for name in self.modes_state_names:
+            setattr(self, name, state.get(name) if name == 'mode_parameters' else state[name])
+        if self.mode_parameters is not None:
+            self.mode_parameters = FractureModesParameters(**json.loads(self.mode_parameters), verbose=self.verbose)
+
+    def set_precomputation_state(self, state):
+        # Restores what impact_precomputation computed, from the output of get_state(precomputation_state_names)
+        self.close()
+        self.fine_piece_cache = None
+        for name in self.precomputation_state_names:
+            setattr(self, name, state[name])
+        # We don't store the factorization of A, it will be recomputed if impact_vis is ever needed
+        self.A_solver = None
+        self.build_impact_lookup()
+        self.impact_precomputed = True
+
+    def build_impact_lookup(self):
+        # Spatial indeces over the cage vertices (for wave impacts) and the points where we evaluate Gaussian impacts (the first vertex of each tet), so that an impact only ever looks at the part of the mesh it touches. These are cheap to build, so we don't store them.
+        self.vertex_tree = cKDTree(self.vertices)
+        self.element_tree = cKDTree(self.vertices[self.elements[:, 0], :])
+        # Same for the Gaussian and the matrix that turns a per-tet impact into a per-piece one
+        self.rv = multivariate_normal(np.zeros(3), self.impact_sigma ** 2 * np.eye(3))
+        self.tet_to_piece_mass_matrix = csc_matrix(self.tet_to_piece_matrix @ self.massmatrix)
+
+    def save(self, path):
+        # Writes everything computed so far to the directory path, one uncompressed .npy file per array, so that load can memory-map it
+        assert hasattr(self, 'modes'), "Nothing to save, call compute_modes first"
+        state = {'format_version': self.save_format_version,
+                 'vertices': self.vertices,
+                 'elements': self.elements,
+                 'v_interior': self.v_interior,
+                 'f_interior': self.f_interior,
+                 'impact_precomputed': self.impact_precomputed,
+                 'partial_modes': self.partial_modes}
+        state.update(self.get_state(self.modes_state_names))
+        if self.impact_precomputed:
+            state.update(self.get_state(self.precomputation_state_names))
+        write_arrays(path, state)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # Reads a FractureModes object written by save. With mmap=True, arrays are memory-mapped (read-only) instead of read, so this is nearly instantaneous regardless of their size
+        state = read_arrays(path, mmap=mmap)
+        if state.get('format_version') != cls.save_format_version:
+            raise ValueError(f"{path} was saved with format version {state.get('format_version')}, "
+                             f"but this code reads version {cls.save_format_version}. Please recompute it.")
+        modes = cls(state['vertices'], state['elements'], state['v_interior'], state['f_interior'])
+        modes.set_modes_state(state)
+        modes.partial_modes = bool(state.get('partial_modes', False))
+        if state['impact_precomputed']:
+            modes.set_precomputation_state(state)
+        return modes
+
     def transfer_modes_to_3d(self):
         # Computing modes in 3D can be slow. One trick we can do for efficiency is compute the modes in 1D and then transfer them to 3D by taking every possible combination of every 1D mode in the x, y and z directions
         modes_3d = []
@@ -89,10 +254,116 @@ class FractureModes:
         # Ta-dah! We have 3D modes :)
         # Please we have no proof that these are exactly the same modes as if you had computed the 3D modes directly. I *think* they are, but maybe they're not! 
 
-    def impact_precomputation(self, v_fine=None, f_fine=None, wave_h=1 / 30, upper_envelope=False):
+    def impact_precomputation(self, v_fine=None, f_fine=None, wave_h=1 / 30, upper_envelope=False, impact_radius=0.05,
+                              impact_sigma=0.1, impact_support=6.0, num_workers=1, cache_dir=None,
+                              cache_size=20 * 2 ** 30, lazy_fine_pieces=False, fine_piece_memory=2 ** 30,
+                              prefetch_fine_pieces=True, fine_backend='boolean'):
         # This is not strictly part of the mode computation but it can be
         # precomputed to make the impact projection as fast as possible:
+        # (impact_radius is the radius around the contact point hit by a wave impact, impact_sigma is the standard deviation of a Gaussian impact, and impact_support is how many standard deviations away from the contact point we still evaluate the Gaussian)
+        # (num_workers, cache_dir and cache_size are passed to compute_fine_pieces, which intersects the fine mesh with every piece)
+        # (with lazy_fine_pieces, those intersections are instead only computed when needed, keeping at most fine_piece_memory bytes of them in memory, see FinePieceCache. With prefetch_fine_pieces, the largest pieces are computed in the background, as many as fit in fine_piece_memory)
+        # (fine_backend is how we split the fine mesh into pieces: 'boolean' intersects it with every piece, 'point_location' labels it by point location and only cuts it where it crosses pieces)
+        if fine_backend not in ('boolean', 'point_location'):
+            raise ValueError(f"Unknown fine mesh backend '{fine_backend}', use 'boolean' or 'point_location'")
         tic()
+        self.fine_backend = fine_backend
+        self.precomputation_inputs = {'v_fine': v_fine, 'f_fine': f_fine, 'cache_dir': cache_dir, 'cache_size': cache_size}
+        self.piece_precomputation()
+        # Now, say we have a contact point t[i] at runtime and d is the vector with all zeros except on the i-th position (called "onehot" later). Then, what we'd want to make the impact vector is
+        # u = C (M - hL)^{-1} M d
+        #       ^--A--^
+        self.A = massmatrix_tets(self.vertices, self.elements) - wave_h * igl.cotmatrix(self.vertices, self.elements)
+        self.M = massmatrix_tets(self.vertices, self.elements)
+        # We won't need A at runtime to fracture, but we will to visualize a wave impact, so we factorize it once here
+        self.A_solver = factorized(csc_matrix(self.A))
+        # (C blurs per-unexploded-vertex values into tets)
+        self.C = 0.25 * (self.tet_to_vertex_matrix.T @ self.unexploded_to_exploded_matrix)
+
+        # The wave impact of a contact point is then just a few rows of a matrix (see wave_piece_precomputation)
+        self.wave_piece_precomputation()
+
+        # We also may want to use a Gaussian, instead of a wave equation, to blur our impact from the contact point to the rest of the shape. In case we want to do this, we pre-build a normal distribution (not sure if this is really necessary). build_impact_lookup does this, together with the spatial indeces we use to find which vertices and tets an impact touches.
+        self.impact_radius = impact_radius
+        self.impact_sigma = impact_sigma
+        self.impact_support = impact_support
+        self.build_impact_lookup()
+
+        # So far, we have precomputed everything we need to answer the question "which pieces will our input mesh break into given an impact". But, often, our input mesh is not the mesh we want to break; rather, it is a cage of a finer mesh, and we want a broken version of the latter to be the output. In that case, what we'll need to precompute are the possible fracture pieces *of the fine mesh* as well as a piece-to-fine-mesh-vertex mapping
+
+        self.close()
+        self.fine_piece_cache = None
+        fine_pieces = None
+        if v_fine is not None and fine_backend == 'point_location':
+            # Instead of intersecting the fine mesh with every piece, we can find which tet each fine vertex is in and only cut the fine triangles that cross from one piece to another (see locate_fine_pieces). This is much faster, but approximate
+            fine_pieces = locate_fine_pieces(self.vertices, self.elements, self.all_modes_labels,
+                                             self.precomputed_num_pieces, v_fine, f_fine)
+            self.assemble_fine_pieces(fine_pieces)
+        elif v_fine is not None:
+            # If we want to alleviate the effect of mesh dependency, we can use a post-facto smoothing combined with upper envelope extraction
+            # This is unsupported now because we still need to port the upper envelope code to gpytoolbox.
+            if upper_envelope:
+            # We convert our per-tet labels into "material densities"
+                LT_elements = np.zeros((self.elements.shape[0],self.precomputed_num_pieces))
+                for i in range(self.precomputed_num_pieces):
+                    LT_elements[self.all_modes_labels==i,i] = 1.0
+                # Convert per-tet material densities into per-vertex material densities
+                LT = blur_onto_vertices(self.elements,LT_elements)
+                # Smooth the densities
+                LT = spsolve(eye(self.vertices.shape[0]) - smoothing_lambda*igl.cotmatrix(self.vertices,self.elements),LT)
+                # Extract upper envelopes
+                u, g, l = gpytoolbox.upper_envelope(self.vertices,self.elements,LT)
+
+            # All this loop is doing is convert each coarse mesh piece into a triangle mesh. We then intersect them by the fine mesh (in parallel, see compute_fine_pieces), save that as fine mesh pieces, and keep track of indexes to get an index-to-fine mapping
+            pieces = []
+            for i in range(self.precomputed_num_pieces):
+                if upper_envelope:
+                    if np.any(l[:, i]):  # Sometimes upper envelope entirely removes a material
+                        vi, ti = igl.remove_unreferenced(u, g[l[:, i], :])[:2]
+                        fi = boundary_faces_fixed(ti)
+                        fi = fi[:, [1, 0, 2]]  # libigl uses different ordering!??
+                    else:
+                        vi = np.zeros((0, 3))
+                        fi = np.zeros((0, 3), dtype=int)
+                else:
+                    vi, fi = self.coarse_piece_mesh(i)
+                pieces.append((vi, fi))
+            if lazy_fine_pieces:
+                for name in ['fine_vertices', 'fine_triangles', 'piece_to_fine_vertices_matrix', 'fine_labels']:
+                    setattr(self, name, None)
+                self.fine_piece_cache = FinePieceCache(v_fine, f_fine, pieces, max_memory=fine_piece_memory,
+                                                       cache_dir=cache_dir, cache_size=cache_size)
+                if prefetch_fine_pieces:
+                    self.fine_piece_cache.prefetch(np.argsort(-np.bincount(self.all_modes_labels,
+                                                                           minlength=self.precomputed_num_pieces)))
+            else:
+                fine_pieces = compute_fine_pieces(v_fine, f_fine, pieces, num_workers=num_workers, cache_dir=cache_dir,
+                                                  cache_size=cache_size)
+                self.assemble_fine_pieces(fine_pieces)
+        else:
+            self.fine_vertices = None
+            self.fine_triangles = None
+
+        # If the object is hollow, every fragment we write is a union of pieces minus the interior. Instead of a boolean per fragment for every impact, we subtract the interior from every piece once here, and fragments are just the pieces put together (this keeps the faces between pieces of the same fragment, just like the fine mesh does)
+        self.hollow_vertices = None
+        self.hollow_triangles = None
+        self.hollow_triangle_pieces = None
+        if self.v_interior is not None and self.f_interior is not None and self.fine_piece_cache is None:
+            if fine_pieces is None:
+                fine_pieces = [self.coarse_piece_mesh(i) for i in range(self.precomputed_num_pieces)]
+            self.assemble_hollow_pieces(compute_hollow_pieces(fine_pieces, self.v_interior, self.f_interior,
+                                                              num_workers=num_workers, cache_dir=cache_dir,
+                                                              cache_size=cache_size))
+
+        # Store and print timing details
+        self.t_impact_pre = round(toc(silence=True), 5)
+        if self.verbose:
+            print(f"Impact precomputation: {self.t_impact_pre} seconds. Will produce a maximum of {self.precomputed_num_pieces} pieces.")
+        # This is a boolean that we'll check before projecting an impact
+        self.impact_precomputed = True
+
+    def piece_precomputation(self):
+        # The part of impact_precomputation that depends on the modes: the pieces that can break off and how tets, modes and mass map onto them. extend_modes calls this again after adding modes
         dim = self.modes.shape[0] // self.elements.shape[0]  # mode dimension
         # Do the kronecker product by these matrices to replicate the "tile" behaviour in matlab and the "blockdiag" behaviour
         blockdiag_mat = eye(dim)
@@ -161,92 +432,153 @@ class FractureModes:
         # So let's define ^-------------  tet_to_piece  ----------------^
         self.tet_to_piece_matrix = spsolve((kron(blockdiag_mat, self.piece_to_tet_matrix.T) @ self.massmatrix @ kron(
             blockdiag_mat, self.piece_to_tet_matrix)), kron(blockdiag_mat, self.piece_to_tet_matrix.T))
-        # Now, say we have a contact point t[i] at runtime and d is the vector with all zeros except on the i-th position (called "onehot" later). Then, what we'd want to make the impact vector is
-        # u = C (M - hL)^{-1} M d
-        #       ^--A--^
-        self.A = massmatrix_tets(self.vertices, self.elements) - wave_h * igl.cotmatrix(self.vertices, self.elements)
-        self.M = massmatrix_tets(self.vertices, self.elements)
-        # (C blurs per-unexploded-vertex values into tets)
-        self.C = 0.25 * (self.tet_to_vertex_matrix.T @ self.unexploded_to_exploded_matrix)
 
+    def wave_piece_precomputation(self):
+        # The wave impact part of impact_precomputation, which depends on the pieces (and on A and C, which don't)
+        dim = self.modes.shape[0] // self.elements.shape[0]  # mode dimension
         # But then the full runtime computation will be
         # piece_impact = tet_to_piece * C * A^{-1} * M * d
         # So we might as well call 
         # wave_piece_lsqr' = tet_to_piece * C  * A^{-1} * M
-        self.wave_piece_lsqr = spsolve(kron(blockdiag_mat, self.A.T),
-                                       kron(blockdiag_mat, self.C.T) @ self.massmatrix.T @ self.tet_to_piece_matrix.T)
+        self.wave_piece_lsqr = csr_matrix(spsolve(kron(eye(dim), self.A.T),
+                                                  kron(eye(dim), self.C.T) @ self.massmatrix.T @ self.tet_to_piece_matrix.T))
         # and then we no longer have to do a solve at runtime
         # we only need to do
         # piece_impact = wave_piece_lsqr' M d
+        # and since d is only nonzero near the contact point, that's just a sum of a few rows of wave_piece_lsqr (which is why we store it by rows)
 
-        # We also may want to use a Gaussian, instead of a wave equation, to blur our impact from the contact point to the rest of the shape. In case we want to do this, we pre-build a normal distribution (not sure if this is really necessary)
-        self.rv = multivariate_normal([0.0, 0.0, 0.0], [[0.01, 0.0, 0.0], [0.0, 0.01, 0.0], [0.0, 0.0, 0.01]])
-
-        # So far, we have precomputed everything we need to answer the question "which pieces will our input mesh break into given an impact". But, often, our input mesh is not the mesh we want to break; rather, it is a cage of a finer mesh, and we want a broken version of the latter to be the output. In that case, what we'll need to precompute are the possible fracture pieces *of the fine mesh* as well as a piece-to-fine-mesh-vertex mapping
+    def extend_impact_precomputation(self, num_workers=1):
+        # Updates what impact_precomputation computed after extend_modes added modes. New modes can only split pieces, never merge them, so every new piece is part of one old piece: the fine and hollow meshes of pieces that weren't split are kept, and only the new pieces are intersected with the fine mesh and have the interior subtracted (with num_workers processes). The result is the same as calling impact_precomputation again. If the fine mesh impact_precomputation was given isn't around (e.g., these modes were loaded), new pieces are instead cut out of the fine mesh of the piece they were split from
+        tic()
+        old_labels = self.all_modes_labels
+        old_num_pieces = self.precomputed_num_pieces
+        self.piece_precomputation()
+        self.wave_piece_precomputation()
+        self.build_impact_lookup()
+        parents = np.zeros(self.precomputed_num_pieces, dtype=int)
+        parents[self.all_modes_labels] = old_labels
+        kept = np.bincount(parents, minlength=old_num_pieces)[parents] == 1
+        split = np.nonzero(~kept)[0]
+        split_coarse_pieces = [self.coarse_piece_mesh(i) for i in split]
+        inputs = self.precomputation_inputs
+        if inputs is None or inputs['v_fine'] is None:
+            inputs = {'v_fine': None, 'f_fine': None, 'cache_dir': None, 'cache_size': 20 * 2 ** 30}
+
+        fine_pieces = None
+        if self.fine_piece_cache is not None:
+            # Lazy fine pieces are computed on demand anyway, we only keep the ones we already have
+            for name in ['fine_vertices', 'fine_triangles', 'piece_to_fine_vertices_matrix', 'fine_labels']:
+                setattr(self, name, None)
+            self.fine_piece_cache = self.fine_piece_cache.with_pieces(
+                [self.coarse_piece_mesh(i) for i in range(self.precomputed_num_pieces)], np.where(kept, parents, -1))
+            self.fine_piece_cache.prefetch(np.argsort(-np.bincount(self.all_modes_labels,
+                                                                   minlength=self.precomputed_num_pieces)))
+        elif self._fine_vertices is not None:
+            old_vertex_pieces = self.piece_to_fine_vertices_matrix @ np.arange(old_num_pieces)
+            old_fine_pieces = split_by_label(self.fine_vertices, self.fine_triangles,
+                                             old_vertex_pieces[self.fine_triangles[:, 0]], old_num_pieces)
+            fine_pieces = [old_fine_pieces[parents[i]] if kept[i] else None for i in range(self.precomputed_num_pieces)]
+            if self.fine_backend == 'point_location' and inputs['v_fine'] is not None:
+                # Locating is cheap, so we just do it all again
+                fine_pieces = locate_fine_pieces(self.vertices, self.elements, self.all_modes_labels,
+                                                 self.precomputed_num_pieces, inputs['v_fine'], inputs['f_fine'])
+            elif self.fine_backend == 'point_location':
+                # Locate the old piece's fine mesh in the tets of the pieces it was split into
+                for j in np.unique(parents[split]):
+                    children = np.nonzero(parents == j)[0]
+                    tets = np.nonzero(old_labels == j)[0]
+                    child_labels = np.searchsorted(children, self.all_modes_labels[tets])
+                    child_pieces = locate_fine_pieces(self.vertices, self.elements[tets, :], child_labels,
+                                                      children.shape[0], *old_fine_pieces[j])
+                    for i, child_piece in zip(children, child_pieces):
+                        fine_pieces[i] = child_piece
+            else:
+                if inputs['v_fine'] is not None:
+                    split_pieces = compute_fine_pieces(inputs['v_fine'], inputs['f_fine'], split_coarse_pieces,
+                                                       num_workers=num_workers, cache_dir=inputs['cache_dir'],
+                                                       cache_size=inputs['cache_size'])
+                else:
+                    split_pieces = split_fine_pieces(old_fine_pieces, split_coarse_pieces, parents[split],
+                                                     num_workers=num_workers)
+                for i, fine_piece in zip(split, split_pieces):
+                    fine_pieces[i] = fine_piece
+            self.assemble_fine_pieces(fine_pieces)
+
+        if self.hollow_vertices is not None:
+            # The same goes for the pieces minus the interior
+            old_hollow_pieces = split_by_label(self.hollow_vertices, self.hollow_triangles,
+                                               self.hollow_triangle_pieces, old_num_pieces)
+            hollow_pieces = [old_hollow_pieces[parents[i]] if kept[i] else None
+                             for i in range(self.precomputed_num_pieces)]
+            split_pieces = compute_hollow_pieces(split_coarse_pieces if fine_pieces is None else
+                                                 [fine_pieces[i] for i in split], self.v_interior, self.f_interior,
+                                                 num_workers=num_workers, cache_dir=inputs['cache_dir'],
+                                                 cache_size=inputs['cache_size'])
+            for i, hollow_piece in zip(split, split_pieces):
+                hollow_pieces[i] = hollow_piece
+            self.assemble_hollow_pieces(hollow_pieces)
+
+        # Whatever we projected was projected onto the old modes
+        self.impact_projected = False
+        self._impact_vis = None
+        self._tet_labels_after_impact = None
+        self._fine_vertex_labels_after_impact = None
+        t_extend = round(toc(silence=True), 5)
+        if self.verbose:
+            print(f"Impact precomputation update: {t_extend} seconds. Split {np.unique(parents[split]).shape[0]} pieces, will produce a maximum of {self.precomputed_num_pieces} pieces.")
 
+    def assemble_fine_pieces(self, fine_pieces):
         # We will be appending to these to stack later
         running_n = 0  # for combining meshes
         fine_piece_vertices = []
         fine_piece_triangles = []
         Js = []
-
-        if v_fine is not None:
-            # If we want to alleviate the effect of mesh dependency, we can use a post-facto smoothing combined with upper envelope extraction
-            # This is unsupported now because we still need to port the upper envelope code to gpytoolbox.
-            if upper_envelope:
-            # We convert our per-tet labels into "material densities"
-                LT_elements = np.zeros((self.elements.shape[0],self.precomputed_num_pieces))
-                for i in range(self.precomputed_num_pieces):
-                    LT_elements[self.all_modes_labels==i,i] = 1.0
-                # Convert per-tet material densities into per-vertex material densities
-                LT = blur_onto_vertices(self.elements,LT_elements)
-                # Smooth the densities
-                LT = spsolve(eye(self.vertices.shape[0]) - smoothing_lambda*igl.cotmatrix(self.vertices,self.elements),LT)
-                # Extract upper envelopes
-                u, g, l = gpytoolbox.upper_envelope(self.vertices,self.elements,LT)
-
-            # All this loop is doing is convert each coarse mesh piece into a triangle mesh, intersect it by the fine mesh, save that as a fine mesh piece, and keep track of indexes to get an index-to-fine mapping
-            for i in tqdm(range(self.precomputed_num_pieces), desc="Precomputing fine mesh pieces"):
-                if upper_envelope:
-                    if np.any(l[:, i]):  # Sometimes upper envelope entirely removes a material
-                        vi, ti = igl.remove_unreferenced(u, g[l[:, i], :])[:2]
-                        fi = boundary_faces_fixed(ti)
-                        fi = fi[:, [1, 0, 2]]  # libigl uses different ordering!??
-                    else:
-                        vi = np.zeros((0, 3))
-                        fi = np.zeros((0, 3), dtype=int)
-                else:
-                    vi, ti = igl.remove_unreferenced(self.vertices, self.elements[self.all_modes_labels == i, :])[:2]
-                    fi = boundary_faces_fixed(ti)
-                    fi = fi[:, [1, 0, 2]]  # libigl uses different ordering!??
-                # This should be replaced by a call to igl.mesh_booleans once the official binding is published
-                vi_fine, fi_fine = mesh_boolean(v_fine, f_fine.astype(np.int32), vi, fi.astype(np.int32),
-                                                boolean_type='intersection')
-                fine_piece_vertices.append(vi_fine.copy())
-                fine_piece_triangles.append(fi_fine + running_n)
-                running_n = running_n + vi_fine.shape[0]
-                Js.append(i * np.ones(vi_fine.shape[0], dtype=int))
-            self.fine_vertices = np.vstack(fine_piece_vertices)
-            self.fine_triangles = np.vstack(fine_piece_triangles)
-            J = np.concatenate(Js)
-            I = np.linspace(0, self.fine_vertices.shape[0] - 1, self.fine_vertices.shape[0], dtype=int)
-            # These correspondences work just like the tet ones from before
-            self.piece_to_fine_vertices_matrix = csr_matrix((np.ones(I.shape[0]), (I, J)), shape=(
-            self.fine_vertices.shape[0], self.precomputed_num_pieces), dtype=int)
-            self.fine_labels = np.zeros((self.fine_vertices.shape[0], self.modes.shape[1]))
-            for k in range(self.modes.shape[1]):
-                self.fine_labels[:, k] = self.piece_to_fine_vertices_matrix @ \
-                                         lsqr(self.piece_to_tet_matrix, self.labels[:, k])[0]  # We don't really need this lsqr (self.labels is constant per piece), but this is not a bottleneck.
-        else:
-            self.fine_vertices = None
-            self.fine_triangles = None
-
-        # Store and print timing details
-        self.t_impact_pre = round(toc(silence=True), 5)
-        if self.verbose:
-            print(f"Impact precomputation: {self.t_impact_pre} seconds. Will produce a maximum of {self.precomputed_num_pieces} pieces.")
-        # This is a boolean that we'll check before projecting an impact
-        self.impact_precomputed = True
+        for i, (vi_fine, fi_fine) in enumerate(fine_pieces):
+            fine_piece_vertices.append(vi_fine.copy())
+            fine_piece_triangles.append(fi_fine + running_n)
+            running_n = running_n + vi_fine.shape[0]
+            Js.append(i * np.ones(vi_fine.shape[0], dtype=int))
+        self.fine_vertices = np.vstack(fine_piece_vertices)
+        self.fine_triangles = np.vstack(fine_piece_triangles)
+        J = np.concatenate(Js)
+        I = np.linspace(0, self.fine_vertices.shape[0] - 1, self.fine_vertices.shape[0], dtype=int)
+        # These correspondences work just like the tet ones from before
+        self.piece_to_fine_vertices_matrix = csr_matrix((np.ones(I.shape[0]), (I, J)), shape=(
+        self.fine_vertices.shape[0], self.precomputed_num_pieces), dtype=int)
+        self.fine_labels = np.zeros((self.fine_vertices.shape[0], self.modes.shape[1]))
+        for k in range(self.modes.shape[1]):
+            self.fine_labels[:, k] = self.piece_to_fine_vertices_matrix @ \
+                                     lsqr(self.piece_to_tet_matrix, self.labels[:, k])[0]  # We don't really need this lsqr (self.labels is constant per piece), but this is not a bottleneck.
+
+    def coarse_piece_mesh(self, i):
+        # Boundary triangle mesh of the i-th precomputed piece of the input tet mesh
+        vi, ti = igl.remove_unreferenced(self.vertices, self.elements[self.all_modes_labels == i, :])[:2]
+        fi = boundary_faces_fixed(ti)
+        fi = fi[:, [1, 0, 2]]  # libigl uses different ordering!??
+        return vi, fi
+
+    def assemble_hollow_pieces(self, hollow_pieces):
+        # Same as assemble_fine_pieces, but we only need to know which piece each triangle comes from. We weld the result once, so that writing a fragment is just taking its triangles (see split_by_label)
+        running_n = 0
+        Vs = [np.zeros((0, 3))]
+        Fs = [np.zeros((0, 3), dtype=int)]
+        Ps = [np.zeros(0, dtype=int)]
+        for i, (vi_hollow, fi_hollow) in enumerate(hollow_pieces):
+            Vs.append(vi_hollow)
+            Fs.append(fi_hollow + running_n)
+            Ps.append(i * np.ones(fi_hollow.shape[0], dtype=int))
+            running_n = running_n + vi_hollow.shape[0]
+        self.hollow_vertices, self.hollow_triangles = weld_mesh(np.vstack(Vs), np.vstack(Fs).astype(int))
+        self.hollow_triangle_pieces = np.concatenate(Ps)
+
+    def has_fine_mesh(self):
+        # Whether impact_precomputation was given a fine mesh (without assembling it, if it's lazy)
+        return self.fine_piece_cache is not None or self._fine_vertices is not None
+
+    def close(self):
+        # Stops prefetching fine pieces in the background, if we were
+        if self.fine_piece_cache is not None:
+            self.fine_piece_cache.close()
 
     def impact_projection(self, contact_point=None, threshold=0.02, wave=True, direction=np.array([1]), impact=None,
                           project_on_modes=False, num_modes_used=None):
@@ -265,38 +597,39 @@ class FractureModes:
         if impact is None:
             # If you gave us a contact point and direction, then
             assert (direction.shape[0] == dim)
-            # We will build an impact vector that is the size of the input vertices, since that's what we assumed for the least squares precomputation stuff
+            # The impact vector is the size of the input vertices (or tets, for a Gaussian), since that's what we assumed for the least squares precomputation stuff. But it is zero away from the contact point, so we only find and store its nonzero entries, using the spatial indeces from the precomputation. This way, the cost of an impact doesn't grow with the size of the mesh.
             if wave:
-                onehot = np.zeros(self.vertices.shape[0])
-                onehot[np.linalg.norm(self.vertices - np.tile(contact_point, (self.vertices.shape[0], 1)),
-                                      axis=1) < 0.05] = 1.0
-                impact_1d = onehot
+                support = np.array(self.vertex_tree.query_ball_point(contact_point, self.impact_radius), dtype=int)
+                impact_1d = np.ones(support.shape[0])
+                num_rows = self.vertices.shape[0]
             else:
-                # Propagate with a gaussian directly
-                impact_1d = 1.0 * self.rv.pdf(
-                    self.vertices[self.elements[:, 0], :] - np.tile(np.reshape(contact_point, (1, 3)),
-                                                                    (self.elements.shape[0], 1)))
+                # Propagate with a gaussian directly (it's negligible beyond impact_support standard deviations)
+                support = np.array(self.element_tree.query_ball_point(contact_point, self.impact_support * self.impact_sigma), dtype=int)
+                impact_1d = np.reshape(self.rv.pdf(self.vertices[self.elements[support, 0], :] - np.reshape(contact_point, (1, 3))), -1)
+                num_rows = self.elements.shape[0]
             # Both these impact versions are effectively repeated accross dimensions, but weighed by the direction of the impact. Let's do this to get a num_verts x dim impact
-            impacts_dim = []
-            for d in range(dim):
-                impacts_dim.append(direction[d] * impact_1d)
-            self.impact = np.concatenate(impacts_dim)
+            self.impact_indeces = np.concatenate([support + d * num_rows for d in range(dim)])
+            self.impact_values = np.concatenate([direction[d] * impact_1d for d in range(dim)])
+            self.impact_size = dim * num_rows
+            # We use the information from our precomputation step to project the impact onto the best (LS) constant-per-piece impact
+            if wave:
+                # self.piece_impact = self.wave_piece_lsqr.T @ kron(blockdiag_kron,self.M) @ self.impact
+                self.piece_impact = self.wave_piece_lsqr[self.impact_indeces, :].T @ self.impact_values
+            else:
+                self.piece_impact = np.concatenate(
+                    [direction[d] * (self.tet_to_piece_mass_matrix[:, support] @ impact_1d) for d in range(dim)])
         else:
             # If we are here, you gave us an impact vector directly
             # Let's check that its dimension matches
             assert (impact.shape[0] == dim * self.vertices.shape[0])
             # We obviously won't use wave propagation if you already gave us an impact
             wave = False
-
-        # This is just to mimic MATLAB's blockdiag function later
-        blockdiag_kron = eye(dim)
-
-        # We use the information from our precomputation step to project the impact onto the best (LS) constant-per-piece impact
-        if wave:
-            # self.piece_impact = self.wave_piece_lsqr.T @ kron(blockdiag_kron,self.M) @ self.impact
-            self.piece_impact = self.wave_piece_lsqr.T @ self.impact
-        else:
-            self.piece_impact = kron(blockdiag_kron, self.tet_to_piece_matrix @ self.massmatrix) @ self.impact
+            self.impact_indeces = np.nonzero(impact)[0]
+            self.impact_values = impact[self.impact_indeces]
+            self.impact_size = impact.shape[0]
+            # This is just to mimic MATLAB's blockdiag function
+            blockdiag_kron = eye(dim)
+            self.piece_impact = kron(blockdiag_kron, self.tet_to_piece_matrix @ self.massmatrix) @ impact
 
         # However, not all constant-per-piece impacts are actually spanned by our modes (pieces can be linked and only break if others do, etc.), so if we want to project directly onto our modes, we need to do this extra step (note everything is happening per-piece, so the complexity of this loop is O(num_pieces*num_modes), irrespective of mesh size)
         if project_on_modes:
@@ -313,6 +646,7 @@ class FractureModes:
         piece_distances = np.linalg.norm(
             np.reshape(self.projected_impact, (-1, dim), order='F')[self.piece_neighbors[:, 0], :] -
             np.reshape(self.projected_impact, (-1, dim), order='F')[self.piece_neighbors[:, 1], :], axis=1)
+        self.piece_distances = piece_distances  # (see impact_hierarchy)
         # Use these distances and our threshold parameter to decide which pieces break off from which pieces
         piece_neighbors_after_impact = self.piece_neighbors[piece_distances < threshold, :]
         # Build an impact-dependent piece adjancency graph
@@ -324,35 +658,139 @@ class FractureModes:
         debug_distances = csr_matrix((piece_distances, (self.piece_neighbors[:, 0], self.piece_neighbors[:, 1])),
                                      shape=(self.precomputed_num_pieces, self.precomputed_num_pieces))
         # Get connected components of adjacency graph to know per-piece labels
-        self.n_pieces_after_impact, self.piece_labels_after_impact = connected_components(
+        n_pieces_after_impact, piece_labels_after_impact = connected_components(
             piece_piece_adjacency_after_impact, directed=False)
 
         # Strictly speaking, this finishes our impact computation: for each piece, we've decided whether it breaks off or not.
-        self.impact_projected = True
         self.t_impact = round(toc(silence=True), 5)  # Save and print runtime
         if self.verbose:
-            print(f"Impact projection: {self.t_impact} seconds. Produced {self.n_pieces_after_impact} pieces.")
-
-        # Still there's a little more information we may want to gather outside of the strict impact projection to display our fracture.
+            print(f"Impact projection: {self.t_impact} seconds. Produced {n_pieces_after_impact} pieces.")
+
+        # Still there's a little more information we may want to gather outside of the strict impact projection to display our fracture (tet labels, fine mesh labels and the impact itself). None of it is needed to fracture, so it is only computed when accessed (see the properties below).
+        self.set_piece_labels_after_impact(piece_labels_after_impact)
+        self.impact_wave = wave
+        self.impact_dim = dim
+        self._impact_vis = None
+
+    @property
+    def impact(self):
+        # The last impact as a full vector (we only store its nonzero entries)
+        impact = np.zeros(self.impact_size)
+        impact[self.impact_indeces] = self.impact_values
+        return impact
+
+    @property
+    def impact_vis(self):
+        # The last projected impact, so we can visualize it. Of course, if you gave us an impact vector, we already have that. If we used a Gaussian to blur the impact from the contact point, then we had to compute this impact for the projection step.
+        if self._impact_vis is None:
+            dim = self.impact_dim
+            # Make it n by dim so that it can easily be added to vertex positions
+            impact = np.reshape(self.impact, (-1, dim), order='F')
+            if self.impact_wave:
+                # But if we used the wave equation, we have never actually computed our wave-equation-blurred impact A^{-1} M onehot, since that would involve a linear solve (see precomputation). So, if we want to visualize the wave impact, we need to actually do that linear solve, one dimension at a time with the factorization of A:
+                # u = C (M - hL)^{-1} M d
+                if self.A_solver is None:
+                    self.A_solver = factorized(csc_matrix(self.A))
+                self._impact_vis = np.column_stack([self.A_solver(self.M @ impact[:, d]) for d in range(dim)])
+            else:
+                self._impact_vis = impact.copy()
+        return self._impact_vis
 
+    @property
+    def tet_labels_after_impact(self):
         # Now that we know per-piece labels, we can transfer this labels to tets
-        self.tet_labels_after_impact = self.piece_to_tet_matrix @ self.piece_labels_after_impact  # O(tets)
+        if self._tet_labels_after_impact is None:
+            self._tet_labels_after_impact = self.piece_to_tet_matrix @ self.piece_labels_after_impact  # O(tets)
+        return self._tet_labels_after_impact
 
+    @property
+    def fine_vertex_labels_after_impact(self):
         # We can also compute labels in the fine mesh, if we're using a cage
-        if self.fine_vertices is not None:
-            self.fine_vertex_labels_after_impact = self.piece_to_fine_vertices_matrix @ self.piece_labels_after_impact
+        if self._fine_vertex_labels_after_impact is None and self.has_fine_mesh():
+            self._fine_vertex_labels_after_impact = self.piece_to_fine_vertices_matrix @ self.piece_labels_after_impact
+        return self._fine_vertex_labels_after_impact
+
+    def impact_hierarchy(self):
+        # Returns the fracture hierarchy of the last projected impact, from which the fracture for any threshold (or any number of pieces) can be read without calling impact_projection again, e.g.
+        #     n_pieces, piece_labels = modes.impact_hierarchy().labels(threshold)
+        #     modes.set_piece_labels_after_impact(piece_labels)
+        assert self.impact_projected
+        return FractureHierarchy(self.piece_neighbors, self.piece_distances, self.precomputed_num_pieces)
 
-        # We may also want to save the impact so we can visualize it. Of course, if you gave us an impact vector, we already have that. If we used a Gaussian to blur the impact from the contact point, then we had to compute this impact for the projection step.        
+    def set_piece_labels_after_impact(self, piece_labels_after_impact):
+        # Makes piece_labels_after_impact the current fracture (e.g., one column of the output of impact_projection_batch), so that the write_segmented_output functions write it
+        self.piece_labels_after_impact = piece_labels_after_impact
+        self.n_pieces_after_impact = int(np.max(piece_labels_after_impact)) + 1
+        self.impact_projected = True
+        # Tet and fine mesh labels will be recomputed from these when accessed
+        self._tet_labels_after_impact = None
+        self._fine_vertex_labels_after_impact = None
+
+    def impact_projection_batch(self, contact_points, directions=np.array([1]), thresholds=0.02, wave=True,
+                                target_num_pieces=None):
+        # Same as impact_projection (without project_on_modes) for many contact points at once. Instead of one sparse product and one connected components call per impact, we do one of each for all of them.
+        # contact_points is num_impacts by 3, directions is either dim or num_impacts by dim and thresholds is either a number or num_impacts.
+        # Returns the number of pieces of each impact and a precomputed_num_pieces by num_impacts matrix of piece labels, where column i is what impact_projection would have put in piece_labels_after_impact for impact i.
+        # If target_num_pieces is given, thresholds is ignored and each impact uses the smallest threshold that breaks the shape into at most target_num_pieces pieces (see FractureHierarchy).
+        if not self.impact_precomputed:
+            self.impact_precomputation()
+        tic()
+        dim = self.modes.shape[0] // self.elements.shape[0]  # mode dimension
+        contact_points = np.reshape(contact_points, (-1, 3))
+        num_impacts = contact_points.shape[0]
+        num_pieces = self.precomputed_num_pieces
+        directions = np.broadcast_to(np.reshape(directions, (-1, dim)), (num_impacts, dim))
+        thresholds = np.broadcast_to(thresholds, (num_impacts,))
+
+        # Which vertices (wave) or tets (Gaussian) each impact touches, from the spatial indeces built in impact_precomputation
         if wave:
-            # But if we used the wave equation, we have never actually computed our wave-equation-blurred impact A^{-1} M onehot, since that would involve a linear solve (see precomputation). So, if we want to visualize the wave impact, we need to actually do that linear solve:
-            # self.impact_vis = spsolve(kron(blockdiag_kron,self.A),kron(blockdiag_kron,self.M) @ self.impact)
-            # u = C (M - hL)^{-1} M d
-            self.impact_vis = spsolve(kron(blockdiag_kron, self.A), kron(blockdiag_kron, self.M) @ self.impact)
+            close = self.vertex_tree.query_ball_point(contact_points, self.impact_radius)
         else:
-            self.impact_vis = self.impact.copy()
-
-        # Make it n by dim so that it can easily be added to vertex positions
-        self.impact_vis = np.reshape(self.impact_vis, (-1, dim), order='F')
+            close = self.element_tree.query_ball_point(contact_points, self.impact_support * self.impact_sigma)
+        support = np.concatenate([np.array(indeces, dtype=int) for indeces in close] + [np.zeros(0, dtype=int)])
+        impact_indeces = np.repeat(np.arange(num_impacts), [len(indeces) for indeces in close])
+        if wave:
+            # All the onehot vectors of impact_projection, as columns of one sparse matrix, restricted to the rows of wave_piece_lsqr they touch
+            rows = np.concatenate([support + d * self.vertices.shape[0] for d in range(dim)])
+            weights = np.concatenate([directions[impact_indeces, d] for d in range(dim)])
+            impacts = csc_matrix((weights, (np.arange(rows.shape[0]), np.tile(impact_indeces, dim))),
+                                 shape=(rows.shape[0], num_impacts))
+            piece_impacts = self.wave_piece_lsqr[rows, :].T @ impacts
+        else:
+            # Same with the Gaussian, which we only evaluate where it is not negligible
+            values = np.reshape(self.rv.pdf(self.vertices[self.elements[support, 0], :] - contact_points[impact_indeces, :]), -1)
+            impacts_1d = csc_matrix((values, (np.arange(support.shape[0]), impact_indeces)),
+                                    shape=(support.shape[0], num_impacts))
+            tet_to_piece_mass_matrix = self.tet_to_piece_mass_matrix[:, support]
+            piece_impacts = vstack([tet_to_piece_mass_matrix @ impacts_1d @ diags(directions[:, d]) for d in range(dim)])
+        if issparse(piece_impacts):
+            piece_impacts = piece_impacts.toarray()
+        piece_impacts = np.reshape(np.asarray(piece_impacts), (dim, num_pieces, num_impacts))
+
+        # Per-impact distances between neighboring pieces, as in impact_projection
+        piece_distances = np.linalg.norm(piece_impacts[:, self.piece_neighbors[:, 0], :] -
+                                         piece_impacts[:, self.piece_neighbors[:, 1], :], axis=0)
+        if target_num_pieces is not None:
+            thresholds = np.array([FractureHierarchy(self.piece_neighbors, piece_distances[:, i],
+                                                     num_pieces).threshold_for_num_pieces(target_num_pieces)
+                                   for i in range(num_impacts)])
+        edge_indeces, impact_indeces = np.nonzero(piece_distances < thresholds[None, :])
+        # One big graph with a copy of the piece graph per impact: piece j of impact i is node i*num_pieces+j
+        rows = impact_indeces * num_pieces + self.piece_neighbors[edge_indeces, 0]
+        cols = impact_indeces * num_pieces + self.piece_neighbors[edge_indeces, 1]
+        piece_piece_adjacency_after_impacts = csr_matrix((np.ones(rows.shape[0]), (rows, cols)),
+                                                         shape=(num_impacts * num_pieces, num_impacts * num_pieces),
+                                                         dtype=int)
+        _, labels = connected_components(piece_piece_adjacency_after_impacts, directed=False)
+        # Components are labeled in node order and the copies are disconnected from one another, so each impact's labels are consecutive. Shift them to start at zero:
+        labels = np.reshape(labels, (num_impacts, num_pieces)).T
+        labels = labels - labels[0, :]
+        n_pieces_after_impacts = np.max(labels, axis=0) + 1
+
+        self.t_impact = round(toc(silence=True), 5)
+        if self.verbose:
+            print(f"Batch impact projection: {self.t_impact} seconds for {num_impacts} impacts.")
+        return n_pieces_after_impacts, labels
 
     def write_generic_data_compressed(self, filename):
         write_file_name = os.path.join(filename, "compressed_mesh.ply")
@@ -361,18 +799,24 @@ class FractureModes:
         # igl.write_obj(write_file_name, self.fine_vertices, self.fine_triangles)
         save_npz(write_data_name, self.piece_to_fine_vertices_matrix)
 
+    def partition_hash(self):
+        # Identifies the precomputed pieces, which compressed fractures are labels of
+        return hash_arrays(self.all_modes_labels)
+
+    def fracture_archive(self, output_file_base, name='fractures', mode='a'):
+        # Archive of compressed fractures in the directory output_file_base (see FractureArchive). When writing many fractures, open it once and append them to it. Appending raises a ValueError if the archive has fractures of other pieces
+        return FractureArchive(output_file_base, name, num_pieces=self.precomputed_num_pieces, mode=mode,
+                               partition=self.partition_hash())
+
     def write_segmented_output_compressed(self, output_file_base=None):
-        write_fracture_name = os.path.join(output_file_base, f"compressed_fractures_{self.piece_labels_after_impact}_{uuid.uuid4().hex}.npy")
-        os.makedirs(output_file_base, exist_ok=True)
-        np.save(write_fracture_name, self.piece_labels_after_impact)
+        # Appends the current fracture to the fracture archive in output_file_base
+        with self.fracture_archive(output_file_base) as archive:
+            archive.append(self.piece_labels_after_impact)
 
     def write_segmented_modes_compressed(self, output_file_base=None):
-        for j in range(self.modes.shape[1]):
-            new_dir = os.path.join(output_file_base, f"mode_{j}_{uuid.uuid4().hex}")
-            write_modes_name = os.path.join(new_dir, "compressed_modes.npy")
-            mode_labels = self.piece_labels[:, j]
-            os.makedirs(new_dir)
-            np.save(write_modes_name, mode_labels)
+        # Writes the labels of every mode to the 'modes' archive in output_file_base (mode j is archive[j])
+        with self.fracture_archive(output_file_base, name='modes', mode='w') as archive:
+            archive.append(self.piece_labels.astype(int))
 
     def write_segmented_output(self, output_file_base=None, pieces=True):
         # All this routine is doing is write the fractured output, as a triangle mesh with num_broken_pieces connected components, so you can load it into an animation in another software. If you gave our algorithm a fine mesh, it will write the fractured fine mesh directly.
@@ -384,29 +828,50 @@ class FractureModes:
         # self.piece_labels_after_impact
 
         assert self.impact_projected
-        self.fine_vertex_labels_after_impact = self.piece_to_fine_vertices_matrix @ self.piece_labels_after_impact
-        Vs = []
-        Fs = []
+        self.mesh_to_write_vertices, self.mesh_to_write_triangles = self.write_fracture(
+            self.piece_labels_after_impact, output_file_base=output_file_base, pieces=pieces)
+
+    def write_fracture(self, piece_labels, output_file_base=None, pieces=True):
+        # Does the work of write_segmented_output for any per-piece labels (e.g., a column of the output of impact_projection_batch), without touching the current fracture. This doesn't change self, so several threads can write different fractures at once (see FractureWriter)
+        # Returns the fractured mesh, which has no triangles if there was nothing to write (in which case nothing is written)
+        n_pieces = int(np.max(piece_labels)) + 1
+        Vs = [np.zeros((0, 3))]
+        Fs = [np.zeros((0, 3), dtype=int)]
         running_n = 0  # for combining meshes
         output_dir = None
         if pieces:
-            output_dir = os.path.join(output_file_base,
-                                      f"fractured_{self.n_pieces_after_impact}_{uuid.uuid4().hex}")
-        for i in range(self.n_pieces_after_impact):
-            if self.fine_vertices is not None:
-                tri_labels = self.fine_vertex_labels_after_impact[self.fine_triangles[:, 0]]
-                if np.any(tri_labels == i):
-                    vi, fi = igl.remove_unreferenced(self.fine_vertices, self.fine_triangles[tri_labels == i, :])[:2]
-                else:
-                    continue
+            output_dir = os.path.join(output_file_base, f"fractured_{n_pieces}_{uuid.uuid4().hex}")
+        lazy = self.fine_piece_cache is not None and self._fine_vertices is None
+        # (hollow pieces already have the interior subtracted, see impact_precomputation)
+        hollow = pieces and self.hollow_vertices is not None
+        if hollow:
+            fine_meshes = split_by_label(self.hollow_vertices, self.hollow_triangles,
+                                         piece_labels[self.hollow_triangle_pieces], n_pieces)
+        elif not lazy and self.fine_vertices is not None:
+            # Split the (welded) fine mesh into all the output pieces at once
+            tri_labels = (self.piece_to_fine_vertices_matrix @ piece_labels)[self.fine_triangles[:, 0]]
+            fine_meshes = split_by_label(*self.welded_fine_mesh(), tri_labels, n_pieces)
+        else:
+            tet_labels = self.piece_to_tet_matrix @ piece_labels
+        for i in range(n_pieces):
+            if hollow or (not lazy and self.fine_vertices is not None):
+                ui, gi = fine_meshes[i]
+            elif lazy:
+                # If the fine mesh hasn't been assembled, we only gather the fine pieces we need
+                vi, fi = self.fine_piece_mesh(np.nonzero(piece_labels == i)[0])
+                ui, I, J, _ = igl.remove_duplicate_vertices(vi, fi, 1e-10)
+                gi = np.reshape(J, (-1,))[fi]
             else:
-                vi, ti = igl.remove_unreferenced(self.vertices, self.elements[self.tet_labels_after_impact == i, :])[:2]
+                vi, ti = igl.remove_unreferenced(self.vertices, self.elements[tet_labels == i, :])[:2]
                 fi = boundary_faces_fixed(ti)
-            ui, I, J, _ = igl.remove_duplicate_vertices(vi, fi, 1e-10)
-            gi = J[fi]
+                ui, I, J, _ = igl.remove_duplicate_vertices(vi, fi, 1e-10)
+                gi = np.reshape(J, (-1,))[fi]
+            # Pieces without triangles are not written
+            if gi.shape[0] == 0:
+                continue
 
             if pieces:
-                if self.v_interior is not None and self.f_interior is not None:
+                if not hollow and self.v_interior is not None and self.f_interior is not None:
                     ui, gi = mesh_boolean(ui, gi.astype(np.int32), self.v_interior, self.f_interior.astype(np.int32),
                                           boolean_type='difference')
                 write_file_name = os.path.join(output_dir, f"piece_{i}.ply")
@@ -417,11 +882,30 @@ class FractureModes:
             Vs.append(ui)
             Fs.append(gi + running_n)
             running_n = running_n + ui.shape[0]
-        self.mesh_to_write_vertices = np.vstack(Vs)
-        self.mesh_to_write_triangles = np.vstack(Fs)
-        if output_file_base and not pieces:
-            igl.write_triangle_mesh(output_file_base, self.mesh_to_write_vertices, self.mesh_to_write_triangles, force_ascii=False)
+        mesh_vertices = np.vstack(Vs)
+        mesh_triangles = np.vstack(Fs)
+        if output_file_base and not pieces and mesh_triangles.shape[0] > 0:
+            igl.write_triangle_mesh(output_file_base, mesh_vertices, mesh_triangles, force_ascii=False)
             # igl.write_obj(filename, self.mesh_to_write_vertices, self.mesh_to_write_triangles)
+        return mesh_vertices, mesh_triangles
+
+    def welded_fine_mesh(self):
+        # The fine mesh with duplicate vertices merged, which we use to write fractures (see split_by_label). It only depends on the fine mesh, so we compute it once
+        if self._welded_fine_mesh is None:
+            self._welded_fine_mesh = weld_mesh(self.fine_vertices, self.fine_triangles)
+        return self._welded_fine_mesh
+
+    def fine_piece_mesh(self, piece_indeces):
+        # Fine mesh of a set of pieces, the same as taking the triangles of those pieces in fine_triangles (but without assembling the whole fine mesh)
+        running_n = 0  # for combining meshes
+        Vs = [np.zeros((0, 3))]
+        Fs = [np.zeros((0, 3), dtype=int)]
+        for j in piece_indeces:
+            vi_fine, fi_fine = self.fine_piece_cache[int(j)]
+            Vs.append(vi_fine)
+            Fs.append(fi_fine + running_n)
+            running_n = running_n + vi_fine.shape[0]
+        return np.vstack(Vs), np.vstack(Fs)
 
     def write_segmented_modes(self, output_file_base=None, pieces=False):
         for j in tqdm(range(self.modes.shape[1]), desc="Writing segmented modes"):
@@ -436,19 +920,21 @@ class FractureModes:
             if len(self.fine_labels[:, j]) == 0:
                 print(f"Mode {j} has no labels, skipping writing.")
                 continue
-            for i in range(np.max(self.fine_labels[:, j]) + 1):
-                # Double check this loop limit
-                if self.fine_vertices is not None:
-                    tri_labels = self.fine_labels[self.fine_triangles[:, 0], j]
-                    if np.any(tri_labels == i):
-                        vi, fi = igl.remove_unreferenced(self.fine_vertices,
-                                                         self.fine_triangles[tri_labels == i, :])[:2]
-                    else:
-                        continue
-                ui, I, J, _ = igl.remove_duplicate_vertices(vi, fi, 1e-10)
-                gi = J[fi]
+            # Double check this loop limit
+            num_labels = np.max(self.fine_labels[:, j]) + 1
+            hollow = pieces and self.hollow_vertices is not None
+            if hollow:
+                fine_meshes = split_by_label(self.hollow_vertices, self.hollow_triangles,
+                                             self.piece_labels[self.hollow_triangle_pieces, j].astype(int), num_labels)
+            else:
+                tri_labels = self.fine_labels[self.fine_triangles[:, 0], j]
+                fine_meshes = split_by_label(*self.welded_fine_mesh(), tri_labels, num_labels)
+            for i in range(num_labels):
+                ui, gi = fine_meshes[i]
+                if gi.shape[0] == 0:
+                    continue
                 if pieces:
-                    if self.v_interior is not None and self.f_interior is not None:
+                    if not hollow and self.v_interior is not None and self.f_interior is not None:
                         ui, gi = mesh_boolean(ui, gi.astype(np.int32), self.v_interior,
                                               self.f_interior.astype(np.int32), boolean_type='difference')
                     write_file_name = os.path.join(pieces_dir, f"piece_{i}.ply")
@@ -1,8 +1,31 @@
 class FractureModesParameters:
-    def __init__(self, num_modes=10, d=1, max_iter=10, tol=1e-4, omega=0.01, verbose=False):
+    def __init__(self, num_modes=10, d=1, max_iter=10, tol=1e-4, omega=0.01, verbose=False, solver='mosek',
+                 solver_tol=1e-6, solver_max_iter=5000, num_quad=1, checkpoint_dir=None,
+                 time_budget=None, max_solves=None, loose_solver_tol=None, loose_solver_max_iter=None,
+                 solver_tol_factor=0.1, eigen_backend='auto', eigen_preconditioner=None, eigen_tol=1e-5):
         self.num_modes = num_modes
         self.d = d
         self.max_iter = max_iter
         self.tol = tol
         self.omega = omega
         self.verbose = verbose
+        # Conic solver backend: 'mosek' (needs a license) or 'admm' (pure NumPy/SciPy)
+        self.solver = solver
+        # Relative accuracy and iteration cap of the 'admm' backend
+        self.solver_tol = solver_tol
+        self.solver_max_iter = solver_max_iter
+        # Quadrature points per internal face in the discontinuity matrix (1 or 3)
+        self.num_quad = num_quad
+        # Directory to save every mode to as soon as it is computed, so that an interrupted run resumes from there (see ModeCheckpoint)
+        self.checkpoint_dir = checkpoint_dir
+        # Seconds and number of conic solves the mode computation may take at most. Once either runs out, it stops and returns the modes it finished (see solve_fracture_modes)
+        self.time_budget = time_budget
+        self.max_solves = max_solves
+        # Solver accuracy schedule (see solve_fracture_modes): if loose_solver_tol is given, the first conic solve of each mode only has that relative accuracy (and at most loose_solver_max_iter iterations), and every later one solver_tol_factor times as much (or times the last change in the mode, if smaller), until that is below solver_tol and we solve to full accuracy
+        self.loose_solver_tol = loose_solver_tol
+        self.loose_solver_max_iter = loose_solver_max_iter
+        self.solver_tol_factor = solver_tol_factor
+        # Laplacian eigensolver for the initial guesses (see LaplacianEigensolver): 'shift_invert' (direct factorization), 'lobpcg' (preconditioned, for large meshes, with eigen_preconditioner 'amg' (needs pyamg) or 'ilu' and relative accuracy eigen_tol) or 'auto' (by mesh size)
+        self.eigen_backend = eigen_backend
+        self.eigen_preconditioner = eigen_preconditioner
+        self.eigen_tol = eigen_tol
@@ -0,0 +1,95 @@
+# Include existing libraries
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class FractureWriter:
+    """Writes the fractures of a `FractureModes` object in the background.
+
+    `submit` hands the per-piece labels of one fracture (e.g., a column of the output of `impact_projection_batch`) to a pool of `num_workers` writer threads, which extract its meshes and write them to `output_dir` (see `FractureModes.write_fracture`), so that projecting impacts and writing files overlap. Compressed fractures are just appended to the fracture archive in `output_dir` (see `FractureArchive`), which is cheap enough to do right away. At most `max_pending` fractures are queued or being written at once: beyond that, `submit` waits for a write to finish. If a write fails, its exception is raised in the submitting thread by the next call to `submit`, `wait` or `close`. Use it as a context manager, so that it is closed (waiting for every write) when done.
+
+    Parameters
+    ----------
+    modes : FractureModes
+        Object whose fractures we write (after `impact_precomputation`)
+    output_dir : str
+        Directory to write the fractures in
+    compressed : bool (optional, default True)
+        Whether to only write the labels of each fracture (to a `FractureArchive`) instead of its meshes
+    num_workers : int (optional, default 1)
+        Number of writer threads
+    max_pending : int (optional, default 2*num_workers)
+        Maximum number of fractures waiting to be written
+    archive : FractureArchive (optional, default None)
+        Archive to append compressed fractures to, if the caller already opened it (it is closed with the writer). By default, the one in output_dir
+    """
+
+    def __init__(self, modes, output_dir, compressed=True, num_workers=1, max_pending=None, archive=None):
+        self.modes = modes
+        self.output_dir = output_dir
+        self.compressed = compressed
+        if max_pending is None:
+            max_pending = 2 * num_workers
+        self.max_pending = max(max_pending, 1)
+        # Fractures that were written, and fractures that had no triangles so nothing was written
+        self.num_written = 0
+        self.num_empty = 0
+        self.pending = set()
+        self.archive = archive
+        if compressed and archive is None:
+            self.archive = modes.fracture_archive(output_dir)
+        elif modes.fine_piece_cache is None and modes.fine_vertices is not None:
+            # Weld the fine mesh once here, instead of in every thread that needs it
+            modes.welded_fine_mesh()
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def write(self, piece_labels):
+        # Runs in a writer thread. Returns whether anything was written
+        _, mesh_triangles = self.modes.write_fracture(piece_labels, output_file_base=self.output_dir, pieces=True)
+        return mesh_triangles.shape[0] > 0
+
+    def submit(self, piece_labels):
+        if self.archive is not None:
+            self.archive.append(piece_labels)
+            self.num_written += 1
+            return
+        while len(self.pending) >= self.max_pending:
+            self.wait()
+        self.pending.add(self.executor.submit(self.write, piece_labels.copy()))
+
+    def wait(self):
+        # Waits for at least one pending write to finish (if any)
+        if not self.pending:
+            return
+        done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.result():
+                self.num_written += 1
+            else:
+                self.num_empty += 1
+
+    def num_pending(self):
+        return len(self.pending)
+
+    def close(self):
+        # Waits for every pending write
+        while self.pending:
+            self.wait()
+        self.executor.shutdown()
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Something went wrong: drop whatever hasn't started and don't hide the original error
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+            # (whatever made it to the archive is still valid)
+            if self.archive is not None:
+                self.archive.close()
+        return False
@@ -11,6 +11,8 @@ from tqdm import tqdm
 
 from .fracture_modes import FractureModes
 from .fracture_modes_parameters import FractureModesParameters
+from .fracture_writer import FractureWriter
+from .stage_cache import StageCache, hash_file, stage_key
 
 
 def normalize_points(v, v_interior=None, center=None):
@@ -74,8 +76,25 @@ def normalize_points(v, v_interior=None, center=None):
 
     return v, None
 
+
+def run_stage(cache, key, compute, keep=None):
+    # Runs one stage of generate_fractures, unless its output is in the cache already. If keep is given, the output is only cached if keep() says so (e.g., not partial modes)
+    if cache is None:
+        return compute()
+    if keep is None:
+        return cache.get_or_compute(key, compute)
+    arrays = cache.get(key)
+    if arrays is None:
+        arrays = compute()
+        if keep():
+            cache.put(key, arrays)
+    return arrays
+
+
 def generate_fractures(input_dir, interior_filename=None, num_modes=20, num_impacts=80, output_dir=None, verbose=True,
-                       compressed=True, cage_size=4000, volume_constraint=(1 / 50)):
+                       compressed=True, cage_size=4000, volume_constraint=(1 / 50), cache_dir=None,
+                       cache_size=20 * 2 ** 30, target_num_pieces=None, num_workers=1, num_writers=1,
+                       checkpoint_dir=None, mode_time_budget=None, mode_max_solves=None):
     """Randomly generate different fractures of a given object and write them to an output directory.
     
     Parameters
@@ -89,42 +108,85 @@ def generate_fractures(input_dir, interior_filename=None, num_modes=20, num_impa
     output_dir : str (optional, default None)
         Path to the directory where all the fractures will be written
     compressed : bool (optional, default True)
-        Whether to write the fractures as compressed .npy files instead of .obj. Needs to use `decompress.py` to decompress them afterwards.
+        Whether to write the fractures compressed, as one archive of per-piece labels (see `FractureArchive`) instead of meshes. Needs to use `decompress.py` to decompress them afterwards.
     cage_size : int (optional, default 4000)
         Number of faces in the simulation mesh used
     volume_constraint : double (optional, default 0)
         Will only consider fractures with minimum piece volume larger than volume_constraint times the volume of the input. Values over 0.01 may severely delay runtime.
+    cache_dir : str (optional, default None)
+        If given, the normalized mesh, cage, tet mesh, fracture modes and impact precomputation are cached in this directory, keyed by the contents of the input files and all stage parameters. Repeated runs on the same input then skip straight to impact sampling.
+    cache_size : int (optional, default 20GB)
+        Maximum size of the cache in bytes. Least recently used entries are evicted beyond it.
+    target_num_pieces : int (optional, default None)
+        If given, instead of using a fixed threshold, each impact uses the smallest threshold that breaks the object into at most this many pieces.
+    num_workers : int (optional, default 1)
+        Number of processes used to intersect the input mesh with the precomputed pieces
+    num_writers : int (optional, default 1)
+        Number of threads writing fractures to output_dir while the next impacts are projected (see `FractureWriter`)
+    checkpoint_dir : str (optional, default None)
+        If given, every fracture mode is saved in this directory as soon as it is computed, and a run that was interrupted while computing the modes resumes after the last one it saved (see `ModeCheckpoint`)
+    mode_time_budget : double (optional, default None)
+        If given, the fracture modes are computed for at most this many seconds (plus the length of one conic solve). If that's not enough for num_modes modes, the fractures are generated from the modes computed until then, which are not cached (with checkpoint_dir, a later run carries on from them). If not a single mode was computed, no fractures are generated.
+    mode_max_solves : int (optional, default None)
+        Same as mode_time_budget, but limiting the number of conic solves instead
     """
 
     # directory = os.fsencode(input_dir)
     # np.random.seed(0)
     # for file in os.listdir(directory):
     filename = input_dir
+    filename_without_extension = os.path.splitext(os.path.basename(filename))[0]
     t0 = time.time()
+    # Every stage below only depends on the input files and the stage parameters, so it can be cached across runs
+    cache = None
+    mesh_key = None
+    if cache_dir is not None:
+        cache = StageCache(cache_dir, max_size=cache_size)
+        mesh_key = stage_key('mesh', hash_file(filename),
+                             None if interior_filename is None else hash_file(interior_filename))
     # try:
     t00 = time.time()
-    v_fine, f_fine = igl.read_triangle_mesh(filename)
-    v_interior, f_interior = None, None
-    if interior_filename is not None:
-        v_interior, f_interior = igl.read_triangle_mesh(interior_filename)
-    # Let's normalize it so that parameter choice makes sense
-    v_fine, v_interior = normalize_points(v_fine, v_interior)
+
+    def read_stage():
+        v_fine, f_fine = igl.read_triangle_mesh(filename)
+        v_interior, f_interior = None, None
+        if interior_filename is not None:
+            v_interior, f_interior = igl.read_triangle_mesh(interior_filename)
+        # Let's normalize it so that parameter choice makes sense
+        v_fine, v_interior = normalize_points(v_fine, v_interior)
+        return {'v_fine': v_fine, 'f_fine': f_fine, 'v_interior': v_interior, 'f_interior': f_interior}
+
+    stage = run_stage(cache, mesh_key, read_stage)
+    v_fine, f_fine, v_interior, f_interior = stage['v_fine'], stage['f_fine'], stage['v_interior'], stage['f_interior']
     t01 = time.time()
     reading_time = t01 - t00
     if verbose:
         print(f"Read shape in {reading_time} seconds.")
     # Build cage mesh (this may actually be the bottleneck...)
     t10 = time.time()
-    v, f = lazy_cage(v_fine, f_fine, num_faces=cage_size, grid_size=256)
+    cage_key = stage_key(mesh_key, 'cage', cage_size, 256)
+
+    def cage_stage():
+        v, f = lazy_cage(v_fine, f_fine, num_faces=cage_size, grid_size=256)
+        return {'v': v, 'f': f}
+
+    stage = run_stage(cache, cage_key, cage_stage)
+    v, f = stage['v'], stage['f']
     t11 = time.time()
     cage_time = t11 - t10
     if verbose:
         print(f"Built cage in {cage_time} seconds.")
     # Tetrahedralize cage mesh
     t20 = time.time()
-    tgen = tetgen.TetGen(v, f)
+    tet_key = stage_key(cage_key, 'tetrahedralize', 1.5)
 
-    nodes, elements = tgen.tetrahedralize(minratio=1.5)
+    def tet_stage():
+        tgen = tetgen.TetGen(v, f)
+        nodes, elements = tgen.tetrahedralize(minratio=1.5)
+        return {'nodes': nodes, 'elements': elements}
+
+    stage = run_stage(cache, tet_key, tet_stage)
+    nodes, elements = stage['nodes'], stage['elements']
     t21 = time.time()
     tet_time = t21 - t20
     if verbose:
@@ -134,15 +196,49 @@ def generate_fractures(input_dir, interior_filename=None, num_modes=20, num_impa
     t30 = time.time()
     modes = FractureModes(nodes, elements, v_interior, f_interior)
     # Set parameters for call to fracture modes
-    params = FractureModesParameters(num_modes=num_modes, verbose=False, d=1)
-    # Compute fracture modes. This should be the bottleneck:
-    modes.compute_modes(parameters=params)
-    modes.impact_precomputation(v_fine=v_fine, f_fine=f_fine)
+    params = FractureModesParameters(num_modes=num_modes, verbose=False, d=1, checkpoint_dir=checkpoint_dir,
+                                     time_budget=mode_time_budget, max_solves=mode_max_solves)
+    # (a budget doesn't change the modes, only whether we get all of them, and partial modes are never cached)
+    modes_key = stage_key(tet_key, 'modes', {name: value for name, value in vars(params).items()
+                                             if name not in ('verbose', 'checkpoint_dir', 'time_budget', 'max_solves')})
+
+    def modes_stage():
+        # Compute fracture modes. This should be the bottleneck:
+        modes.compute_modes(parameters=params)
+        return modes.get_state(modes.modes_state_names)
+
+    def complete_modes():
+        return not modes.partial_modes
+
+    modes.set_modes_state(run_stage(cache, modes_key, modes_stage, keep=complete_modes))
+    if modes.modes.shape[1] == 0:
+        # Nothing can break without modes
+        print(f"Could not compute any fracture mode of {filename_without_extension} within the budget, "
+              f"so no fractures were generated.")
+        return
+    if modes.partial_modes:
+        print(f"Only computed {modes.modes.shape[1]} of {num_modes} fracture modes within the budget, "
+              f"generating fractures from those.")
+    precomputation_key = stage_key(modes_key, 'precomputation', FractureModes.save_format_version)
+
+    def precomputation_stage():
+        # (the per-piece intersections are cached too, so they are reused when the modes change but some pieces don't)
+        modes.impact_precomputation(v_fine=v_fine, f_fine=f_fine, num_workers=num_workers, cache_dir=cache_dir,
+                                    cache_size=cache_size)
+        return modes.get_state(modes.precomputation_state_names)
+
+    modes.set_precomputation_state(run_stage(cache, precomputation_key, precomputation_stage, keep=complete_modes))
 
-    filename_without_extension = os.path.splitext(os.path.basename(filename))[0]
     os.makedirs(output_dir, exist_ok=True)
 
+    archive = None
     if compressed:
+        # The fractures earlier runs appended are labels of their pieces, so this run can only add to them if it has the same pieces (not, e.g., if one of them ran out of budget for modes, or computed them without the cache). Opening the archive checks that, and keeps other runs from writing to output_dir until we are done, before we overwrite the pieces they refer to
+        try:
+            archive = modes.fracture_archive(output_dir)
+        except ValueError as error:
+            raise ValueError(f"{output_dir} has fractures of other pieces than this run's, which we won't delete. "
+                             f"Use another output_dir (or delete that one) to write these.") from error
         modes.write_generic_data_compressed(output_dir)
         modes.write_segmented_modes_compressed(output_dir)
     else:
@@ -166,37 +262,39 @@ def generate_fractures(input_dir, interior_filename=None, num_modes=20, num_impa
         t40 = time.time()
         # Loop to generate many possible fractures
         # all_labels = np.zeros((modes.precomputed_num_pieces, num_impacts), dtype=int)
-        num_generated = 0
-        with tqdm(range(P.shape[0]), desc="Generating Fractures") as pbar:
-            for i in pbar:
+        # Fractures are written in the background while we project the next ones. A fracture with nothing to write doesn't count, so we only hand out as many as we may still need
+        writer = FractureWriter(modes, output_dir, compressed=compressed, num_workers=num_writers, archive=archive)
+        # We project the contact points in batches (one batch is usually enough, since most impacts produce a valid fracture)
+        batch_size = max(num_impacts, 1)
+        with writer, tqdm(total=P.shape[0], desc="Generating Fractures") as pbar:
+            for batch_start in range(0, P.shape[0], batch_size):
                 # t400 = time.time()
-                    modes.impact_projection(contact_point=P[i, :], direction=np.array([1.0]), threshold=10)
-                # min_volume = volume_constraint * total_vol / modes.n_pieces_after_impact
-                # current_min_volume = total_vol
-                # for i in range(modes.n_pieces_after_impact):
-                #     current_min_volume = min(current_min_volume, np.sum(vols[modes.tet_labels_after_impact == i]))
-                # valid_volume = (current_min_volume >= min_volume)
-                # t401 = time.time()
-                # # if verbose:
-                # #     print("Impact simulation: ",round(t401-t400,3),"seconds.")
-                # new = not (modes.piece_labels_after_impact.tolist() in all_labels.T.tolist())
-                # # print(modes.piece_labels_after_impact.tolist() in all_labels.T.tolist())
-                # if 1 < modes.n_pieces_after_impact < 100 and new and valid_volume:
-                #     all_labels[:, running_num] = modes.piece_labels_after_impact
-                    try:
-                        if compressed:
-                            modes.write_segmented_output_compressed(output_file_base=output_dir)
-                        else:
-                            modes.write_segmented_output(output_file_base=output_dir, pieces=True)
-                    except ValueError:
-                        continue
-                    # t402 = time.time()
-                    # if verbose:
-                    #     print("Writing: ",round(t402-t401,3),"seconds.")
-                    num_generated += 1
-                    pbar.set_postfix_str(f"{num_generated}/{num_impacts}({num_generated / num_impacts:.2%}) impacts generated")
-                    if num_generated >= num_impacts:
+                _, batch_labels = modes.impact_projection_batch(P[batch_start:batch_start + batch_size, :],
+                                                                directions=np.array([1.0]), thresholds=10,
+                                                                target_num_pieces=target_num_pieces)
+                for i in range(batch_labels.shape[1]):
+                    while writer.num_pending() > 0 and writer.num_written + writer.num_pending() >= num_impacts:
+                        writer.wait()
+                    if writer.num_written >= num_impacts:
                         break
+                    pbar.update()
+                    # min_volume = volume_constraint * total_vol / modes.n_pieces_after_impact
+                    # current_min_volume = total_vol
+                    # for i in range(modes.n_pieces_after_impact):
+                    #     current_min_volume = min(current_min_volume, np.sum(vols[modes.tet_labels_after_impact == i]))
+                    # valid_volume = (current_min_volume >= min_volume)
+                    # t401 = time.time()
+                    # # if verbose:
+                    # #     print("Impact simulation: ",round(t401-t400,3),"seconds.")
+                    # new = not (modes.piece_labels_after_impact.tolist() in all_labels.T.tolist())
+                    # # print(modes.piece_labels_after_impact.tolist() in all_labels.T.tolist())
+                    # if 1 < modes.n_pieces_after_impact < 100 and new and valid_volume:
+                    #     all_labels[:, running_num] = modes.piece_labels_after_impact
+                    writer.submit(batch_labels[:, i])
+                    pbar.set_postfix_str(f"{writer.num_written}/{num_impacts}({writer.num_written / num_impacts:.2%}) impacts generated")
+                if writer.num_written >= num_impacts:
+                    break
+        num_generated = writer.num_written
         # print(all_labels)
         t41 = time.time()
         impact_time = t41 - t40
@@ -206,3 +304,5 @@ def generate_fractures(input_dir, interior_filename=None, num_modes=20, num_impa
         total_time = t1 - t0
         if verbose:
             print(f"Generated {num_generated} fractures for object {filename_without_extension} and wrote them into {output_dir} in {total_time} seconds.")
+    elif archive is not None:
+        archive.close()
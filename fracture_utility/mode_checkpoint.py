@@ -0,0 +1,78 @@
+# Include existing libraries
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+
+def save_atomic(path, array):
+    # np.save, but readers only ever see the old file or the whole new one (even if the machine goes down)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ModeCheckpoint:
+    """Fracture modes computed so far, so that an interrupted mode computation can resume from the last finished mode.
+
+    `solve_fracture_modes` saves every mode to `directory` as soon as it converges (see `FractureModesParameters.checkpoint_dir`), so that a crashed, killed or preempted run only loses the mode it was working on. Each mode and its piece labels are written to their own files, and then `index.json`, which lists the files of the finished modes with their iteration counts and timings, and the solver's state, is atomically replaced. A mode only counts once it is in the index, so a checkpoint is never read half-written. Every run names its files differently, so that two runs of the same computation writing to the same checkpoint (or one deleting it when it finishes) can't mix up each other's modes: the index always lists modes that were computed one after the other, and if any of its files is gone, we start over. Checkpoints of different meshes, parameters or previous modes go into different subdirectories of `directory` (named after `key`), so they can share it.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to store checkpoints in
+    key : str
+        What the modes are computed from (see `stage_key`)
+    """
+
+    def __init__(self, directory, key):
+        self.directory = os.path.join(directory, key)
+        self.index_path = os.path.join(self.directory, "index.json")
+        # Names the files of the modes this run computes
+        self.run = uuid.uuid4().hex
+        self.index = {'modes': [], 'solver_state': {}}
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def __len__(self):
+        return len(self.index['modes'])
+
+    def load(self):
+        # Modes and labels saved so far, one per column, and the solver's state after the last of them
+        try:
+            modes = [np.load(os.path.join(self.directory, info['mode_file'])) for info in self.index['modes']]
+            labels = [np.load(os.path.join(self.directory, info['labels_file'])) for info in self.index['modes']]
+        except (OSError, ValueError):
+            self.index = {'modes': [], 'solver_state': {}}
+        if len(self) == 0:
+            return None, None, {}
+        return np.column_stack(modes), np.column_stack(labels), self.index['solver_state']
+
+    def save(self, mode, labels, info, solver_state):
+        # Adds the next mode, with its per-tet labels and a dictionary info with anything else to remember about it (e.g., its number of iterations)
+        # (another run may have removed the directory in the meantime)
+        os.makedirs(self.directory, exist_ok=True)
+        k = len(self)
+        info = dict(info, mode_file=f"mode_{k}_{self.run}.npy", labels_file=f"labels_{k}_{self.run}.npy")
+        save_atomic(os.path.join(self.directory, info['mode_file']), mode)
+        save_atomic(os.path.join(self.directory, info['labels_file']), labels)
+        index = {'modes': self.index['modes'] + [info], 'solver_state': solver_state}
+        tmp_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        self.index = index
+
+    def remove(self):
+        # Deletes the checkpoint (once the modes are computed, it is of no more use)
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,244 @@
+# Include existing libraries
+import igl
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def tet_barycentric_matrices(vertices, elements):
+    # For each tet, the matrix that takes (x - first tet vertex) to the barycentric coordinates of x with respect to the other three tet vertices
+    tet_vertices = vertices[elements, :]
+    edges = np.transpose(tet_vertices[:, 1:, :] - tet_vertices[:, [0], :], (0, 2, 1))
+    return np.linalg.inv(edges)
+
+
+def barycentric(tet_inverses, tet_origins, points):
+    # All four barycentric coordinates of points (..., 3) with respect to tets given by their (matching) inverse matrices and first vertices
+    b = np.einsum('...ij,...j->...i', tet_inverses, points - tet_origins)
+    return np.concatenate((1.0 - np.sum(b, axis=-1, keepdims=True), b), axis=-1)
+
+
+def locate_points(vertices, elements, points, num_candidates=16, chunk_size=10000):
+    """Find the tet containing each point.
+
+    Candidate tets are the ones with the closest centroids. If none of them contains a point (e.g., because it is slightly outside the tet mesh), we pick the one that comes closest to containing it, in barycentric coordinates.
+
+    Parameters
+    ----------
+    vertices : (n,3) numpy double array
+        Tet mesh vertex positions
+    elements : (t,4) numpy int array
+        Tet indeces
+    points : (p,3) numpy double array
+        Query points
+    num_candidates : int (optional, default 16)
+        Number of nearest tets (by centroid) that we check for each point
+    chunk_size : int (optional, default 10000)
+        Number of points we process at a time, to bound memory use
+
+    Returns
+    -------
+    tets : (p,) numpy int array
+        Index of the tet containing each point
+    """
+    tet_inverses = tet_barycentric_matrices(vertices, elements)
+    tet_origins = vertices[elements[:, 0], :]
+    tree = cKDTree(np.mean(vertices[elements, :], axis=1))
+    tets = np.zeros(points.shape[0], dtype=int)
+    for start in range(0, points.shape[0], chunk_size):
+        chunk = points[start:start + chunk_size, :]
+        score = np.full(chunk.shape[0], -np.inf)
+        # If a point is not in any of its closest tets (this happens next to very elongated tets), we look at more of them
+        k = num_candidates
+        unsure = np.arange(chunk.shape[0])
+        while unsure.shape[0] > 0:
+            k_used = min(k, elements.shape[0])
+            candidates = np.reshape(tree.query(chunk[unsure, :], k=k_used)[1], (unsure.shape[0], k_used))
+            b = barycentric(tet_inverses[candidates], tet_origins[candidates], chunk[unsure, None, :])
+            candidate_score = np.min(b, axis=2)
+            best = np.argmax(candidate_score, axis=1)
+            tets[start + unsure] = candidates[np.arange(unsure.shape[0]), best]
+            score[unsure] = candidate_score[np.arange(unsure.shape[0]), best]
+            if k_used == elements.shape[0] or k >= 16 * num_candidates:
+                break
+            unsure = unsure[score[unsure] < -1e-10]
+            k = 4 * k
+    return tets
+
+
+def clip_polygon(polygon, coordinates):
+    # Sutherland-Hodgman: the part of a convex polygon (m by 3, with m by 4 barycentric coordinates) inside a tet, i.e., where all barycentric coordinates are positive
+    for j in range(4):
+        if polygon.shape[0] == 0:
+            break
+        s = coordinates[:, j]
+        if np.all(s >= 0):
+            continue
+        new_polygon = []
+        new_coordinates = []
+        for a in range(polygon.shape[0]):
+            b = (a + 1) % polygon.shape[0]
+            if s[a] >= 0:
+                new_polygon.append(polygon[a])
+                new_coordinates.append(coordinates[a])
+            if (s[a] >= 0) != (s[b] >= 0):
+                # Always interpolate from the lexicographically smaller endpoint, so that the two triangles sharing an edge produce exactly the same point
+                lo, hi = (a, b) if tuple(polygon[a]) < tuple(polygon[b]) else (b, a)
+                t = s[lo] / (s[lo] - s[hi])
+                new_polygon.append(polygon[lo] + t * (polygon[hi] - polygon[lo]))
+                new_coordinates.append(coordinates[lo] + t * (coordinates[hi] - coordinates[lo]))
+        polygon = np.array(new_polygon).reshape(-1, 3)
+        coordinates = np.array(new_coordinates).reshape(-1, 4)
+    return polygon
+
+
+def piece_interfaces(vertices, elements, tet_labels):
+    # The tet faces separating different pieces, once from each side: returns them oriented outwards from their tet, and the piece of that tet
+    faces = np.vstack((elements[:, [1, 2, 3]], elements[:, [0, 3, 2]], elements[:, [0, 1, 3]], elements[:, [0, 2, 1]]))
+    owners = np.tile(np.arange(elements.shape[0]), 4)
+    # These are outward for positively oriented tets, so flip the others
+    tet_vertices = vertices[elements, :]
+    negative = np.linalg.det(np.transpose(tet_vertices[:, 1:, :] - tet_vertices[:, [0], :], (0, 2, 1))) < 0
+    faces[negative[owners], :] = faces[negative[owners], :][:, [0, 2, 1]]
+    # Each internal face appears twice, find the pairs
+    keys = np.sort(faces, axis=1)
+    order = np.lexsort(keys.T[::-1])
+    same = np.all(keys[order[1:], :] == keys[order[:-1], :], axis=1)
+    first = order[:-1][same]
+    second = order[1:][same]
+    different = tet_labels[owners[first]] != tet_labels[owners[second]]
+    interfaces = np.concatenate((first[different], second[different]))
+    return faces[interfaces, :], tet_labels[owners[interfaces]]
+
+
+def subdivision_weights(levels):
+    # Barycentric weights of the corners of the 4^levels triangles of a regular subdivision of a triangle, as a (4^levels, 3, 3) array (with the same orientation as the triangle)
+    n = 2 ** levels
+    triangles = []
+    for i in range(n):
+        for j in range(n - i):
+            triangles.append([(i, j), (i + 1, j), (i, j + 1)])
+            if i + j < n - 1:
+                triangles.append([(i + 1, j), (i + 1, j + 1), (i, j + 1)])
+    uv = np.array(triangles, dtype=float) / n
+    return np.stack((1.0 - uv[:, :, 0] - uv[:, :, 1], uv[:, :, 0], uv[:, :, 1]), axis=2)
+
+
+def locate_fine_pieces(vertices, elements, tet_labels, num_pieces, v_fine, f_fine, cap_subdivisions=3):
+    """Split a fine triangle mesh into the pieces of a tet mesh, without mesh booleans.
+
+    Every fine vertex is located in the tet mesh and takes the label of its tet. Fine triangles whose vertices all have the same label go to that piece as they are. Only the triangles straddling a piece boundary are cut, by clipping them against every tet they overlap. Finally, each piece is closed with the faces of the tet mesh that separate it from other pieces, where they are inside the fine mesh (by winding number). Faces that cross the fine surface are subdivided `cap_subdivisions` times and we keep the subdivided triangles whose centroid is inside. The cost is linear in the fine mesh size (for point location) plus the size of the cut surface, instead of pieces times fine mesh size for booleans.
+
+    This is an approximation of intersecting the fine mesh with each piece (see `compute_fine_pieces`). The fine surface is split exactly, but the closing faces stick out of (or fall short of) the fine surface by up to one subdivided triangle, so pieces are not watertight there. Also, a piece thinner than a fine triangle may be missed.
+
+    Parameters
+    ----------
+    vertices : (n,3) numpy double array
+        Tet mesh vertex positions
+    elements : (t,4) numpy int array
+        Tet indeces
+    tet_labels : (t,) numpy int array
+        Piece of each tet
+    num_pieces : int
+        Number of pieces
+    v_fine : (m,3) numpy double array
+        Fine mesh vertex positions
+    f_fine : (k,3) numpy int array
+        Fine mesh triangle indeces
+    cap_subdivisions : int (optional, default 3)
+        How many times to subdivide closing faces that cross the fine surface
+
+    Returns
+    -------
+    fine_pieces : list of tuples
+        The (vertices, triangles) of each piece of the fine mesh
+    """
+    f_fine = f_fine.astype(int)
+    tet_inverses = tet_barycentric_matrices(vertices, elements)
+    tet_origins = vertices[elements[:, 0], :]
+    # Label every fine vertex
+    vertex_labels = tet_labels[locate_points(vertices, elements, v_fine)]
+    face_labels = vertex_labels[f_fine]
+    uncut = (face_labels[:, 0] == face_labels[:, 1]) & (face_labels[:, 1] == face_labels[:, 2])
+
+    # Faces and vertices of each piece. Vertices are numbered as (fine vertices, tet vertices, new vertices from cutting)
+    uncut_faces = np.nonzero(uncut)[0]
+    uncut_faces = uncut_faces[np.argsort(face_labels[uncut_faces, 0], kind='stable')]
+    splits = np.searchsorted(face_labels[uncut_faces, 0], np.arange(1, num_pieces))
+    piece_faces = [[faces] for faces in np.split(f_fine[uncut_faces, :], splits)]
+    new_vertices = []
+    num_new_vertices = 0
+    offset = v_fine.shape[0] + vertices.shape[0]
+
+    # Cut straddling triangles: find the tets they may overlap, discard the ones separated from them by a tet face, and clip against the rest
+    cut = np.nonzero(~uncut)[0]
+    if cut.shape[0] > 0:
+        tet_vertices = vertices[elements, :]
+        tet_centroids = np.mean(tet_vertices, axis=1)
+        tet_radius = np.max(np.linalg.norm(tet_vertices - tet_centroids[:, None, :], axis=2))
+        triangles = v_fine[f_fine[cut, :], :]
+        triangle_centroids = np.mean(triangles, axis=1)
+        triangle_radii = np.max(np.linalg.norm(triangles - triangle_centroids[:, None, :], axis=2), axis=1)
+        close = cKDTree(tet_centroids).query_ball_point(triangle_centroids, triangle_radii + tet_radius)
+        pair_tets = np.concatenate([np.array(tets, dtype=int) for tets in close])
+        pair_triangles = np.repeat(np.arange(cut.shape[0]), [len(tets) for tets in close])
+        coordinates = barycentric(tet_inverses[pair_tets, None, :, :], tet_origins[pair_tets, None, :],
+                                  triangles[pair_triangles, :, :])
+        overlap = ~np.any(np.all(coordinates < 0, axis=1), axis=1)
+        inside = np.all(coordinates >= 0, axis=(1, 2))
+        for p in np.nonzero(overlap)[0]:
+            label = tet_labels[pair_tets[p]]
+            if inside[p]:
+                piece_faces[label].append(f_fine[cut[pair_triangles[p]], None, :])
+                continue
+            polygon = clip_polygon(triangles[pair_triangles[p]], coordinates[p])
+            if polygon.shape[0] < 3:
+                continue
+            # Fan triangulation of the clipped (convex) polygon
+            fan = np.arange(1, polygon.shape[0] - 1)
+            piece_faces[label].append(offset + num_new_vertices +
+                                      np.vstack((np.zeros_like(fan), fan, fan + 1)).T)
+            new_vertices.append(polygon)
+            num_new_vertices += polygon.shape[0]
+
+    # Close the pieces with the tet faces that separate them from other pieces, where they are inside the fine mesh
+    interfaces, interface_labels = piece_interfaces(vertices, elements, tet_labels)
+    if interfaces.shape[0] > 0:
+        corners = vertices[interfaces, :]
+        inside = np.abs(igl.winding_number(v_fine, f_fine, np.vstack((np.mean(corners, axis=1),
+                                                                     np.reshape(corners, (-1, 3)))))) > 0.5
+        inside_centroid = inside[:interfaces.shape[0]]
+        inside_corners = np.reshape(inside[interfaces.shape[0]:], (-1, 3))
+        whole = inside_centroid & np.all(inside_corners, axis=1)
+        crossing = np.nonzero(~whole & (inside_centroid | np.any(inside_corners, axis=1)))[0]
+        for i in range(num_pieces):
+            piece_faces[i].append(v_fine.shape[0] + interfaces[whole & (interface_labels == i), :])
+        if crossing.shape[0] > 0:
+            # Subdivide the faces that cross the fine surface and keep the inside part
+            triangles = np.einsum('sij,cjk->csik', subdivision_weights(cap_subdivisions), corners[crossing, :, :])
+            triangles = np.reshape(triangles, (-1, 3, 3))
+            triangle_labels = np.repeat(interface_labels[crossing], 4 ** cap_subdivisions)
+            keep = np.abs(igl.winding_number(v_fine, f_fine, np.mean(triangles, axis=1))) > 0.5
+            triangles = triangles[keep, :, :]
+            triangle_labels = triangle_labels[keep]
+            for i in range(num_pieces):
+                count = np.sum(triangle_labels == i)
+                piece_faces[i].append(offset + num_new_vertices + np.reshape(np.arange(3 * count), (-1, 3)))
+                new_vertices.append(np.reshape(triangles[triangle_labels == i, :, :], (-1, 3)))
+                num_new_vertices += 3 * count
+
+    all_vertices = np.vstack([v_fine, vertices] + new_vertices)
+    fine_pieces = []
+    for i in range(num_pieces):
+        faces = np.vstack(piece_faces[i])
+        if faces.shape[0] == 0:
+            fine_pieces.append((np.zeros((0, 3)), np.zeros((0, 3), dtype=int)))
+            continue
+        # Keep only the vertices this piece uses, and weld the copies made by cutting
+        used, faces = np.unique(faces, return_inverse=True)
+        faces = np.reshape(faces, (-1, 3))
+        vi, _, J, _ = igl.remove_duplicate_vertices(all_vertices[used, :], faces, 1e-10)
+        fi = J[faces]
+        fi = fi[(fi[:, 0] != fi[:, 1]) & (fi[:, 1] != fi[:, 2]) & (fi[:, 2] != fi[:, 0]), :]
+        vi, fi = igl.remove_unreferenced(vi, fi)[:2]
+        fine_pieces.append((vi, fi))
+    return fine_pieces
@@ -0,0 +1,49 @@
+# Include existing libraries
+import igl
+import numpy as np
+
+
+def weld_mesh(vertices, triangles, epsilon=1e-10):
+    # Merges vertices closer than epsilon. Returns the merged vertices and the triangles indexing them. This only depends on the mesh, so it should be done once and reused for every fracture
+    welded_vertices, _, welded_index, _ = igl.remove_duplicate_vertices(vertices, triangles, epsilon)
+    return welded_vertices, np.reshape(welded_index, (-1,))[triangles]
+
+
+def split_by_label(vertices, triangles, triangle_labels, num_labels):
+    """Split a triangle mesh into one mesh per label.
+
+    All pieces are extracted at once: triangles are sorted by label, and every piece's vertices are found with a single sort of (label, vertex) pairs. This is the same as taking `remove_unreferenced(vertices, triangles[triangle_labels == i, :])` for each label i (and `remove_duplicate_vertices`, if the mesh was given by `weld_mesh`), but O(triangles log triangles) instead of O(labels * triangles).
+
+    Parameters
+    ----------
+    vertices : (n,3) numpy double array
+        Mesh vertex positions (usually welded with `weld_mesh`)
+    triangles : (m,3) numpy int array
+        Mesh triangle indeces
+    triangle_labels : (m,) numpy int array
+        Label of each triangle, between 0 and num_labels-1
+    num_labels : int
+        Number of labels
+
+    Returns
+    -------
+    pieces : list of tuples
+        The (vertices, triangles) of each label. Labels without triangles get empty arrays.
+    """
+    triangle_labels = np.asarray(triangle_labels).astype(np.int64)
+    order = np.argsort(triangle_labels, kind='stable')
+    sorted_labels = triangle_labels[order]
+    triangle_starts = np.searchsorted(sorted_labels, np.arange(num_labels + 1))
+    # Every (label, vertex) pair, as one integer
+    num_vertices = max(vertices.shape[0], 1)
+    keys = sorted_labels[:, None] * num_vertices + triangles[order, :].astype(np.int64)
+    unique_keys, local_triangles = np.unique(keys, return_inverse=True)
+    piece_vertices = unique_keys % num_vertices
+    vertex_starts = np.searchsorted(unique_keys // num_vertices, np.arange(num_labels + 1))
+    # Make indeces local to each piece
+    local_triangles = np.reshape(local_triangles, (-1, 3)) - vertex_starts[sorted_labels][:, None]
+    pieces = []
+    for i in range(num_labels):
+        pieces.append((vertices[piece_vertices[vertex_starts[i]:vertex_starts[i + 1]], :],
+                       local_triangles[triangle_starts[i]:triangle_starts[i + 1], :]))
+    return pieces
@@ -0,0 +1,117 @@
+# Include existing libraries
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .array_store import directory_size, read_arrays, write_arrays
+
+
+def hash_file(filename):
+    # Content hash of a file, so that a cache key does not depend on where the file lives
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_arrays(*arrays):
+    # Content hash of some numpy arrays (their shapes, types and values)
+    h = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def stage_key(*parts):
+    # Combine a previous stage's key with this stage's parameters into a new key
+    h = hashlib.sha256()
+    h.update(json.dumps(parts, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class StageCache:
+    """Content-addressed on-disk cache for the stages of `generate_fractures`.
+
+    Each entry is a directory of arrays (see `array_store.py`) named after its key. Keys are meant to be built with `stage_key`, chaining the key of the previous stage with the parameters of the current one, so that changing any upstream input invalidates everything downstream. When the cache grows over `max_size` bytes, the least recently used entries are deleted. Several processes can share a cache directory: entries are written atomically, and an entry that disappears while being read is treated as a miss.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory where the cache lives
+    max_size : int (optional, default 20GB)
+        Maximum total size of the cache in bytes
+    """
+
+    def __init__(self, cache_dir, max_size=20 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, mmap=False):
+        entry = self.entry_dir(key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            arrays = read_arrays(entry, mmap=mmap)
+            # Mark as recently used
+            os.utime(os.path.join(entry, "index.json"))
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key, arrays, evict=True):
+        # (when writing many entries at once, pass evict=False and call evict once at the end)
+        entry = self.entry_dir(key)
+        if os.path.isdir(entry):
+            return
+        try:
+            write_arrays(entry, arrays)
+        except OSError:
+            # Another process wrote the same entry in the meantime, which is just as good
+            if not os.path.isdir(entry):
+                raise
+        if evict:
+            self.evict()
+
+    def get_or_compute(self, key, compute):
+        # Returns the cached arrays for key, calling compute() and storing its output on a miss
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
+
+    def evict(self):
+        # Delete least recently used entries until we are under the size limit
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                last_used = os.path.getmtime(os.path.join(entry, "index.json"))
+            except OSError:
+                continue
+            size = directory_size(entry)
+            entries.append((last_used, size, entry))
+            total += size
+        entries.sort()
+        for last_used, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
@@ -0,0 +1,256 @@
+# Include existing libraries
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+
+
+def count_faces(filename):
+    # Number of faces of a mesh file, reading as little of it as we can: the header of a .ply or binary .stl, the face lines of an .obj, and otherwise we estimate it from the file size
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.ply':
+        with open(filename, 'rb') as f:
+            for line in f:
+                words = line.split()
+                if words[:2] == [b'element', b'face']:
+                    return int(words[2])
+                if words[:1] == [b'end_header']:
+                    break
+    elif extension == '.stl':
+        with open(filename, 'rb') as f:
+            header = f.read(84)
+        num_faces = struct.unpack('<I', header[80:84])[0] if len(header) == 84 else 0
+        # (an ASCII .stl doesn't have a count, but then the size doesn't match)
+        if 84 + 50 * num_faces == os.path.getsize(filename):
+            return num_faces
+    elif extension == '.obj':
+        with open(filename, 'rb') as f:
+            return sum(1 for line in f if line.startswith(b'f '))
+    # Roughly what a face takes in most formats
+    return os.path.getsize(filename) // 50
+
+
+def estimate_cost(filename, cage_size=4000):
+    # Rough relative cost of generate_fractures on a mesh: intersecting the fine mesh with every piece grows with its number of faces, and computing the modes with the size of the cage (whose tet mesh has several tets per cage face, and each solve is superlinear in them)
+    return count_faces(filename) + 10 * cage_size
+
+
+def tasks_hash(tasks):
+    # Identifies a list of tasks regardless of their order, costs (which are estimates) and ids
+    identities = sorted(json.dumps({key: value for key, value in task.items() if key not in ('cost', 'id')},
+                                   sort_keys=True) for task in tasks)
+    return hashlib.sha256(json.dumps(identities).encode()).hexdigest()
+
+
+class SharedTaskQueue:
+    """Task queue shared by processes on any number of machines through a shared filesystem, with no central service.
+
+    One process creates the list of tasks with `create` (any other process calling it just reads it), sorted from most to least expensive, so that big tasks are not left for the end. Processes then `claim` tasks, which creates a lock file for the task: creating it is atomic (`O_EXCL`), so a task is only ever claimed by one process. While a process holds a claim, a background thread keeps renewing it. A claim that wasn't renewed for `lease` seconds (its process died, or its machine did) is considered abandoned, and another process can claim the task. Finished tasks are marked with `complete`. A task can run twice if its claim expires while its process is alive but stuck, so tasks should be safe to rerun.
+
+    Everything lives in `directory`: `tasks.json`, with the tasks (and a hash of them, so that `create` can tell if it is given a different list), `claims/`, with one lock file per claimed task, and `done/`, with one file per finished task (with its status).
+
+    Parameters
+    ----------
+    directory : str
+        Directory on the shared filesystem
+    lease : float (optional, default 600)
+        Seconds after which a claim that wasn't renewed is given up on
+    """
+
+    def __init__(self, directory, lease=600):
+        self.directory = directory
+        self.lease = lease
+        self.manifest_path = os.path.join(directory, "tasks.json")
+        self.claims_dir = os.path.join(directory, "claims")
+        self.done_dir = os.path.join(directory, "done")
+        os.makedirs(self.claims_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self.tasks = None
+        self.manifest_hash = None
+        # Unique to this process, and written in every lock file it creates
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        # Tasks we hold the claim of, and the thread that renews them
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop_renewing = threading.Event()
+        self.renew_thread = None
+
+    def create(self, tasks):
+        # Writes the list of tasks (dictionaries, with a 'cost' entry each) unless some process already did, and returns the list everybody uses. Each task gets an 'id'. If the directory already has a different list (e.g., from an earlier run on other inputs), this raises a ValueError instead of silently working on that one
+        digest = tasks_hash(tasks)
+        if not os.path.exists(self.manifest_path):
+            tasks = sorted(tasks, key=lambda task: -task['cost'])
+            for i, task in enumerate(tasks):
+                task['id'] = f"{i:08d}"
+            temp_path = f"{self.manifest_path}.{self.owner.replace(':', '_')}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({'tasks_hash': digest, 'tasks': tasks}, f)
+            try:
+                # Unlike a rename, this fails if the manifest exists, so that the first process to get here wins
+                os.link(temp_path, self.manifest_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_path)
+        tasks = self.read()
+        if self.manifest_hash != digest:
+            raise ValueError(f"{self.manifest_path} has a different list of tasks than the one given (from an earlier "
+                             f"run?), so this isn't resuming it. Use a new (or empty) schedule directory "
+                             f"(--schedule_dir) to run these tasks")
+        return tasks
+
+    def read(self):
+        if self.tasks is None:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.manifest_hash = manifest['tasks_hash']
+            self.tasks = manifest['tasks']
+        return self.tasks
+
+    def claim_path(self, task):
+        return os.path.join(self.claims_dir, task['id'])
+
+    def done_path(self, task):
+        return os.path.join(self.done_dir, task['id'])
+
+    def is_done(self, task):
+        return os.path.exists(self.done_path(task))
+
+    def try_claim(self, task):
+        try:
+            fd = os.open(self.claim_path(task), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        # It may have been finished by someone whose claim we saw expire
+        if self.is_done(task):
+            os.remove(self.claim_path(task))
+            return False
+        return True
+
+    def expired(self, task):
+        # Takes away an abandoned claim, returning whether we did
+        lock_path = self.claim_path(task)
+        try:
+            if time.time() - os.stat(lock_path).st_mtime <= self.lease:
+                return False
+            # Renaming is atomic, so only one process can take it away
+            stale_path = f"{lock_path}.{self.owner.replace(':', '_')}.stale"
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(stale_path).st_mtime <= self.lease:
+            # Its owner renewed it just before we took it away, so give it back (unless someone claimed it since)
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def claim(self):
+        # Claims the most expensive task nobody is working on (or whose claim expired), or returns None if there is none right now
+        for task in self.read():
+            if self.is_done(task):
+                continue
+            if self.try_claim(task) or (self.expired(task) and self.try_claim(task)):
+                with self.lock:
+                    self.held.add(task['id'])
+                self.start_renewing()
+                return task
+        return None
+
+    def start_renewing(self):
+        if self.renew_thread is None:
+            self.stop_renewing.clear()
+            self.renew_thread = threading.Thread(target=self.renew, daemon=True)
+            self.renew_thread.start()
+
+    def renew(self):
+        # Runs in the background, touching the lock files of our claims often enough that they never expire
+        while not self.stop_renewing.wait(self.lease / 4):
+            with self.lock:
+                held = list(self.held)
+            for task_id in held:
+                # A process that saw our claim expire takes the lock file away for a moment even if we just renewed it (see expired), so we look again before giving up on it
+                if self.renew_claim(task_id):
+                    continue
+                time.sleep(1)
+                if not self.renew_claim(task_id):
+                    # Someone took it away from us (we took too long to renew it)
+                    with self.lock:
+                        self.held.discard(task_id)
+
+    def renew_claim(self, task_id):
+        # Touches the lock file of a claim, returning whether it is still ours
+        lock_path = os.path.join(self.claims_dir, task_id)
+        try:
+            with open(lock_path) as f:
+                if f.read() != self.owner:
+                    return False
+            os.utime(lock_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, task, status='ok'):
+        # Marks the task as done, and gives up its claim
+        try:
+            fd = os.open(self.done_path(task), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'status': status, 'owner': self.owner, 'time': time.time()}, f)
+        except FileExistsError:
+            pass
+        self.release(task)
+
+    def release(self, task):
+        # Gives up the claim of a task without finishing it, so that someone else can claim it right away
+        with self.lock:
+            if task['id'] not in self.held:
+                return
+            self.held.discard(task['id'])
+        try:
+            with open(self.claim_path(task)) as f:
+                if f.read() == self.owner:
+                    os.remove(self.claim_path(task))
+        except FileNotFoundError:
+            pass
+
+    def num_done(self):
+        return sum(1 for task in self.read() if self.is_done(task))
+
+    def claimed_tasks(self):
+        # Claims tasks one by one until every task is done. When there is nothing to claim but other processes are still running tasks, this yields None (try again later): if one of them dies, its task will be claimable once its claim expires
+        while True:
+            task = self.claim()
+            if task is not None:
+                yield task
+            elif self.num_done() == len(self.read()):
+                return
+            else:
+                yield None
+
+    def close(self):
+        # Gives up every claim we haven't completed, and stops renewing
+        with self.lock:
+            held = list(self.held)
+        for task_id in held:
+            self.release({'id': task_id})
+        if self.renew_thread is not None:
+            self.stop_renewing.set()
+            self.renew_thread.join()
+            self.renew_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -1,54 +1,70 @@
 import glob
 import os
-from multiprocessing import Pool
 
 import pyvista as pv
 from fast_simplification import simplify_mesh
 from psutil import cpu_count
 from tqdm import tqdm
 
+from fracture_utility.batch_driver import BatchDriver
+from fracture_utility.task_scheduler import SharedTaskQueue
+
 # 路径配置
 zip_folder = "/mnt/NAS/data/MUG500"
 output_folder = os.path.join(zip_folder, "objects")
 
 
-def process_single_zip(file_path) -> str:
-    try:
-        mesh = pv.read(file_path)
-        mesh = simplify_mesh(mesh, 0.9)
-        out_path = os.path.join(output_folder, os.path.basename(file_path).replace("_clear.stl", ".ply"))
-        os.makedirs(output_folder, exist_ok=True)
-        mesh.save(out_path)
-        return f"[Done] {file_path}"
-    except Exception as e:
-        return f"[Error] {file_path}: {str(e)}"
+def process_single_zip(file_path):
+    # 由 BatchDriver 在常驻 worker 中运行：出错直接抛出异常，错误信息记录在该文件的日志里
+    mesh = pv.read(file_path)
+    mesh = simplify_mesh(mesh, 0.9)
+    out_path = os.path.join(output_folder, os.path.basename(file_path).replace("_clear.stl", ".ply"))
+    os.makedirs(output_folder, exist_ok=True)
+    mesh.save(out_path)
+
+
+def zip_task(file_path):
+    """ 一个文件的参数和日志文件（由 BatchDriver 运行）"""
+    log_file = os.path.join(output_folder, "logs", os.path.basename(file_path).replace("_clear.stl", ".log"))
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    return {'file_path': file_path}, log_file
 
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-r", "--rank", type=int, default=0)
+    parser.add_argument("--schedule_dir", type=str, default=os.path.join(zip_folder, "schedule"),
+                        help="所有机器共享的任务队列目录；用同一目录重新运行会接着完成未完成的任务，"
+                             "处理不同的文件或重新处理已完成的任务需要使用新的（或空的）目录")
+    parser.add_argument("--lease", type=float, default=600, help="多少秒没有响应的机器的任务会被其他机器接管")
     args = parser.parse_args()
-    rank = args.rank
-
-    # 机器设置
-    cpus = [16, 16, 12, 12, 10, 32]
 
     items = list(sorted(glob.glob(os.path.join(zip_folder, "*/*_clear.stl"))))
 
-    # === 按 rank 分配任务 ===
-    total = sum(cpus)
-    sizes = [round(len(items) * c / total) for c in cpus]
+    # === 所有机器从共享队列领取任务，大文件优先（文件大小与面数成正比）===
+    queue = SharedTaskQueue(args.schedule_dir, lease=args.lease)
+    queue.create([{'file_path': file_path, 'cost': os.path.getsize(file_path)} for file_path in items])
+
+    claimed = []
+
+    def claimed_tasks():
+        # 只在有空闲 worker 时领取下一个任务，暂时没有可领取的任务（其他机器正在处理）时稍后再试
+        for task in queue.claimed_tasks():
+            if task is None:
+                yield None
+                continue
+            claimed.append(task)
+            yield zip_task(task['file_path'])
 
-    # 调整最后一块，确保总和正确
-    sizes[-1] = len(items) - sum(sizes[:-1])
+    # 每个物理核心一个常驻 worker；worker 崩溃（例如内存不足被杀）时任务记为 crashed 并换一个新的 worker，不会一直占着任务
+    n_cpus = cpu_count(logical=False)
+    worker_cpus = [[c for c in (cpu, cpu + n_cpus) if c < cpu_count()] for cpu in range(n_cpus)]
 
-    # 得到每段的起止 index
-    start_idx = sum(sizes[:rank])
-    end_idx = start_idx + sizes[rank]
-    items = items[start_idx:end_idx]
+    with queue, tqdm(total=len(items), initial=queue.num_done(), desc="Processing") as pbar:
+        def report(i, status, seconds):
+            queue.complete(claimed[i], status)
+            pbar.update()
+            print(f"[{status}] {claimed[i]['file_path']} ({seconds:.1f} seconds)")
 
-    with Pool(processes=cpu_count(logical=False)) as pool:
-        for result in tqdm(pool.imap_unordered(process_single_zip, items), total=len(items), desc=f"Rank {rank} Processing"):
-            print(result)
+        BatchDriver(process_single_zip, worker_cpus=worker_cpus).run(claimed_tasks(), callback=report)
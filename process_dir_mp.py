@@ -1,16 +1,17 @@
 import glob
 import os
-import sys
-import multiprocessing
-import subprocess
 import time
 from argparse import ArgumentParser
 
 import psutil
 
+from scripts.context import fracture_utility as fracture
+from fracture_utility.batch_driver import BatchDriver
+from fracture_utility.task_scheduler import SharedTaskQueue, count_faces, estimate_cost
+
 
-def process_model(model):
-    """ 处理单个 .obj 文件，并将其输出重定向到日志文件 """
+def model_task(model, cache_dir=None, mode_time_budget=None):
+    """ 一个模型的 generate_fractures 参数和日志文件（由 BatchDriver 运行）"""
     output_dir = os.path.splitext(model)[0].replace("object", "synthetic_fracture")  # 确定输出文件夹
     log_file = os.path.join(output_dir, "process.log")  # 每个模型的日志文件
     interior = model.replace("object", "interior")
@@ -20,119 +21,67 @@ def process_model(model):
     # 创建输出目录（如果不存在）
     os.makedirs(output_dir, exist_ok=True)
 
-    # 构造 Python 命令，调用 fracture_utility 处理模型
-    command = [
-        sys.executable, "-c",  # 让 Python 运行一个字符串脚本
-        f"""
-from scripts.context import fracture_utility as fracture
-fracture.generate_fractures(
-    {model!r}, {interior!r}, num_modes=112, num_impacts=112,
-    output_dir={output_dir!r}, verbose=True, compressed=False, cage_size=5000,
-    volume_constraint=0.00)
-"""
-    ]
-
-    # 运行子进程，重定向所有输出到 log_file
-    with open(log_file, "w") as log:
-        subprocess.run(command, stdout=log, stderr=log, text=True)
-
-    return output_dir
-
-
-def worker_process(cpus, task_queue):
-    env = os.environ.copy()
-    n_cpus = f"{len(cpus)}"
-    env["OMP_NUM_THREADS"] = n_cpus
-    env["MKL_NUM_THREADS"] = n_cpus
-    env["OPENBLAS_NUM_THREADS"] = n_cpus
-    env["VECLIB_MAXIMUM_THREADS"] = n_cpus
-    env["NUMEXPR_NUM_THREADS"] = n_cpus
-
-    while True:
-        model = task_queue.get()
-        if model is None:
-            break
-
-        start_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        print(f"[{start_time}] Processing {model} on CPU {cpus}")
-        output_dir = os.path.splitext(model)[0].replace("object", "synthetic_fracture")  # 确定输出文件夹
-        log_file = os.path.join(output_dir, "process.log")  # 每个模型的日志文件
-        interior = model.replace("object", "interior")
-        if not os.path.exists(interior):
-            interior = None
-
-        # 创建输出目录（如果不存在）
-        os.makedirs(output_dir, exist_ok=True)
-
-        # 构造 Python 命令，调用 fracture_utility 处理模型
-        command = [
-            sys.executable, "-c",  # 让 Python 运行一个字符串脚本
-            f"""
-import psutil
-psutil.Process().cpu_affinity({cpus!r})
-from scripts.context import fracture_utility as fracture
-fracture.generate_fractures(
-    {model!r}, {interior!r}, num_modes=7, num_impacts=6,
-    output_dir={output_dir!r}, verbose=True, compressed=False, cage_size=5000,
-    volume_constraint=0.00)
-        """
-        ]
-
-        # 运行子进程，重定向所有输出到 log_file
-        with open(log_file, "w") as log:
-            r = subprocess.run(command, env=env, stdout=log, stderr=log, text=True)
-
-        end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        print(f"[{end_time}] Processed {model} on CPU {cpus} with return code {r.returncode}")
+    kwargs = dict(input_dir=model, interior_filename=interior, num_modes=7, num_impacts=6,
+                  output_dir=output_dir, verbose=True, compressed=False, cage_size=5000,
+                  volume_constraint=0.00, cache_dir=cache_dir,
+                  checkpoint_dir=os.path.join(output_dir, "mode_checkpoint"), mode_time_budget=mode_time_budget)
+    return kwargs, log_file
 
 
 if __name__ == "__main__":
     # 读取输入参数
     parser = ArgumentParser()
     parser.add_argument('--root_dir', type=str, default="/mnt/HDD1/pig")
-    parser.add_argument('--rank', type=int, default=None)
+    parser.add_argument('--schedule_dir', type=str, default=None,
+                        help="shared directory of the task queue (default root_dir/schedule); every machine running "
+                             "this script with the same one shares the work. Rerunning with the same one (and the "
+                             "same arguments) resumes it, skipping finished tasks; to run a different set of tasks "
+                             "(other models or --repeat) or to redo finished ones, use a new or empty directory")
+    parser.add_argument('--lease', type=float, default=600,
+                        help="seconds after which the tasks of a machine that stopped responding are taken over")
     parser.add_argument('--repeat', type=int, default=8)
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="cache mesh/cage/tets/modes/precomputation here so that repeats skip them")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="seconds after which a model is given up on (its worker is restarted)")
+    parser.add_argument('--mode_time_budget', type=float, default=None,
+                        help="seconds after which a model stops computing modes and generates fractures from the "
+                             "ones it has (bounds the time of the slowest models, unlike --timeout it still "
+                             "produces fractures)")
     args = parser.parse_args()
-    rank = args.rank
-
-    models = glob.glob(f"{args.root_dir}/object/*.ply")
-    if args.rank is not None:
-        models.sort()
-        cpus = [16, 16, 12, 12, 10, 32]
-
-        # === 按 rank 分配任务 ===
-        total = sum(cpus)
-        sizes = [round(len(models) * c / total) for c in cpus]
-
-        # 调整最后一块，确保总和正确
-        sizes[-1] = len(models) - sum(sizes[:-1])
-
-        # 得到每段的起止 index
-        start_idx = sum(sizes[:rank])
-        end_idx = start_idx + sizes[rank]
-        models = models[start_idx:end_idx]
-
-    task_queue = multiprocessing.Queue()
-    for _ in range(args.repeat):
-        for task in models:
-            task_queue.put(task)
 
+    # 所有机器共享同一个任务清单（第一个到达的机器写入），按估计代价从大到小领取任务，不再按 rank 静态切分
+    schedule_dir = args.schedule_dir or os.path.join(args.root_dir, "schedule")
+    models = sorted(glob.glob(f"{args.root_dir}/object/*.ply"))
+    queue = SharedTaskQueue(schedule_dir, lease=args.lease)
+    task_list = []
+    for r in range(args.repeat):
+        for model in models:
+            # 有缓存时，重复运行不需要重新计算 cage 和 modes
+            cost = count_faces(model) if r > 0 and args.cache_dir is not None else estimate_cost(model, 5000)
+            task_list.append({'model': model, 'repeat': r, 'cost': cost})
+    queue.create(task_list)
+
+    claimed = []
+
+    def claimed_tasks():
+        # 只在有空闲 worker 时领取下一个任务
+        for task in queue.claimed_tasks():
+            if task is None:
+                yield None
+                continue
+            claimed.append(task)
+            yield model_task(task['model'], args.cache_dir, args.mode_time_budget)
+
+    # 每个物理核心一个常驻 worker（绑定到该核心及其超线程），只导入一次库、只创建一次 MOSEK 环境
     n_cpus = psutil.cpu_count(logical=False)
-    cpus = list(range(n_cpus))
-    for _ in cpus:
-        task_queue.put(None)
+    worker_cpus = [[c for c in (cpu, cpu + n_cpus) if c < psutil.cpu_count()] for cpu in range(n_cpus)]
 
-    processes = []
-    for cpu in cpus:
-        p = multiprocessing.Process(target=worker_process,
-                                    args=((cpu, cpu + n_cpus), task_queue))
-        p.start()
-        processes.append(p)
-
-    for p in processes:
-        p.join()
+    def report(i, status, seconds):
+        end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        queue.complete(claimed[i], status)
+        print(f"[{end_time}] Processed {claimed[i]['model']} in {seconds:.1f} seconds: {status}")
 
-    # with multiprocessing.Pool(6) as pool, tqdm(total=len(models)) as pbar:
-    #     for result in pool.imap_unordered(process_model, models):
-    #         pbar.update()
-    #         pbar.set_postfix_str(f"Processed {result}")
+    driver = BatchDriver(fracture.generate_fractures, worker_cpus=worker_cpus, timeout=args.timeout)
+    with queue:
+        driver.run(claimed_tasks(), callback=report)
@@ -0,0 +1,98 @@
+# Time and peak memory of the Laplacian eigensolver backends (see LaplacianEigensolver) on regular tet grids of increasing size
+import multiprocessing
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import igl
+import numpy as np
+
+from context import fracture_utility
+from fracture_utility.compute_fracture_modes import LaplacianEigensolver
+from fracture_utility.massmatrix_tets import massmatrix_tets
+
+
+def regular_tet_mesh(num_tets):
+    # Unit cube split into n^3 cubes, each split into six tets sharing the cube's diagonal
+    n = max(1, int(round((num_tets / 6) ** (1 / 3))))
+    g = np.linspace(-0.5, 0.5, n + 1)
+    X, Y, Z = np.meshgrid(g, g, g, indexing='ij')
+    vertices = np.stack((X.ravel(), Y.ravel(), Z.ravel()), axis=1)
+    idx = np.reshape(np.arange((n + 1) ** 3), (n + 1, n + 1, n + 1))
+    corners = []
+    for dx, dy, dz in [(0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0), (0, 0, 1), (1, 0, 1), (0, 1, 1), (1, 1, 1)]:
+        corners.append(idx[dx:n + dx, dy:n + dy, dz:n + dz].ravel())
+    tets = [(0, 1, 3, 7), (0, 1, 5, 7), (0, 2, 3, 7), (0, 2, 6, 7), (0, 4, 5, 7), (0, 4, 6, 7)]
+    elements = np.vstack([np.stack([corners[i] for i in tet], axis=1) for tet in tets])
+    # Make all tets positively oriented
+    e = vertices[elements[:, 1:], :] - vertices[elements[:, [0]], :]
+    negative = np.linalg.det(e) < 0
+    elements[negative, :] = elements[negative][:, [1, 0, 2, 3]]
+    return vertices, elements
+
+
+def resident_memory():
+    # Resident memory of this process in bytes (Linux only)
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(num_tets, backend, preconditioner, num_modes, num_more_modes):
+    # Runs in a process of its own, so that what one backend allocates doesn't count towards the next. Memory is sampled in the background while the eigensolver runs
+    vertices, elements = regular_tet_mesh(num_tets)
+    Q = igl.cotmatrix(vertices, elements)
+    M = massmatrix_tets(vertices, elements)
+    start_memory = resident_memory()
+    peak_memory = [start_memory]
+    stop = threading.Event()
+
+    def monitor():
+        while not stop.wait(0.01):
+            peak_memory[0] = max(peak_memory[0], resident_memory())
+
+    thread = threading.Thread(target=monitor, daemon=True)
+    thread.start()
+    t0 = time.time()
+    solver = LaplacianEigensolver(Q, M, backend=backend, preconditioner=preconditioner)
+    eigenmodes = solver.solve(num_modes)
+    t1 = time.time()
+    # More modes reuse the factorization (or preconditioner) and, for LOBPCG, start from the modes we have
+    solver.solve(num_modes + num_more_modes)
+    t2 = time.time()
+    stop.set()
+    thread.join()
+    eigenvalues = np.sum(eigenmodes * (-Q @ eigenmodes), axis=0) / np.sum(eigenmodes * (M @ eigenmodes), axis=0)
+    return elements.shape[0], t1 - t0, t2 - t1, (peak_memory[0] - start_memory) / 2 ** 20, eigenvalues
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 50000, 100000, 200000, 500000])
+    parser.add_argument('--backends', type=str, nargs='*', default=['shift_invert', 'lobpcg:amg', 'lobpcg:ilu'],
+                        help="eigen backends to compare, with the LOBPCG preconditioner after a colon")
+    parser.add_argument('--num_modes', type=int, default=20)
+    parser.add_argument('--num_more_modes', type=int, default=5)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for num_tets in args.sizes:
+        reference = None
+        for name in args.backends:
+            backend, _, preconditioner = name.partition(':')
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    num_elements, seconds, more_seconds, memory, eigenvalues = executor.submit(
+                        run, num_tets, backend, preconditioner or None, args.num_modes, args.num_more_modes).result()
+            except BrokenProcessPool:
+                print(f"{num_tets:>8} tets, {name:>12}: killed (out of memory?)")
+                continue
+            # Eigenvalues are compared to the first backend's (eigenmodes of repeated eigenvalues aren't unique)
+            if reference is None:
+                reference = eigenvalues
+            error = np.max(np.abs(eigenvalues - reference) / np.maximum(np.abs(reference), 1))
+            print(f"{num_elements:>8} tets, {name:>12}: {seconds:8.2f} seconds ({more_seconds:6.2f} for "
+                  f"{args.num_more_modes} more modes), peak {memory:7.0f}MB, "
+                  f"max relative eigenvalue difference {error:.1e}")
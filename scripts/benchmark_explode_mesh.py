@@ -0,0 +1,41 @@
+# Time explode_mesh (discontinuity matrix assembly) on regular tet grids of increasing size
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from context import fracture_utility as fracture
+
+parser = ArgumentParser()
+parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000, 50000, 100000, 200000, 500000])
+parser.add_argument('--num_quad', type=int, nargs='*', default=[1, 3])
+args = parser.parse_args()
+
+
+def regular_tet_mesh(num_tets):
+    # Unit cube split into n^3 cubes, each split into six tets sharing the cube's diagonal
+    n = max(1, int(round((num_tets / 6) ** (1 / 3))))
+    g = np.linspace(-0.5, 0.5, n + 1)
+    X, Y, Z = np.meshgrid(g, g, g, indexing='ij')
+    vertices = np.stack((X.ravel(), Y.ravel(), Z.ravel()), axis=1)
+    idx = np.reshape(np.arange((n + 1) ** 3), (n + 1, n + 1, n + 1))
+    corners = []
+    for dx, dy, dz in [(0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0), (0, 0, 1), (1, 0, 1), (0, 1, 1), (1, 1, 1)]:
+        corners.append(idx[dx:n + dx, dy:n + dy, dz:n + dz].ravel())
+    tets = [(0, 1, 3, 7), (0, 1, 5, 7), (0, 2, 3, 7), (0, 2, 6, 7), (0, 4, 5, 7), (0, 4, 6, 7)]
+    elements = np.vstack([np.stack([corners[i] for i in tet], axis=1) for tet in tets])
+    # Make all tets positively oriented
+    e = vertices[elements[:, 1:], :] - vertices[elements[:, [0]], :]
+    negative = np.linalg.det(e) < 0
+    elements[negative, :] = elements[negative][:, [1, 0, 2, 3]]
+    return vertices, elements
+
+
+for num_tets in args.sizes:
+    vertices, elements = regular_tet_mesh(num_tets)
+    for num_quad in args.num_quad:
+        t0 = time.time()
+        _, _, discontinuity_matrix, _, _, _ = fracture.explode_mesh(vertices, elements, num_quad=num_quad)
+        t1 = time.time()
+        print(f"{elements.shape[0]:>8} tets, num_quad={num_quad}: {t1 - t0:.3f} seconds, "
+              f"discontinuity matrix {discontinuity_matrix.shape[0]} x {discontinuity_matrix.shape[1]}")
@@ -0,0 +1,48 @@
+# Compare the MOSEK and ADMM conic solver backends on the bundled meshes
+import glob
+import time
+from argparse import ArgumentParser
+
+import igl
+import numpy as np
+import tetgen
+from gpytoolbox.copyleft import lazy_cage
+
+from context import fracture_utility as fracture
+from context import gpytoolbox
+
+parser = ArgumentParser()
+parser.add_argument('inputs', type=str, nargs='*', default=sorted(glob.glob("data/*.obj")))
+parser.add_argument('--num_modes', type=int, default=10)
+parser.add_argument('--cage_size', type=int, default=2000)
+parser.add_argument('--solver_tol', type=float, default=1e-6)
+args = parser.parse_args()
+
+for filename in args.inputs:
+    v_fine, f_fine = igl.read_triangle_mesh(filename)
+    v_fine = gpytoolbox.normalize_points(v_fine)
+    v, f = lazy_cage(v_fine, f_fine, num_faces=args.cage_size)
+    tgen = tetgen.TetGen(v, f)
+    nodes, elements = tgen.tetrahedralize(minratio=1.5)
+    print(f"{filename}: {elements.shape[0]} tets")
+
+    results = {}
+    for solver in ['mosek', 'admm']:
+        params = fracture.FractureModesParameters(num_modes=args.num_modes, d=1, solver=solver,
+                                                  solver_tol=args.solver_tol)
+        t0 = time.time()
+        _, _, modes, labels, _, _, M, _ = fracture.compute_fracture_modes(nodes, elements, params)
+        t1 = time.time()
+        n_pieces = [int(np.max(labels[:, k])) + 1 for k in range(labels.shape[1])]
+        results[solver] = (modes, M)
+        print(f"    {solver:>5}: {t1 - t0:8.2f} seconds, pieces per mode: {n_pieces}")
+
+    # Modes are only defined up to sign, so compare them up to sign
+    modes_mosek, M = results['mosek']
+    modes_admm = results['admm'][0]
+    errors = []
+    for k in range(modes_mosek.shape[1]):
+        error_plus = np.max(np.abs(modes_mosek[:, k] - modes_admm[:, k]))
+        error_minus = np.max(np.abs(modes_mosek[:, k] + modes_admm[:, k]))
+        errors.append(min(error_plus, error_minus))
+    print(f"    max |mosek - admm| per mode: {np.round(errors, 5).tolist()}")
@@ -0,0 +1,99 @@
+# Compare the 'boolean' and 'point_location' backends that split the fine mesh into pieces in impact_precomputation
+import time
+from argparse import ArgumentParser
+
+import igl
+import numpy as np
+import tetgen
+from gpytoolbox.copyleft import lazy_cage
+
+from context import fracture_utility as fracture
+from context import gpytoolbox
+
+parser = ArgumentParser()
+parser.add_argument('inputs', type=str, nargs='*', default=["data/bunny_oded.obj", "data/chair.obj"])
+parser.add_argument('--num_modes', type=int, default=10)
+parser.add_argument('--cage_size', type=int, default=2000)
+parser.add_argument('--solver', type=str, default='mosek')
+args = parser.parse_args()
+
+
+def piece_meshes(modes):
+    # Split the assembled fine mesh back into one mesh per piece
+    piece_of_vertex = modes.piece_to_fine_vertices_matrix.tocsr().indices
+    meshes = []
+    for i in range(modes.precomputed_num_pieces):
+        triangles = modes.fine_triangles[piece_of_vertex[modes.fine_triangles[:, 0]] == i, :]
+        if triangles.shape[0] == 0:
+            meshes.append((np.zeros((0, 3)), np.zeros((0, 3), dtype=int)))
+            continue
+        meshes.append(igl.remove_unreferenced(modes.fine_vertices, triangles)[:2])
+    return meshes
+
+
+def area(v, f):
+    return 0.0 if f.shape[0] == 0 else 0.5 * np.sum(igl.doublearea(v, f))
+
+
+def volume(v, f):
+    if f.shape[0] == 0:
+        return 0.0
+    return np.sum(np.einsum('ij,ij->i', v[f[:, 0], :], np.cross(v[f[:, 1], :], v[f[:, 2], :]))) / 6
+
+
+def open_edges(f):
+    # Number of edges with a single adjacent triangle
+    if f.shape[0] == 0:
+        return 0
+    edges = np.sort(np.vstack((f[:, [0, 1]], f[:, [1, 2]], f[:, [2, 0]])), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    return int(np.sum(counts == 1))
+
+
+def distance(v_from, f_from, v_to, f_to, num_samples=5000):
+    # Distance from random points on one mesh to the other mesh (its max approximates the one-sided Hausdorff distance)
+    if f_from.shape[0] == 0 or f_to.shape[0] == 0:
+        return np.zeros(1)
+    areas = igl.doublearea(v_from, f_from)
+    triangles = np.random.choice(f_from.shape[0], num_samples, p=areas / np.sum(areas))
+    b = np.random.rand(num_samples, 2)
+    b[np.sum(b, axis=1) > 1, :] = 1 - b[np.sum(b, axis=1) > 1, :]
+    points = (1 - b[:, [0]] - b[:, [1]]) * v_from[f_from[triangles, 0], :] + b[:, [0]] * v_from[f_from[triangles, 1], :] + \
+             b[:, [1]] * v_from[f_from[triangles, 2], :]
+    return np.sqrt(igl.point_mesh_squared_distance(points, v_to, f_to)[0])
+
+
+for filename in args.inputs:
+    v_fine, f_fine = igl.read_triangle_mesh(filename)
+    v_fine = gpytoolbox.normalize_points(v_fine)
+    v, f = lazy_cage(v_fine, f_fine, num_faces=args.cage_size)
+    tgen = tetgen.TetGen(v, f)
+    nodes, elements = tgen.tetrahedralize(minratio=1.5)
+    modes = fracture.FractureModes(nodes, elements)
+    modes.compute_modes(fracture.FractureModesParameters(num_modes=args.num_modes, d=1, solver=args.solver))
+    print(f"{filename}: {f_fine.shape[0]} fine triangles, {elements.shape[0]} tets")
+
+    results = {}
+    for backend in ['boolean', 'point_location']:
+        t0 = time.time()
+        modes.impact_precomputation(v_fine=v_fine, f_fine=f_fine, fine_backend=backend)
+        t1 = time.time()
+        results[backend] = piece_meshes(modes)
+        print(f"    {backend:>14}: {t1 - t0:8.2f} seconds for {modes.precomputed_num_pieces} pieces")
+
+    # Quality of point location, taking the booleans as ground truth
+    area_errors = []
+    volume_errors = []
+    distances = []
+    num_open_edges = {'boolean': 0, 'point_location': 0}
+    for (vb, fb), (vp, fp) in zip(results['boolean'], results['point_location']):
+        area_errors.append(abs(area(vp, fp) - area(vb, fb)) / max(area(vb, fb), 1e-12))
+        volume_errors.append(abs(volume(vp, fp) - volume(vb, fb)) / max(abs(volume(vb, fb)), 1e-12))
+        distances.append(np.concatenate((distance(vb, fb, vp, fp), distance(vp, fp, vb, fb))))
+        num_open_edges['boolean'] += open_edges(fb)
+        num_open_edges['point_location'] += open_edges(fp)
+    print(f"    per-piece relative area error: median {np.median(area_errors):.4f}, max {np.max(area_errors):.4f}")
+    print(f"    per-piece relative volume error: median {np.median(volume_errors):.4f}, max {np.max(volume_errors):.4f}")
+    distances = np.concatenate(distances)
+    print(f"    distance between surfaces: median {np.median(distances):.5f}, 99th percentile {np.percentile(distances, 99):.5f}, max {np.max(distances):.5f}")
+    print(f"    open edges in all pieces: {num_open_edges['boolean']} (boolean), {num_open_edges['point_location']} (point location)")
@@ -49,6 +49,8 @@ f_fine = f
 v, f = lazy_cage(v_fine, f_fine, num_faces=face_num, grid_size=gs)
 ind = 0
 threshold = 10
+target_num_pieces = 2
+hierarchy = None
 now = datetime.now()
 dt_string = now.strftime("_%d_%m_%H_%M")
 base = os.path.basename(filename)
@@ -66,7 +68,7 @@ ps_cage.set_transparency(0.4)
 
 
 def callback():
-    global t, ind, nodes, elements, params, computed_modes, showing_modes, showing_input, v, f, ps_input_mesh, ps_vol, modes, off, UU, face_num, ps_cage, v_fine, f_fine, ps_impact_mesh, ps_fracture_mesh, P, ind, showing_impact, ps_impact_projected_mesh, threshold, impact, impact_text, modes_text, off_x, off_y, contact_point, gs, modes_1d, labels_fine_1d, labels_1d, fine_vertices_1d, fine_triangles_1d, off_tets_x, off_tets, off_tets_x_exploded, off_tets_y, direction, show_full_impact
+    global hierarchy, target_num_pieces, t, ind, nodes, elements, params, computed_modes, showing_modes, showing_input, v, f, ps_input_mesh, ps_vol, modes, off, UU, face_num, ps_cage, v_fine, f_fine, ps_impact_mesh, ps_fracture_mesh, P, ind, showing_impact, ps_impact_projected_mesh, threshold, impact, impact_text, modes_text, off_x, off_y, contact_point, gs, modes_1d, labels_fine_1d, labels_1d, fine_vertices_1d, fine_triangles_1d, off_tets_x, off_tets, off_tets_x_exploded, off_tets_y, direction, show_full_impact
     # Executed every frame
     # Do computation here, define custom UIs, etc.
     changed, params.num_modes = psim.InputInt("Number of modes", params.num_modes, step=1, step_fast=10)
@@ -77,21 +79,15 @@ def callback():
         modes_text = "Computing modes..."
         modes = fracture.FractureModes(nodes, elements)
         modes.compute_modes(params)
-        modes.impact_precomputation(v_fine=v_fine, f_fine=f_fine)
-        labels_fine_1d = modes.fine_labels.copy()
-        fine_vertices_1d = modes.fine_vertices.copy()
-        fine_triangles_1d = modes.fine_triangles.copy()
+        # The fine mesh pieces are computed in the background, so that we don't have to wait for all of them here
+        modes.impact_precomputation(v_fine=v_fine, f_fine=f_fine, lazy_fine_pieces=True)
+        labels_fine_1d = None
         modes_1d = modes.modes.copy()  # For visualization only
         labels_1d = modes.labels.copy()  # For visualization only
         # modes.transfer_modes_to_3d()
         # modes.impact_precomputation(v_fine=v_fine,f_fine=f_fine)
         UU = modes_1d.copy()  # For visualization only
         UU = np.vstack((np.zeros((2 * UU.shape[0], UU.shape[1])), UU))  # Make Z be the dim
-        off = 0. * modes.fine_vertices
-        off_x = off.copy()
-        off_y = off.copy()
-        off_x[:, 0] = 1.2
-        off_y[:, 2] = 1.2
         computed_modes = True
         modes_text = "Computed modes"
         t = 0.0
@@ -108,6 +104,10 @@ def callback():
             showing_input = False
         ps_vol = []
         ps.set_transparency_mode('none')
+        if labels_fine_1d is None:
+            labels_fine_1d = modes.fine_labels.copy()
+            fine_vertices_1d = modes.fine_vertices.copy()
+            fine_triangles_1d = modes.fine_triangles.copy()
         off = 0. * fine_vertices_1d
         off_x = off.copy()
         off_y = off.copy()
@@ -185,9 +185,15 @@ def callback():
         ps.reset_camera_to_home_view()
 
     if showing_impact:
+        # Changing the threshold (or the number of pieces) doesn't need a new projection, we just read the fracture off the impact's hierarchy
         changed, threshold = psim.SliderFloat("Threshold", threshold, v_min=0.0, v_max=1000.0)
-        if changed and modes.impact_projected:
-            modes.impact_projection(contact_point=contact_point, threshold=threshold, direction=direction)
+        if changed and hierarchy is not None:
+            modes.set_piece_labels_after_impact(hierarchy.labels(threshold)[1])
+            ps_fracture_mesh.add_scalar_quantity("fracture", modes.fine_vertex_labels_after_impact, enabled=True)
+        changed, target_num_pieces = psim.InputInt("Number of pieces", target_num_pieces, step=1)
+        if changed and hierarchy is not None:
+            threshold = min(hierarchy.threshold_for_num_pieces(target_num_pieces), 1000.0)
+            modes.set_piece_labels_after_impact(hierarchy.labels(threshold)[1])
             ps_fracture_mesh.add_scalar_quantity("fracture", modes.fine_vertex_labels_after_impact, enabled=True)
         if psim.Button("Generate random impact"):
             contact_point = P[ind, :]
@@ -195,6 +201,7 @@ def callback():
             direction = np.array([1])
             ind = ind + 1
             modes.impact_projection(contact_point=contact_point, threshold=threshold, direction=direction)
+            hierarchy = modes.impact_hierarchy()
             if show_full_impact:
                 ps_impact_mesh.update_vertex_positions(modes.vertices + 10 * np.reshape(modes.impact_vis, (-1, 3)))
                 ps_impact_projected_mesh.update_vertex_positions(